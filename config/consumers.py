@@ -1,33 +1,264 @@
+import asyncio
 import json
+from collections import OrderedDict
+from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.db.models import Q
 from rest_framework_simplejwt.exceptions import TokenError
-from rest_framework_simplejwt.tokens import Token, AccessToken
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
 
+from config import metrics, presence
+from config.types import NotificationType
 
-class NotificationsConsumer(WebsocketConsumer):
-    def connect(self):
-        token = self.scope.get('query_string').decode('utf-8').split('=')[1]
+# live events equal in these fields are collapsed into the latest one while queued
+COLLAPSE_FIELDS = ('type', 'template', 'related_user', 'related_post', 'related_comment')
 
-        try:
-            jwt_auth = AccessToken(token)
-            user = jwt_auth['user_id']
-        except TokenError:
-            user = None
 
+class NotificationsConsumer(AsyncWebsocketConsumer):
+    """
+    Notification socket of one user, authenticated by the JWT access token in the query string.
+    The connection joins the user group (group name is the user id) and marks the user online
+    until it disconnects, the socket refreshes its presence every PRESENCE_TTL / 2 by itself.
+    "ping" frames are answered with "pong".
+
+    With {"action": "subscribe", "stream": "feed"} the socket receives `new_post` frames with
+    the id, author and timestamp of posts of followed users, and the serialized post when the
+    message has "data": true. Unsubscribed sockets get the generic new_thread notification.
+
+    With {"action": "subscribe", "stream": "posts", "posts": [ids]} the socket watches up to
+    `POST_WATCH_LIMIT` visible posts and receives `post_counters` frames, at most one per post
+    and `POST_COUNTERS_INTERVAL` seconds.
+
+    Notification frames carry the `id` of the stored notification, null for pushes that aren't
+    stored. A reconnecting client passes the id of its newest notification as `last_seen`, the newer
+    ones are streamed first, followed by a `replay` frame. Live events wait in the channel
+    until the replay is done, so a notification created meanwhile may arrive twice.
+    Coalesced notifications are updated in place and pushed once at the end of their window,
+    the client replaces its entry of the same id. Count changes of a notification the client
+    already had are not replayed, they show up when the inbox is reloaded.
+
+    Notifications are sent as JSON array frames. Live events are queued per connection and
+    flushed by `NOTIFICATION_SOCKET_BATCH`: after INTERVAL_MS or once MAX_EVENTS are waiting.
+    The queue holds at most QUEUE_SIZE events, a slow client loses the oldest ones.
+    """
+    group_name = None
+    feed_subscribed = False
+    feed_data = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = OrderedDict()
+        self.batch_full = asyncio.Event()
+        self.flusher = None
+        self.keepalive = None
+        self.stats = dict.fromkeys(
+            [metrics.SOCKET_FRAMES_SENT, metrics.SOCKET_EVENTS_SENT,
+             metrics.SOCKET_EVENTS_COLLAPSED, metrics.SOCKET_EVENTS_DROPPED], 0
+        )
+        self.queue_peak = 0
+        self.watched_posts = set()
+
+    async def connect(self):
+        params = parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+        user = self.authenticate(params)
         if user:
-            self.accept()
-            async_to_sync(self.channel_layer.group_add)(
-                str(user), self.channel_name
-            )
+            self.group_name = str(user)
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
+            await presence.connected(self.group_name, self.channel_name)
+            self.keepalive = asyncio.ensure_future(self.keep_presence())
+            await self.accept()
+            last_seen = params.get('last_seen', [''])[0]
+            if last_seen.isdigit():
+                await self.replay(user, int(last_seen))
         else:
-            self.close()
+            await self.close()
+
+    async def disconnect(self, close_code):
+        for task in (self.flusher, self.keepalive):
+            if task is not None:
+                task.cancel()
+        if self.group_name is not None:
+            await self.unsubscribe_feed()
+            await self.unwatch_posts(list(self.watched_posts))
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await presence.disconnected(self.group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if text_data == 'ping':
+            await self.send(text_data='pong')
+            return
+        try:
+            message = json.loads(text_data or '')
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        action, stream = message.get('action'), message.get('stream')
+        if stream == presence.FEED and action == 'subscribe':
+            await self.subscribe_feed(bool(message.get('data')))
+        elif stream == presence.FEED and action == 'unsubscribe':
+            await self.unsubscribe_feed()
+        elif stream == 'posts' and isinstance(message.get('posts'), list):
+            post_ids = [post_id for post_id in message['posts'] if isinstance(post_id, int)]
+            if action == 'subscribe':
+                await self.watch_posts(post_ids)
+            elif action == 'unsubscribe':
+                await self.unwatch_posts(post_ids)
+
+    async def subscribe_feed(self, with_data):
+        self.feed_data = with_data
+        if not self.feed_subscribed:
+            await self.channel_layer.group_add(presence.feed_group(self.group_name), self.channel_name)
+            await presence.connected(self.group_name, self.channel_name, presence.FEED)
+            self.feed_subscribed = True
+        await self.send(text_data=json.dumps({"type": "subscribed", "stream": presence.FEED}))
+
+    async def unsubscribe_feed(self):
+        if self.feed_subscribed:
+            await self.channel_layer.group_discard(presence.feed_group(self.group_name), self.channel_name)
+            await presence.disconnected(self.group_name, self.channel_name, presence.FEED)
+            self.feed_subscribed = False
+
+    async def keep_presence(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_TTL / 2)
+            await presence.heartbeat(self.group_name, self.channel_name)
+            if self.feed_subscribed:
+                await presence.heartbeat(self.group_name, self.channel_name, presence.FEED)
+            await presence.watching(self.watched_posts)
+
+    def authenticate(self, params):
+        try:
+            return AccessToken(params['token'][0])['user_id']
+        except (KeyError, TokenError):
+            return None
+
+    async def watch_posts(self, post_ids):
+        """Join the counter groups of visible posts, the socket keeps at most `POST_WATCH_LIMIT`."""
+        room = settings.POST_WATCH_LIMIT - len(self.watched_posts)
+        post_ids = [post_id for post_id in dict.fromkeys(post_ids) if post_id not in self.watched_posts][:room]
+        visible = await self.visible_posts(post_ids)
+        for post_id in visible:
+            await self.channel_layer.group_add(presence.post_group(post_id), self.channel_name)
+            self.watched_posts.add(post_id)
+        await presence.watching(visible)
+        await self.send(text_data=json.dumps(
+            {"type": "subscribed", "stream": "posts", "posts": sorted(self.watched_posts)}
+        ))
+
+    async def unwatch_posts(self, post_ids):
+        for post_id in post_ids:
+            if post_id in self.watched_posts:
+                await self.channel_layer.group_discard(presence.post_group(post_id), self.channel_name)
+                self.watched_posts.discard(post_id)
+
+    @database_sync_to_async
+    def visible_posts(self, post_ids):
+        from pages.models import Post
+
+        if not post_ids:
+            return []
+        user_id = int(self.group_name)
+        return list(Post.objects.filter(pk__in=post_ids).filter(
+            Q(author__is_private=False) | Q(author_id=user_id)
+            | Q(author__followee__follower_id=user_id, author__followee__allowed=True)
+        ).values_list('pk', flat=True).distinct())
+
+    async def replay(self, user_id, last_seen):
+        """
+        Send notifications created after `last_seen` in batches of `NOTIFICATION_REPLAY_BATCH_SIZE`.
+        Past `NOTIFICATION_REPLAY_LIMIT` the replay stops with `complete` false and the client
+        should reload the inbox instead.
+        """
+        batch_size, limit = settings.NOTIFICATION_REPLAY_BATCH_SIZE, settings.NOTIFICATION_REPLAY_LIMIT
+        sent, complete = 0, False
+        while sent < limit:
+            size = min(batch_size, limit - sent)
+            batch = await self.missed_notifications(user_id, last_seen, size)
+            if batch:
+                await self.send(text_data=self.render(batch))
+            sent += len(batch)
+            if batch:
+                last_seen = batch[-1]["id"]
+            if len(batch) < size:
+                complete = True
+                break
+        await self.send(text_data=json.dumps({"type": "replay", "last_id": last_seen, "complete": complete}))
+
+    @database_sync_to_async
+    def missed_notifications(self, user_id, after_id, count):
+        # asgi.py imports the routing before the app registry is ready
+        from config.tasks import stored_notification_event
+        from pages.models import Notification
+
+        notifications = Notification.objects.missed(user_id, after_id).select_related('related_user').only(
+            'id', 'type', 'payload', 'actor_count', 'related_post_id', 'related_comment_id', 'related_user__username'
+        )[:count]
+        return [stored_notification_event(notification)["notification"] for notification in notifications]
 
-    def disconnect(self, close_code):
-        pass
+    @staticmethod
+    def render(notifications):
+        frame = []
+        for notification in notifications:
+            notification = dict(notification)
+            notification["text"] = NotificationType.render(
+                notification.pop("template"), notification.pop("actor"), notification["actor_count"]
+            )
+            frame.append(notification)
+        return json.dumps(frame, separators=(',', ':'))
+
+    async def send_feed_post(self, event):
+        frame = {"type": "new_post", "post": event["post"]}
+        if self.feed_data and "data" in event:
+            frame["data"] = event["data"]
+        await self.send(text_data=json.dumps(frame, separators=(',', ':')))
+
+    async def send_post_counters(self, event):
+        frame = {key: value for key, value in event.items() if key != "type"}
+        await self.send(text_data=json.dumps({"type": "post_counters", **frame}, separators=(',', ':')))
+
+    async def send_notification(self, event):
+        options = settings.NOTIFICATION_SOCKET_BATCH
+        notification = event["notification"]
+        key = tuple(notification.get(field) for field in COLLAPSE_FIELDS)
+        if key in self.pending:
+            self.stats[metrics.SOCKET_EVENTS_COLLAPSED] += 1
+        elif len(self.pending) >= options["QUEUE_SIZE"]:
+            self.pending.popitem(last=False)
+            self.stats[metrics.SOCKET_EVENTS_DROPPED] += 1
+        self.pending[key] = notification
+        self.queue_peak = max(self.queue_peak, len(self.pending))
+
+        if len(self.pending) >= options["MAX_EVENTS"]:
+            self.batch_full.set()
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_pending())
+
+    async def flush_pending(self):
+        """Wait for the batch interval or a full batch, then send everything queued meanwhile."""
+        options = settings.NOTIFICATION_SOCKET_BATCH
+        try:
+            await asyncio.wait_for(self.batch_full.wait(), options["INTERVAL_MS"] / 1000)
+        except asyncio.TimeoutError:
+            pass
+        self.batch_full.clear()
+        while self.pending:
+            size = min(options["MAX_EVENTS"], len(self.pending))
+            batch = [self.pending.popitem(last=False)[1] for _ in range(size)]
+            await self.send(text_data=self.render(batch))
+            self.stats[metrics.SOCKET_FRAMES_SENT] += 1
+            self.stats[metrics.SOCKET_EVENTS_SENT] += size
+        # events queued from now on start a new flush
+        self.flusher = None
+        await self.report_stats()
 
-    def send_notification(self, event):
-        message = event["message"]
-        self.send(text_data=json.dumps({"message": message}))
+    async def report_stats(self):
+        stats, queue_peak = self.stats, self.queue_peak
+        self.stats, self.queue_peak = dict.fromkeys(stats, 0), 0
+        for name, value in stats.items():
+            if value:
+                await metrics.aincr(name, value)
+        await metrics.aobserve_max(metrics.SOCKET_QUEUE_PEAK, queue_peak)
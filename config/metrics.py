@@ -0,0 +1,61 @@
+from django.core.cache import cache
+
+KEY_PREFIX = 'metrics'
+
+FEED_CACHE_HITS = 'feed_cache.hits'
+FEED_CACHE_MISSES = 'feed_cache.misses'
+PUSHES_DELIVERED = 'notifications.pushes_delivered'
+PUSHES_SKIPPED = 'notifications.pushes_skipped'
+SOCKET_FRAMES_SENT = 'notifications.socket_frames_sent'
+SOCKET_EVENTS_SENT = 'notifications.socket_events_sent'
+SOCKET_EVENTS_COLLAPSED = 'notifications.socket_events_collapsed'
+SOCKET_EVENTS_DROPPED = 'notifications.socket_events_dropped'
+SOCKET_QUEUE_PEAK = 'notifications.socket_queue_peak'
+
+METRIC_NAMES = [
+    FEED_CACHE_HITS,
+    FEED_CACHE_MISSES,
+    PUSHES_DELIVERED,
+    PUSHES_SKIPPED,
+    SOCKET_FRAMES_SENT,
+    SOCKET_EVENTS_SENT,
+    SOCKET_EVENTS_COLLAPSED,
+    SOCKET_EVENTS_DROPPED,
+    SOCKET_QUEUE_PEAK,
+]
+
+
+def _key(name):
+    return f'{KEY_PREFIX}:{name}'
+
+
+def incr(name, delta=1):
+    """Increase a shared counter kept in the default cache."""
+    key = _key(name)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, timeout=None):
+            cache.incr(key, delta)
+
+
+async def aincr(name, delta=1):
+    key = _key(name)
+    try:
+        await cache.aincr(key, delta)
+    except ValueError:
+        if not await cache.aadd(key, delta, timeout=None):
+            await cache.aincr(key, delta)
+
+
+async def aobserve_max(name, value):
+    """Raise a high-water mark gauge to `value`, concurrent updates may lose the larger one."""
+    key = _key(name)
+    if value > await cache.aget(key, 0):
+        await cache.aset(key, value, timeout=None)
+
+
+def snapshot(names=None):
+    names = METRIC_NAMES if names is None else names
+    values = cache.get_many([_key(name) for name in names])
+    return {name: values.get(_key(name), 0) for name in names}
@@ -0,0 +1,79 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = 'presence'
+
+# stream of live feed posts, sockets subscribe to it explicitly
+FEED = 'feed'
+
+
+def feed_group(user_id):
+    """Channel layer group of the live feed sockets of a user."""
+    return f'{FEED}_{user_id}'
+
+
+def post_group(post_id):
+    """Channel layer group of the sockets watching the counters of a post."""
+    return f'post_{post_id}'
+
+
+def _watched_key(post_id):
+    return f'{KEY_PREFIX}:post:{post_id}'
+
+
+async def watching(post_ids):
+    """Mark posts watched by an open socket for another TTL, sockets refresh them with their heartbeat."""
+    if post_ids:
+        await cache.aset_many({_watched_key(post_id): True for post_id in post_ids}, settings.PRESENCE_TTL)
+
+
+def watched(post_id):
+    """Whether a socket has watched the counters of the post within the last TTL."""
+    return cache.get(_watched_key(post_id)) is not None
+
+
+def _key(user_id, stream=None):
+    return f'{KEY_PREFIX}:{user_id}' if stream is None else f'{KEY_PREFIX}:{stream}:{user_id}'
+
+
+async def connected(user_id, connection, stream=None):
+    """Mark a socket (subscribed to `stream`) of the user open for another TTL."""
+    await _set(_key(user_id, stream), connection, alive=True)
+
+
+# open sockets call it every PRESENCE_TTL / 2, so a user stays online while any socket is open
+heartbeat = connected
+
+
+async def disconnected(user_id, connection, stream=None):
+    await _set(_key(user_id, stream), connection, alive=False)
+
+
+def _open_connections(value, now):
+    # {connection: expires_at} of the sockets of one user, entries of crashed sockets time out
+    if not isinstance(value, dict):
+        return {}
+    return {connection: expires_at for connection, expires_at in value.items() if expires_at > now}
+
+
+async def _set(key, connection, alive):
+    # sockets of one user racing here may drop each other's entry, the next heartbeat restores it
+    now = time.time()
+    connections = _open_connections(await cache.aget(key), now)
+    connections.pop(connection, None)
+    if alive:
+        connections[connection] = now + settings.PRESENCE_TTL
+    if connections:
+        await cache.aset(key, connections, settings.PRESENCE_TTL)
+    else:
+        await cache.adelete(key)
+
+
+def online(user_ids, stream=None):
+    """Return those of the given user ids that have an open socket (subscribed to `stream`), in the given order."""
+    keys = {_key(user_id, stream): user_id for user_id in user_ids}
+    found = cache.get_many(keys)
+    now = time.time()
+    return [user_id for key, user_id in keys.items() if _open_connections(found.get(key), now)]
@@ -1,40 +1,469 @@
+import asyncio
+
 from asgiref.sync import async_to_sync
-from celery import shared_task
+from celery import group, shared_task
 from channels.layers import get_channel_layer
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import send_mail
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce, Now
+from django.utils import timezone
+
+from config import metrics, presence, types
+from pages.counters import adjust_counter
+from pages.feed_cache import PUBLIC_SCOPE, author_scope, tag_scope, bump_user_feeds, bump_versions
+from pages.models import (Notification, NotificationBroadcast, NotificationGroup, NotificationGroupActor,
+                          NotificationShard, Post)
+from pages import retention
+from pages.ranking import rank_for_you_candidates
+from pages.serializers import PostViewSerializer
+from pages.timelines import get_timeline_store, post_score, is_pull_author
+from pages.viewer import ViewerState
+from users.models import User, Follow
 
-from config import types
-from pages.models import Notification
-from users.models import User
+FANOUT_CHUNK_SIZE = 1000
+NOTIFICATION_CHUNK_SIZE = 1000
+SAMPLE_ACTORS = 3
+# seconds, below CELERY_TASK_TIME_LIMIT so a long shard is retried before the hard kill
+SHARD_SOFT_TIME_LIMIT = 25 * 60
 
 
 @shared_task
 def send_notification(recipient_id: int, notification_data: dict, create_notification=True):
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        str(recipient_id),
-        {
-            "type": "send_notification",
-            "message": f'"{notification_data["type"]}": "{notification_data["message"]}"',
+    notification_id = None
+    if create_notification:
+        with transaction.atomic():
+            notification = build_notification(recipient_id, notification_data)
+            notification.save()
+            adjust_counter(User, recipient_id, 'unread_notifications')
+        notification_id = notification.pk
+    push_to_online([recipient_id], notification_event(notification_data, notification_id=notification_id))
+
+
+@shared_task
+def send_multiple_notifications(notification_type: dict, create_notification=True, shard_size=None, **filters):
+    """
+    Notify every user matching `filters`. Recipients are split into shards of `shard_size`
+    (NOTIFICATION_SHARD_SIZE by default) consecutive recipient ids which are sent as a group,
+    so workers deliver them in parallel and a failed shard is retried from its checkpoint.
+    """
+    return start_broadcast(notification_type, filters, create_notification, shard_size)
+
+
+def start_broadcast(notification_data, filters, create_notification=True, shard_size=None, post_id=None):
+    bounds = shard_bounds(User.objects.filter(**filters), shard_size or settings.NOTIFICATION_SHARD_SIZE)
+    if not bounds:
+        return None
+    broadcast = NotificationBroadcast.objects.create(
+        notification_data=notification_data, filters=filters, create_notification=create_notification,
+        post_id=post_id,
+    )
+    shards = NotificationShard.objects.bulk_create(
+        NotificationShard(broadcast=broadcast, start_id=start_id, end_id=end_id) for start_id, end_id in bounds
+    )
+    group(send_notification_shard.s(shard.id) for shard in shards).apply_async()
+    return broadcast.id
+
+
+def shard_bounds(recipients, shard_size):
+    """(first id, last id) of every `shard_size` consecutive recipients, sparse audiences make few shards."""
+    recipient_ids = recipients.order_by('id').values_list('id', flat=True).iterator(chunk_size=NOTIFICATION_CHUNK_SIZE)
+    return [(chunk[0], chunk[-1]) for chunk in _chunked(recipient_ids, shard_size)]
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, soft_time_limit=SHARD_SOFT_TIME_LIMIT,
+             autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def send_notification_shard(self, shard_id: int):
+    """
+    Deliver one broadcast shard in chunks. Stored notifications and the checkpoint are
+    committed together, so a retry neither loses nor duplicates rows. A shard hitting the
+    soft time limit is retried, one of a killed or lost worker goes back to the queue,
+    both continue after the checkpoint.
+    """
+    shard = NotificationShard.objects.select_related('broadcast__post').filter(pk=shard_id).first()
+    if shard is None:
+        # the announced post was deleted
+        return 0
+    if shard.finished_at is not None:
+        return shard.sent
+    broadcast = shard.broadcast
+    NotificationShard.objects.filter(pk=shard_id).update(
+        attempts=F('attempts') + 1, started_at=Coalesce('started_at', Now())
+    )
+
+    after_id = shard.last_recipient_id if shard.last_recipient_id is not None else shard.start_id - 1
+    recipient_ids = User.objects.filter(**broadcast.filters).filter(
+        id__gt=after_id, id__lte=shard.end_id
+    ).order_by('id').values_list('id', flat=True).iterator(chunk_size=NOTIFICATION_CHUNK_SIZE)
+    event = notification_event(broadcast.notification_data)
+    if broadcast.post is not None:
+        feed_event = feed_post_event(broadcast.post)
+    for chunk in _chunked(recipient_ids, NOTIFICATION_CHUNK_SIZE):
+        notification_ids = None
+        with transaction.atomic():
+            if broadcast.create_notification:
+                notifications = Notification.objects.bulk_create(
+                    [build_notification(recipient_id, broadcast.notification_data) for recipient_id in chunk]
+                )
+                # backends that don't return inserted ids leave them empty
+                notification_ids = {notification.owner_id: notification.pk for notification in notifications}
+                User.objects.filter(pk__in=chunk).update(unread_notifications=F('unread_notifications') + 1)
+            NotificationShard.objects.filter(pk=shard_id).update(
+                last_recipient_id=chunk[-1], sent=F('sent') + len(chunk)
+            )
+        if broadcast.post is None:
+            push_to_online(chunk, event, notification_ids)
+        else:
+            push_feed_post(chunk, feed_event, event, notification_ids)
+
+    NotificationShard.objects.filter(pk=shard_id).update(finished_at=Now())
+    shard.refresh_from_db(fields=['sent'])
+    return shard.sent
+
+
+def coalescing_key(notification_data):
+    return f"{notification_data['type']}:{notification_data.get('related_post') or ''}"
+
+
+def _open_group(recipient_id, notification_data):
+    """
+    The locked group of the event, created by the first event of a window. The unique
+    (owner, key) constraint makes concurrent first events share one group.
+    """
+    key = coalescing_key(notification_data)
+    group, created = NotificationGroup.objects.select_for_update().get_or_create(owner_id=recipient_id, key=key)
+    if not created and group.opened_at < timezone.now() - settings.NOTIFICATION_COALESCE_WINDOW:
+        # the flush of that window was lost, its notification stays as it is
+        group.delete()
+        group, created = NotificationGroup.objects.create(owner_id=recipient_id, key=key), True
+    return group, created
+
+
+def _sample_actors(group):
+    return list(group.actors.order_by('-id').values_list('actor_id', flat=True)[:SAMPLE_ACTORS])
+
+
+@shared_task
+def coalesce_notification(recipient_id: int, notification_data: dict):
+    """
+    Count an event in the aggregated notification of its (owner, type, related_post) group.
+    The first event of a window stores the notification and schedules one push at the end of
+    the window, events of further actors update its count and sample actors in place.
+    """
+    actor_id = notification_data.get('related_user')
+    with transaction.atomic():
+        group, created = _open_group(recipient_id, notification_data)
+        try:
+            with transaction.atomic():
+                NotificationGroupActor.objects.create(group=group, actor_id=actor_id)
+        except IntegrityError:
+            # the actor is counted in this window already
+            return group.notification_id
+        if created:
+            notification = build_notification(recipient_id, notification_data)
+            notification.sample_actors = [actor_id]
+            notification.save()
+            adjust_counter(User, recipient_id, 'unread_notifications')
+            group.notification_id = notification.pk
+            group.save(update_fields=['notification_id'])
+        else:
+            notifications = Notification.objects.filter(pk=group.notification_id)
+            if notifications.filter(read_at__isnull=False).update(read_at=None):
+                adjust_counter(User, recipient_id, 'unread_notifications')
+            notifications.update(
+                actor_count=F('actor_count') + 1, sample_actors=_sample_actors(group), related_user_id=actor_id,
+                related_comment_id=notification_data.get('related_comment'),
+            )
+
+    if created:
+        window = settings.NOTIFICATION_COALESCE_WINDOW.total_seconds()
+        transaction.on_commit(lambda: flush_coalesced_notification.apply_async((group.pk,), countdown=window))
+    return group.notification_id
+
+
+@shared_task
+def retract_notification(recipient_id: int, notification_data: dict):
+    """
+    Take an actor back out of a still open window, e.g. an unlike within it. The newest
+    remaining actor is shown, a window left without actors is closed with its notification.
+    """
+    since = timezone.now() - settings.NOTIFICATION_COALESCE_WINDOW
+    with transaction.atomic():
+        group = NotificationGroup.objects.select_for_update().filter(
+            owner_id=recipient_id, key=coalescing_key(notification_data), opened_at__gte=since
+        ).first()
+        if group is None or not group.actors.filter(actor_id=notification_data.get('related_user')).delete()[0]:
+            return
+        notifications = Notification.objects.filter(pk=group.notification_id)
+        sample_actors = _sample_actors(group)
+        if sample_actors:
+            notifications.update(
+                actor_count=F('actor_count') - 1, sample_actors=sample_actors, related_user_id=sample_actors[0]
+            )
+            return
+        if notifications.filter(read_at__isnull=True).delete()[0]:
+            adjust_counter(User, recipient_id, 'unread_notifications', -1)
+        notifications.delete()
+        group.delete()
+
+
+@shared_task
+def flush_coalesced_notification(group_id: int):
+    """Close a coalescing window and push its notification, unless all its actors were retracted."""
+    with transaction.atomic():
+        notification_id = NotificationGroup.objects.select_for_update().filter(pk=group_id).values_list(
+            'notification_id', flat=True
+        ).first()
+        NotificationGroup.objects.filter(pk=group_id).delete()
+    notification = Notification.objects.filter(pk=notification_id).select_related('related_user').first()
+    if notification is None:
+        return
+    push_to_online([notification.owner_id], stored_notification_event(notification))
+
+
+@shared_task
+def broadcast_post_counters(post_id: int):
+    """Send the current engagement counters of a post to the sockets watching it."""
+    cache.delete(counter_broadcast_key(post_id))
+    counters = Post.objects.filter(pk=post_id).values('like_count', 'comment_count', 'repost_count', 'quote_count').first()
+    if counters is None:
+        return
+    async_to_sync(get_channel_layer().group_send)(presence.post_group(post_id), {
+        "type": "send_post_counters",
+        "post": post_id,
+        "total_likes": counters['like_count'],
+        "total_comments": counters['comment_count'],
+        "total_reposts": counters['repost_count'],
+        "total_quotes": counters['quote_count'],
+    })
+
+
+def post_counters_changed(post_id: int):
+    """
+    Schedule a counter broadcast at the end of the post interval if a socket watches the post.
+    Only the first change of an interval schedules it, the broadcast reads counters with all
+    later changes applied.
+    """
+    interval = settings.POST_COUNTERS_INTERVAL
+    if presence.watched(post_id) and cache.add(counter_broadcast_key(post_id), True, interval * 2):
+        transaction.on_commit(lambda: broadcast_post_counters.apply_async((post_id,), countdown=interval))
+
+
+def counter_broadcast_key(post_id: int):
+    return f'post_counters:broadcast:{post_id}'
+
+
+def notification_event(notification_data: dict, actor_count=1, notification_id=None):
+    """
+    Channel layer event with the structured notification, the consumer renders its text.
+    `id` is the stored notification, clients pass the newest one as `last_seen` on reconnect.
+    """
+    return {
+        "type": "send_notification",
+        "notification": {
+            "id": notification_id,
+            "type": notification_data["type"],
+            "template": notification_data["template"],
+            "actor": notification_data.get("actor"),
+            "actor_count": actor_count,
+            "related_user": notification_data.get("related_user"),
+            "related_post": notification_data.get("related_post"),
+            "related_comment": notification_data.get("related_comment"),
         },
+    }
+
+
+def stored_notification_event(notification):
+    """Channel layer event of a stored notification, its `related_user` has to be loaded."""
+    notification_data = {
+        "type": notification.type,
+        "template": notification.template,
+        "actor": notification.related_user.username if notification.related_user_id else None,
+        "related_user": notification.related_user_id,
+        "related_post": notification.related_post_id,
+        "related_comment": notification.related_comment_id,
+    }
+    return notification_event(notification_data, notification.actor_count, notification.id)
+
+
+def build_notification(recipient_id: int, notification_data: dict):
+    template = notification_data['template']
+    return Notification(
+        owner_id=recipient_id,
+        type=notification_data['type'],
+        payload={} if template == notification_data['type'] else {'template': template},
+        related_post_id=notification_data.get("related_post"),
+        related_comment_id=notification_data.get("related_comment"),
+        related_user_id=notification_data.get("related_user"),
     )
-    if create_notification:
-        Notification.objects.create(
-            owner_id=recipient_id,
-            text=notification_data["message"],
-            type=notification_data['type'],
-            related_post=notification_data.get("related_post"),
-            related_comment=notification_data.get("related_comment"),
-            related_user_id=notification_data.get("related_user"),
-        )
+
+
+def push_to_online(recipient_ids, event, notification_ids=None):
+    """
+    Send the event to recipients with an open socket, the rest only get the stored notification.
+    `notification_ids` maps recipients to the ids of their stored notifications, put into their events.
+    """
+    online = presence.online(recipient_ids)
+    if online:
+        events = {
+            str(user_id): _with_notification_id(event, notification_ids.get(user_id)) if notification_ids else event
+            for user_id in online
+        }
+        async_to_sync(_group_send_many)(get_channel_layer(), events)
+    metrics.incr(metrics.PUSHES_DELIVERED, len(online))
+    metrics.incr(metrics.PUSHES_SKIPPED, len(recipient_ids) - len(online))
+
+
+def _with_notification_id(event, notification_id):
+    return {**event, "notification": {**event["notification"], "id": notification_id}}
+
+
+async def _group_send_many(channel_layer, events):
+    """Send every group, given as group name -> event, its own copy of the event."""
+    await asyncio.gather(*(channel_layer.group_send(group_name, dict(event)) for group_name, event in events.items()))
+
+
+def _chunked(iterable, size=FANOUT_CHUNK_SIZE):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@shared_task
+def fan_out_post(post_id: int):
+    """
+    Push a new post into the timelines of all allowed followers of its author.
+    Posts of authors above the follower limit only go to the author cache and are merged at read time.
+    """
+    try:
+        post = Post.objects.only('id', 'author_id', 'date_posted').get(pk=post_id)
+    except Post.DoesNotExist:
+        return
+    store = get_timeline_store()
+    bump_versions(tag_scope(tag_name) for tag_name in post.hash_tag.values_list('tag_name', flat=True))
+    store.push_author(post.author_id, post.id, post_score(post))
+    is_pull = post.author_id in store.pull_authors()
+    if not is_pull and is_pull_author(User.objects.values_list('follower_count', flat=True).get(pk=post.author_id)):
+        store.add_pull_author(post.author_id)
+        is_pull = True
+    if is_pull:
+        bump_versions([author_scope(post.author_id)])
+        return
+
+    follower_ids = Follow.objects.filter(
+        followee_id=post.author_id, allowed=True
+    ).values_list('follower_id', flat=True).iterator(chunk_size=FANOUT_CHUNK_SIZE)
+    for chunk in _chunked(follower_ids):
+        store.push(chunk, post.id, post_score(post))
+        bump_user_feeds(*chunk)
+
+
+@shared_task
+def push_new_post(post_id: int):
+    """
+    Announce a new post to the online allowed followers of its author, as a sharded broadcast.
+    Sockets subscribed to the live feed get a post envelope (with the serialized post if
+    `LIVE_FEED_POST_DATA`), other sockets the generic new_thread notification.
+    """
+    author_id = Post.objects.filter(pk=post_id).values_list('author_id', flat=True).first()
+    if author_id is None:
+        return None
+    return start_broadcast(
+        types.NotificationType.new_thread(), {'follower__followee_id': author_id, 'follower__allowed': True},
+        create_notification=False, post_id=post_id,
+    )
+
+
+def feed_post_event(post):
+    event = {
+        "type": "send_feed_post",
+        "post": {"id": post.id, "author": post.author_id, "date_posted": post.date_posted.isoformat()},
+    }
+    if settings.LIVE_FEED_POST_DATA:
+        # nobody has interacted with a new post yet
+        event["data"] = PostViewSerializer(post, context={'viewer_state': ViewerState([post.id])}).data
+    return event
+
+
+def push_feed_post(recipient_ids, event, legacy_event, notification_ids=None):
+    """Send the post envelope to live feed subscribers and the legacy event to the other recipients."""
+    subscribers = presence.online(recipient_ids, presence.FEED)
+    if subscribers:
+        feed_groups = [presence.feed_group(user_id) for user_id in subscribers]
+        async_to_sync(_group_send_many)(get_channel_layer(), dict.fromkeys(feed_groups, event))
+    subscribers = set(subscribers)
+    push_to_online([user_id for user_id in recipient_ids if user_id not in subscribers], legacy_event, notification_ids)
+
+
+@shared_task
+def remove_posts_from_timelines(entries: list):
+    """Purge deleted posts, given as [post_id, author_id] pairs, from follower timelines."""
+    posts_by_author = {}
+    for post_id, author_id in entries:
+        posts_by_author.setdefault(author_id, []).append(post_id)
+
+    store = get_timeline_store()
+    pull_authors = store.pull_authors()
+    for author_id, post_ids in posts_by_author.items():
+        store.remove_author_posts(author_id, post_ids)
+        if author_id in pull_authors:
+            bump_versions([author_scope(author_id)])
+            # deleted ids left in follower timelines are skipped by the feed query and trimmed out over time
+            continue
+        follower_ids = Follow.objects.filter(
+            followee_id=author_id, allowed=True
+        ).values_list('follower_id', flat=True).iterator(chunk_size=FANOUT_CHUNK_SIZE)
+        for chunk in _chunked(follower_ids):
+            store.remove(chunk, post_ids)
+            bump_user_feeds(*chunk)
+
+
+@shared_task
+def backfill_timeline(follower_id: int, followee_id: int):
+    """Add the newest posts of a just followed user to the follower timeline."""
+    store = get_timeline_store()
+    if followee_id in store.pull_authors():
+        return
+    if not store.exists(follower_id):
+        # built on the next read, with the followee
+        bump_user_feeds(follower_id)
+        return
+    posts = Post.objects.filter(author_id=followee_id).order_by('-date_posted').values_list(
+        'pk', 'date_posted'
+    )[:store.max_length]
+    store.extend(follower_id, ((post_id, date_posted.timestamp()) for post_id, date_posted in posts))
+    bump_user_feeds(follower_id)
+
+
+@shared_task
+def purge_timeline(follower_id: int, followee_id: int):
+    """Remove posts of an unfollowed user from the follower timeline."""
+    store = get_timeline_store()
+    post_ids = Post.objects.filter(author_id=followee_id).order_by('-date_posted').values_list(
+        'pk', flat=True
+    )[:store.max_length]
+    store.remove([follower_id], list(post_ids))
+    bump_user_feeds(follower_id)
+
+
+@shared_task
+def rank_for_you_feed():
+    ranked = rank_for_you_candidates()
+    bump_versions([PUBLIC_SCOPE])
+    return ranked
 
 
 @shared_task
-def send_multiple_notifications(notification_type: dict, create_notification=True, **filters,):
-    users = User.objects.filter(**filters)
-    for user in users:
-        send_notification(user.id, notification_type, create_notification=create_notification)
+def expire_notifications():
+    retention.expire_broadcasts()
+    return retention.expire_notifications()
 
 
 @shared_task
@@ -136,10 +136,78 @@ if not DEBUG:
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [("redis", 6379)],
-        },
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+FEED_CACHE_TIMEOUT = 60
+
+# levels of quote chains expanded in post responses, deeper originals are returned as ids
+REPOST_CHAIN_DEPTH = 3
+
+# recipients delivered by one broadcast notification task
+NOTIFICATION_SHARD_SIZE = 10000
+# broadcasts and their shard checkpoints are removed this long after they were started
+NOTIFICATION_BROADCAST_RETENTION = timedelta(days=7)
+
+# like/comment/repost/follow notifications of one group within the window are merged into one
+NOTIFICATION_COALESCE_WINDOW = timedelta(seconds=30)
+
+# older notifications are archived (gzip NDJSON, one file per month) and removed by a daily task,
+# without an archive directory they are only removed
+NOTIFICATION_RETENTION = timedelta(days=180)
+NOTIFICATION_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive/notifications/')
+
+# seconds a notification socket counts as online after its last heartbeat, sockets send one every
+# PRESENCE_TTL / 2 while open, pushes skip offline users
+PRESENCE_TTL = 90
+
+# notifications streamed on reconnect after the client `last_seen` id, in batches, up to the limit
+NOTIFICATION_REPLAY_BATCH_SIZE = 100
+NOTIFICATION_REPLAY_LIMIT = 500
+
+# live notifications of a socket are sent in batches every INTERVAL_MS or MAX_EVENTS events,
+# at most QUEUE_SIZE events wait per socket, equal events are collapsed and the oldest dropped
+NOTIFICATION_SOCKET_BATCH = {
+    "INTERVAL_MS": 100,
+    "MAX_EVENTS": 50,
+    "QUEUE_SIZE": 500,
+}
+
+# live feed frames carry the serialized post next to its id, author and timestamp
+LIVE_FEED_POST_DATA = True
+
+# sockets watch the counters of at most this many posts, each post broadcasts them at most once per interval (seconds)
+POST_WATCH_LIMIT = 50
+POST_COUNTERS_INTERVAL = 2
+
+TIMELINES = {
+    "BACKEND": "pages.timelines.InMemoryTimelineStore",
+    "MAX_LENGTH": 800,
+    "AUTHOR_MAX_LENGTH": 100,
+    "FANOUT_FOLLOWER_LIMIT": 10000,
+}
+
+# allowed follower / following / pending id sets per user, with a short lived in-process LRU in front
+SOCIAL_GRAPH = {
+    "BACKEND": "users.graph.InMemoryGraphStore",
+    "LOCAL_CACHE_SIZE": 10000,
+    "LOCAL_CACHE_TTL": 5,
+}
+
+FOR_YOU_RANKING = {
+    "WINDOW": timedelta(days=3),
+    "POOL_SIZE": 1000,
+    "GRAVITY": 1.5,
+    "WEIGHTS": {
+        "likes": 1,
+        "comments": 2,
+        "reposts": 3,
     },
 }
 
@@ -157,6 +225,8 @@ OTP_LIFETIME = timedelta(minutes=15)
 WSGI_APPLICATION = 'config.wsgi.application'
 ASGI_APPLICATION = "config.asgi.application"
 
+CELERY_TASK_ALWAYS_EAGER = True
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
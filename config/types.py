@@ -3,11 +3,37 @@ from users.models import User
 
 
 class NotificationType:
+    # message templates by template name, `{actor}` is filled in when a notification is rendered
+    templates = {
+        "test": "All is work fine!",
+        "new_thread": "We have new updates from people you follow!",
+        "new_repost": "{actor} just reposted your thread!",
+        "new_quote": "{actor} just quoted your thread!",
+        "new_subscriber": "{actor} just followed you!",
+        "subscribe_request": "{actor} want to subscribe you!",
+        "subscribe_allowed": "{actor} allow your subscribe request!",
+        "new_like": "{actor} just liked your thread!",
+        "new_comment_like": "{actor} just liked your comment!",
+        "new_comment": "{actor} just commented on your thread!",
+        "new_comment_mention": "{actor} just mentioned you in a comment!",
+        "new_mention": "{actor} just mentioned you in a thread!",
+        "new_reply": "{actor} just replied to your comment!",
+    }
+
+    @classmethod
+    def render(cls, template, actor=None, actor_count=1):
+        """Message text; coalesced notifications read "@a and 41 others ..."."""
+        others = actor_count - 1
+        actor = f'@{actor}'
+        if others > 0:
+            actor = f'{actor} and {others} other{"s" if others > 1 else ""}'
+        return cls.templates.get(template, "").format(actor=actor)
+
     @staticmethod
     def test():
         return {
             "type": "test",
-            "message": "All is work fine!",
+            "template": "test",
             "related_user": None,
             "related_post": None,
             "related_comment": None,
@@ -18,7 +44,7 @@ class NotificationType:
     def new_thread():
         return {
             "type": "new_thread",
-            "message": "We have new updates from people you follow!",
+            "template": "new_thread",
             "related_user": None,
             "related_post": None,
             "related_comment": None,
@@ -28,7 +54,8 @@ class NotificationType:
     def new_repost(user, post):
         return {
             "type": "new_repost",
-            "message": f'@{user.username} just reposted your thread!',
+            "template": "new_repost",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": post.id,
             "related_comment": None,
@@ -39,7 +66,8 @@ class NotificationType:
     def new_quote(user, post):
         return {
             "type": "new_repost",
-            "message": f'@{user.username} just quoted your thread!',
+            "template": "new_quote",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": post.id,
             "related_comment": None,
@@ -50,7 +78,8 @@ class NotificationType:
     def new_subscriber(user):
         return {
             "type": "new_subscriber",
-            "message": f'@{user.username} just followed you!',
+            "template": "new_subscriber",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": None,
             "related_comment": None,
@@ -60,7 +89,8 @@ class NotificationType:
     def subscribe_request(user):
         return {
             "type": "subscribe_request",
-            "message": f'@{user.username} want to subscribe you!',
+            "template": "subscribe_request",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": None,
             "related_comment": None,
@@ -70,7 +100,8 @@ class NotificationType:
     def subscribe_allowed(user):
         return {
             "type": "subscribe_allowed",
-            "message": f'@{user.username} allow your subscribe request!',
+            "template": "subscribe_allowed",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": None,
             "related_comment": None,
@@ -81,7 +112,8 @@ class NotificationType:
     def new_thread_like(user, post):
         return {
             "type": "new_like",
-            "message": f'@{user.username} just liked your thread!',
+            "template": "new_like",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": post.id,
             "related_comment": None,
@@ -91,7 +123,8 @@ class NotificationType:
     def new_comment_like(user, comment):
         return {
             "type": "new_like",
-            "message": f'@{user.username} just liked your comment!',
+            "template": "new_comment_like",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": None,
             "related_comment": comment.id,
@@ -101,7 +134,8 @@ class NotificationType:
     def new_comment(user, related_post, comment):
         return {
             "type": "new_comment",
-            "message": f'@{user.username} just commented on your thread!',
+            "template": "new_comment",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": related_post.id,
             "related_comment": comment.id,
@@ -111,7 +145,8 @@ class NotificationType:
     def new_mentions_in_comment(user, comment):
         return {
             "type": "new_mention",
-            "message": f'@{user.username} just mentioned you in a comment!',
+            "template": "new_comment_mention",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": None,
             "related_comment": comment.id,
@@ -121,7 +156,8 @@ class NotificationType:
     def new_mentions_in_thread(user, post):
         return {
             "type": "new_mention",
-            "message": f'@{user.username} just mentioned you in a thread!',
+            "template": "new_mention",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": post.id,
             "related_comment": None,
@@ -131,7 +167,8 @@ class NotificationType:
     def new_reply(user, comment):
         return {
             "type": "new_reply",
-            "message": f'@{user.username} just replied to your comment!',
+            "template": "new_reply",
+            "actor": user.username,
             "related_user": user.id,
             "related_post": None,
             "related_comment": comment.id,
@@ -1,9 +1,16 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
+from datetime import datetime
 
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
 from drf_yasg import openapi
 from drf_yasg.inspectors import PaginatorInspector
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination, _positive_int
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class ThreadsMainPaginatorInspector(PaginatorInspector):
@@ -75,3 +82,162 @@ class ThreadsMainPaginator(PageNumberPagination):
 class ThreadsMainPaginatorLTE(ThreadsMainPaginator):
     lookup = 'id__lte'
 
+
+class ThreadsCursorPaginatorInspector(ThreadsMainPaginatorInspector):
+    def get_paginator_parameters(self, paginator):
+        return super().get_paginator_parameters(paginator) + [
+            openapi.Parameter(
+                name='cursor',
+                in_=openapi.IN_QUERY,
+                description='Opaque pagination cursor. Pass an empty value to get the first page '
+                            'without total count, then follow the links',
+                type=openapi.TYPE_STRING
+            )
+        ]
+
+
+class ThreadsCursorPaginator(BasePagination):
+    """
+    Keyset pagination by opaque cursor. Runs no COUNT query and no OFFSET scan,
+    rows are ordered and filtered by `ordering` fields, (date_posted, id) by default.
+    Views can override ordering with `cursor_ordering` attribute.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    ordering = ('-date_posted', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = tuple(getattr(view, 'cursor_ordering', self.ordering))
+        self.model = queryset.model
+
+        position, reverse = self.decode_cursor(request)
+        ordering = self.reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(ordering, position))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_paginated_response(self, data):
+        return Response({
+            'links': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link()
+            },
+            'results': data
+        })
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[-1]), reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[0]), reverse=True)
+
+    @staticmethod
+    def reverse_ordering(ordering):
+        return tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+
+    @staticmethod
+    def get_position_filter(ordering, position):
+        """Lexicographic "after position" filter: (a < x) OR (a = x AND b < y) OR ..."""
+        position_filter = Q()
+        for index, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition = Q(**{f'{name}__{lookup}': position[index]})
+            for previous_field, previous_value in zip(ordering[:index], position):
+                condition &= Q(**{previous_field.lstrip('-'): previous_value})
+            position_filter |= condition
+        return position_filter
+
+    def get_position(self, instance):
+        position = []
+        for field in self.ordering:
+            value = instance
+            for attr in field.lstrip('-').split('__'):
+                value = getattr(value, attr)
+            position.append(value.isoformat() if isinstance(value, datetime) else value)
+        return position
+
+    def get_model_field(self, name):
+        model, field = self.model, None
+        for attr in name.split('__'):
+            try:
+                field = model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                return None
+            model = field.related_model
+        return field
+
+    def encode_cursor(self, position, reverse):
+        payload = json.dumps({'p': position, 'r': reverse}, separators=(',', ':'))
+        cursor = urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    @staticmethod
+    def load_cursor(cursor):
+        """Return raw (position, reverse) of a cursor, position values are not converted."""
+        payload = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return list(payload['p']), bool(payload['r'])
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            position, reverse = self.load_cursor(cursor)
+            if len(position) != len(self.ordering):
+                raise ValueError
+            for index, field in enumerate(self.ordering):
+                model_field = self.get_model_field(field.lstrip('-'))
+                if model_field is not None:
+                    position[index] = model_field.to_python(position[index])
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+
+class CursorPaginationMixin:
+    """
+    Opt-in keyset pagination for list views: requests with `cursor` query param
+    (empty for the first page) are paginated by `cursor_pagination_class`,
+    the rest keep using `pagination_class`.
+    """
+    cursor_pagination_class = ThreadsCursorPaginator
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            cursor_class = self.cursor_pagination_class
+            if cursor_class is not None and cursor_class.cursor_query_param in self.request.query_params:
+                self._paginator = cursor_class()
+            else:
+                self._paginator = self.pagination_class() if self.pagination_class else None
+        return self._paginator
@@ -1,8 +1,13 @@
 from django.contrib import admin
 
-from .models import Post, Comment
+from .models import Post, Comment, NotificationShard
 
 admin.site.register(Post),
 admin.site.register(Comment),
 
 
+@admin.register(NotificationShard)
+class NotificationShardAdmin(admin.ModelAdmin):
+    list_display = ['id', 'broadcast', 'start_id', 'end_id', 'last_recipient_id', 'sent', 'attempts',
+                    'started_at', 'finished_at', 'duration']
+    list_filter = ['broadcast']
@@ -1,27 +1,169 @@
+import hashlib
+
+from django.utils.http import parse_etags, quote_etag
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework import generics
+from rest_framework import generics, status
+from rest_framework.exceptions import ParseError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 
-from config.utils import ThreadsMainPaginator, ThreadsMainPaginatorInspector
+from config.utils import ThreadsMainPaginator, ThreadsCursorPaginatorInspector, CursorPaginationMixin
+from users.models import User
+from users.serializers import UserProfileSerializer
+from .feed_cache import PUBLIC_SCOPE, user_scope, feed_cache_key, get_page, set_page
 
 
-class BaseSearchView(generics.ListAPIView):
+class BaseSearchView(CursorPaginationMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     model = None
     serializer_class = None
     pagination_class = ThreadsMainPaginator
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
+    cursor_ordering = ('id',)
 
     @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
     def get(self, request, search_obj, *args, **kwargs):
         queryset = self.get_queryset()
-        paginator = ThreadsMainPaginator()
-        result_page = paginator.paginate_queryset(queryset, request)
+        result_page = self.paginate_queryset(queryset)
         serializer = self.serializer_class(result_page, many=True, context=self.get_serializer_context())
-        return paginator.get_paginated_response(serializer.data)
+        return self.get_paginated_response(serializer.data)
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context['request'] = self.request
         return context
 
+
+class FeedCacheMixin:
+    """
+    Caches serialized feed pages per (viewer, feed, url). The key embeds versions of the
+    scopes the feed depends on, so a version bump makes old pages unreachable.
+    """
+    feed_name = None
+
+    def get_feed_scopes(self):
+        return [user_scope(self.request.user.id), PUBLIC_SCOPE]
+
+    def list(self, request, *args, **kwargs):
+        key = feed_cache_key(self.feed_name, request.user.id, self.get_feed_scopes(), request.build_absolute_uri())
+        data = get_page(key)
+        if data is not None:
+            return Response(data)
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            set_page(key, response.data)
+        return response
+
+
+class FeedDeltaMixin:
+    """
+    Polling mode of a feed. With `since` (post id or cursor) only items newer than it are
+    returned, with `count_only` just their number for "N new threads" badges. Both come from
+    one primary key range scan, and an unchanged poll answers 304 by `If-None-Match`.
+    """
+    since_query_param = 'since'
+    count_only_query_param = 'count_only'
+    max_delta_items = 100
+
+    delta_parameters = [
+        openapi.Parameter(
+            name='since',
+            in_=openapi.IN_QUERY,
+            description='Post id or cursor, return only items newer than it',
+            type=openapi.TYPE_STRING
+        ),
+        openapi.Parameter(
+            name='count_only',
+            in_=openapi.IN_QUERY,
+            description='With since, return only the number of new items (up to 100)',
+            type=openapi.TYPE_BOOLEAN
+        ),
+    ]
+
+    def list(self, request, *args, **kwargs):
+        since = request.query_params.get(self.since_query_param)
+        if since is None:
+            return super().list(request, *args, **kwargs)
+
+        since_id = self.parse_since(since)
+        queryset = self.filter_queryset(self.get_queryset()).filter(pk__gt=since_id)
+        new_ids = list(queryset.order_by('-pk').values_list('pk', flat=True)[:self.max_delta_items + 1])
+        has_more, new_ids = len(new_ids) > self.max_delta_items, new_ids[:self.max_delta_items]
+        count_only = request.query_params.get(self.count_only_query_param, '').lower() in ('1', 'true')
+
+        etag = quote_etag(hashlib.md5(f'{count_only}:{has_more}:{new_ids}'.encode('utf-8')).hexdigest())
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        data = {
+            'latest_id': new_ids[0] if new_ids else since_id,
+            'count': len(new_ids),
+            'has_more': has_more,
+        }
+        if not count_only:
+            posts = queryset.filter(pk__in=new_ids).order_by('-date_posted', '-pk')
+            data['results'] = self.get_serializer(posts, many=True).data
+        return Response(data, headers={'ETag': etag})
+
+    def parse_since(self, since):
+        if since.isdigit():
+            return int(since)
+        try:
+            # cursor orderings end with the primary key
+            position, _ = self.cursor_pagination_class.load_cursor(since)
+            return int(position[-1])
+        except (TypeError, ValueError, KeyError, IndexError):
+            raise ParseError('Invalid since value')
+
+
+class SideLoadUsersMixin:
+    """
+    Opt-in normalized response. With `?include=users` the referenced user ids (author,
+    related_user, also inside nested reposts and replies) are resolved into a de-duplicated
+    `users` map next to `results`, loaded with one query for the whole page.
+    """
+    include_query_param = 'include'
+    side_loaded_user_fields = ('author', 'related_user')
+
+    include_parameters = [
+        openapi.Parameter(
+            name='include',
+            in_=openapi.IN_QUERY,
+            description='`users` to add profiles of referenced users as a `users` map',
+            type=openapi.TYPE_STRING
+        ),
+    ]
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        include = request.query_params.get(self.include_query_param, '').split(',')
+        if 'users' not in include or response.status_code != status.HTTP_200_OK:
+            return response
+
+        data = response.data
+        if isinstance(data, list):
+            data = {'results': data}
+        data['users'] = self.load_users(self.collect_user_ids(data.get('results', [])))
+        response.data = data
+        return response
+
+    def collect_user_ids(self, items):
+        user_ids = set()
+        pending = list(items)
+        while pending:
+            item = pending.pop()
+            for field, value in item.items():
+                if isinstance(value, dict):
+                    pending.append(value)
+                elif field in self.side_loaded_user_fields and value is not None:
+                    user_ids.add(value)
+        return user_ids
+
+    @staticmethod
+    def load_users(user_ids):
+        if not user_ids:
+            return {}
+        fields = [field for field in UserProfileSerializer.Meta.fields if field != 'pk']
+        users = User.objects.filter(pk__in=user_ids).only(*fields)
+        return {user.pk: UserProfileSerializer(user).data for user in users}
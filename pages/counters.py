@@ -0,0 +1,154 @@
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from users.models import User, Follow
+from .models import Post, Comment, Notification
+
+
+def adjust_counter(model, pk, field, delta=1):
+    """Atomically change a denormalized counter column, never going below zero."""
+    model.objects.filter(pk=pk).update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def set_like(model, pk, user_id, liked):
+    """
+    Add or remove the like of a user on a post or comment together with its like counter.
+    The counter only moves when a like row was really inserted or deleted, so concurrent
+    requests never count twice. Returns whether anything changed.
+    """
+    field = model.likes.field
+    row = {f'{field.m2m_field_name()}_id': pk, f'{field.m2m_reverse_field_name()}_id': user_id}
+    with transaction.atomic():
+        if liked:
+            try:
+                with transaction.atomic():
+                    model.likes.through.objects.create(**row)
+            except IntegrityError:
+                return False
+        elif not model.likes.through.objects.filter(**row).delete()[0]:
+            return False
+        adjust_counter(model, pk, 'like_count', 1 if liked else -1)
+    return True
+
+
+def repost_counter_field(post):
+    return 'quote_count' if post.is_quote() else 'repost_count'
+
+
+def count_subquery(queryset, outer_field):
+    """Correlated COUNT(*) of queryset rows grouped by `outer_field`, 0 when there are none."""
+    counts = queryset.order_by().values(outer_field).annotate(total=Count('pk')).values('total')
+    return Coalesce(Subquery(counts), 0)
+
+
+def post_comment_count(comment_model=Comment):
+    return count_subquery(comment_model.objects.filter(post_id=OuterRef('pk')), 'post_id')
+
+
+# the expressions take the models as arguments, so data migrations can pass historical ones
+
+def post_counter_expressions(post_model=Post, comment_model=Comment):
+    return {
+        'like_count': count_subquery(post_model.likes.through.objects.filter(post_id=OuterRef('pk')), 'post_id'),
+        'comment_count': post_comment_count(comment_model),
+        'repost_count': count_subquery(
+            post_model.objects.filter(Q(text__isnull=True) | Q(text=''), repost_id=OuterRef('pk')), 'repost_id'
+        ),
+        'quote_count': count_subquery(
+            post_model.objects.filter(repost_id=OuterRef('pk')).exclude(text__isnull=True).exclude(text=''),
+            'repost_id'
+        ),
+    }
+
+
+def comment_counter_expressions(comment_model=Comment):
+    return {
+        'like_count': count_subquery(
+            comment_model.likes.through.objects.filter(comment_id=OuterRef('pk')), 'comment_id'
+        ),
+    }
+
+
+def user_counter_expressions(notification_model=Notification, follow_model=Follow, post_model=Post):
+    return {
+        'unread_notifications': count_subquery(
+            notification_model.objects.filter(owner_id=OuterRef('pk'), read_at__isnull=True), 'owner_id'
+        ),
+        'follower_count': count_subquery(
+            follow_model.objects.filter(followee_id=OuterRef('pk'), allowed=True), 'followee_id'
+        ),
+        'following_count': count_subquery(
+            follow_model.objects.filter(follower_id=OuterRef('pk'), allowed=True), 'follower_id'
+        ),
+        'post_count': count_subquery(post_model.objects.filter(author_id=OuterRef('pk')), 'author_id'),
+    }
+
+
+def reconcile_counters(model, expressions, chunk_size=1000):
+    """Recompute counter columns from `expressions` in pk ordered chunks, return the number of rows fixed."""
+    fields = list(expressions)
+    annotations = {f'actual_{field}': expression for field, expression in expressions.items()}
+    fixed, last_pk = 0, 0
+    while True:
+        rows = list(
+            model.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', *fields).annotate(**annotations)[:chunk_size]
+        )
+        if not rows:
+            return fixed
+        last_pk = rows[-1].pk
+
+        changed = []
+        for row in rows:
+            if any(getattr(row, field) != getattr(row, f'actual_{field}') for field in fields):
+                for field in fields:
+                    setattr(row, field, getattr(row, f'actual_{field}'))
+                changed.append(row)
+        model.objects.bulk_update(changed, fields)
+        fixed += len(changed)
+
+
+def adjust_follow_counters(follower_id, followee_id, delta=1):
+    """Counters of an allowed follow, changed when it is created (or approved) and deleted."""
+    adjust_counter(User, followee_id, 'follower_count', delta)
+    adjust_counter(User, follower_id, 'following_count', delta)
+
+
+def release_post_counters(author_ids):
+    """Decrease post counters by deleted posts, given by the author id of every deleted post."""
+    for author_id, count in Counter(author_ids).items():
+        adjust_counter(User, author_id, 'post_count', -count)
+
+
+def release_unread_notifications(notifications):
+    """
+    Decrease unread counters by the unread ones of `notifications`, before a deleted post,
+    comment or user removes them by cascade.
+    """
+    unread = notifications.filter(read_at__isnull=True).order_by().values_list('owner_id').annotate(Count('id'))
+    for owner_id, count in unread:
+        adjust_counter(User, owner_id, 'unread_notifications', -count)
+
+
+def deleted_user_notifications(user_ids):
+    """Notifications of other users removed by cascade with the users, their posts, comments and reposts."""
+    return Notification.objects.exclude(owner__in=user_ids).filter(
+        Q(related_user__in=user_ids) | Q(related_post__author__in=user_ids) | Q(related_post__repost__author__in=user_ids)
+        | Q(related_comment__author__in=user_ids) | Q(related_comment__post__author__in=user_ids)
+    )
+
+
+def reply_thread_ids(comment_id):
+    """Ids of a comment and all replies below it, the rows a delete of the comment cascades over."""
+    comment_ids, replies = [comment_id], [comment_id]
+    while replies:
+        replies = list(Comment.objects.filter(reply_id__in=replies).values_list('pk', flat=True))
+        comment_ids += replies
+    return comment_ids
+
+
+def recount_post_comments(post_id):
+    """Exact comment counter refresh, used when a delete cascades over an unknown number of replies."""
+    Post.objects.filter(pk=post_id).update(comment_count=post_comment_count())
@@ -0,0 +1,63 @@
+import hashlib
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+from config import metrics
+
+PUBLIC_SCOPE = 'public'
+
+
+def user_scope(user_id):
+    """Everything in the feeds of one viewer: followees, follows and own actions."""
+    return f'user:{user_id}'
+
+
+def author_scope(author_id):
+    """Posts of a pull author, merged into follower feeds at read time."""
+    return f'author:{author_id}'
+
+
+def tag_scope(tag_name):
+    return f'tag:{tag_name}'
+
+
+def _version_key(scope):
+    return f'feed:version:{scope}'
+
+
+def get_versions(scopes):
+    keys = {scope: _version_key(scope) for scope in scopes}
+    versions = cache.get_many(keys.values())
+    for scope, key in keys.items():
+        if key not in versions:
+            cache.add(key, uuid4().hex, timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[keys[scope]] for scope in sorted(scopes)]
+
+
+def bump_versions(scopes):
+    """Invalidate every cached page depending on the scopes, without scanning keys."""
+    scopes = list(scopes)
+    if scopes:
+        cache.set_many({_version_key(scope): uuid4().hex for scope in scopes}, timeout=None)
+
+
+def bump_user_feeds(*user_ids):
+    bump_versions(user_scope(user_id) for user_id in user_ids)
+
+
+def feed_cache_key(feed_name, viewer_id, scopes, url):
+    digest = hashlib.md5(f'{url}|{"|".join(get_versions(scopes))}'.encode('utf-8')).hexdigest()
+    return f'feed:page:{feed_name}:{viewer_id}:{digest}'
+
+
+def get_page(key):
+    data = cache.get(key)
+    metrics.incr(metrics.FEED_CACHE_MISSES if data is None else metrics.FEED_CACHE_HITS)
+    return data
+
+
+def set_page(key, data):
+    cache.set(key, data, timeout=settings.FEED_CACHE_TIMEOUT)
@@ -0,0 +1,19 @@
+from .models import Post
+
+
+def load_repost_chains(posts, max_depth):
+    """
+    Load originals of reposts and quotes in the given posts, following quote chains
+    up to `max_depth` levels. Each level is one query and every original is loaded once.
+    Returns {post_id: Post}.
+    """
+    originals = {}
+    pending = {post.repost_id for post in posts if post.repost_id}
+    for _ in range(max_depth):
+        pending -= originals.keys()
+        if not pending:
+            break
+        loaded = Post.objects.in_bulk(pending)
+        originals.update(loaded)
+        pending = {post.repost_id for post in loaded.values() if post.repost_id}
+    return originals
@@ -0,0 +1,75 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from pages.timelines import InMemoryTimelineStore, merge_timelines
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate write (fan-out) and read (merge) cost of the hybrid push/pull following feed '
+        'for a Zipf-skewed follower distribution and several follower limits. Uses the in-memory '
+        'timeline store only, no database access.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000, help='Number of readers')
+        parser.add_argument('--authors', type=int, default=500, help='Number of posting authors')
+        parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of follower counts')
+        parser.add_argument('--posts', type=int, default=3, help='Posts per author')
+        parser.add_argument('--reads', type=int, default=2000, help='Number of sampled feed reads')
+        parser.add_argument('--limits', type=float, nargs='+', default=[0, 100, 1000, 5000, float('inf')],
+                            help='Follower limits to compare, 0 is pull only and inf is push only')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        users, authors = options['users'], options['authors']
+
+        followers = {}
+        followees = {user_id: [] for user_id in range(users)}
+        for rank in range(authors):
+            author_id = users + rank
+            count = max(1, int(users / (rank + 1) ** options['skew']))
+            followers[author_id] = rng.sample(range(users), count)
+            for follower_id in followers[author_id]:
+                followees[follower_id].append(author_id)
+
+        posts = [(author_id, post_number) for post_number in range(options['posts']) for author_id in followers]
+        readers = rng.sample(range(users), min(options['reads'], users))
+        counts = sorted((len(ids) for ids in followers.values()), reverse=True)
+        self.stdout.write(
+            f'{users} users, {authors} authors, max/median followers {counts[0]}/{counts[len(counts) // 2]}, '
+            f'{len(posts)} posts, {len(readers)} reads'
+        )
+        self.stdout.write(f'{"limit":>8} {"pull":>6} {"writes":>10} {"write ms":>10} {"sources/read":>13} '
+                          f'{"read ms":>9} {"us/read":>8}')
+
+        for limit in options['limits']:
+            store = InMemoryTimelineStore()
+            pull_authors = {author_id for author_id, ids in followers.items() if len(ids) >= limit}
+
+            writes, started = 0, time.perf_counter()
+            for score, (author_id, _) in enumerate(posts):
+                post_id = score + 1
+                if author_id in pull_authors:
+                    store.push_author(author_id, post_id, score)
+                    writes += 1
+                else:
+                    store.push(followers[author_id], post_id, score)
+                    writes += len(followers[author_id])
+            write_ms = (time.perf_counter() - started) * 1000
+
+            sources, started = 0, time.perf_counter()
+            for user_id in readers:
+                pulled = [author_id for author_id in followees[user_id] if author_id in pull_authors]
+                timeline = store.range_with_scores(user_id)
+                merge_timelines([timeline, *store.author_ranges(pulled).values()], store.max_length)
+                sources += 1 + len(pulled)
+            read_ms = (time.perf_counter() - started) * 1000
+
+            self.stdout.write(
+                f'{limit:>8g} {len(pull_authors):>6} {writes:>10} {write_ms:>10.1f} '
+                f'{sources / len(readers):>13.2f} {read_ms:>9.1f} {read_ms * 1000 / len(readers):>8.1f}'
+            )
@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from config import celery_app
+from config.tasks import send_multiple_notifications, send_notification
+from config.types import NotificationType
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure throughput of send_multiple_notifications for several recipient counts, optionally '
+        'against the old per-recipient loop. Recipients and notifications are created inside a '
+        'transaction that is rolled back; messages go to the configured channel layer. Broadcast '
+        'shards run in process, one after another.'
+    )
+    username_prefix = 'bench-notify-'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--no-persist', action='store_true', help='Only send, do not store notifications')
+        parser.add_argument('--shard-size', type=int, help='Recipients per shard, NOTIFICATION_SHARD_SIZE by default')
+        parser.add_argument('--per-recipient-max', type=int, default=1000,
+                            help='Also time the per-recipient loop up to this many recipients')
+
+    def handle(self, *args, **options):
+        create_notification = not options['no_persist']
+        celery_app.conf.task_always_eager = True
+        self.stdout.write(f'{"recipients":>10} {"mode":>14} {"seconds":>9} {"per second":>11}')
+        for count in options['recipients']:
+            modes = [('bulk', self.send_bulk)]
+            if count <= options['per_recipient_max']:
+                modes.append(('per-recipient', self.send_per_recipient))
+            for mode, send in modes:
+                with transaction.atomic():
+                    self.create_recipients(count)
+                    started = time.perf_counter()
+                    send(create_notification, options['shard_size'])
+                    elapsed = time.perf_counter() - started
+                    transaction.set_rollback(True)
+                self.stdout.write(f'{count:>10} {mode:>14} {elapsed:>9.2f} {count / elapsed:>11.0f}')
+
+    def create_recipients(self, count):
+        User.objects.bulk_create(
+            (User(email=f'{self.username_prefix}{i}@example.com', username=f'{self.username_prefix}{i}',
+                  password='!') for i in range(count)),
+            batch_size=5000
+        )
+
+    def send_bulk(self, create_notification, shard_size):
+        send_multiple_notifications(
+            NotificationType.test(), create_notification=create_notification, shard_size=shard_size,
+            username__startswith=self.username_prefix
+        )
+
+    def send_per_recipient(self, create_notification, shard_size):
+        recipients = User.objects.filter(username__startswith=self.username_prefix)
+        for user in recipients:
+            send_notification(user.id, NotificationType.test(), create_notification=create_notification)
@@ -0,0 +1,89 @@
+import asyncio
+import statistics
+import time
+import tracemalloc
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config.consumers import NotificationsConsumer
+from config.tasks import notification_event
+from config.types import NotificationType
+
+
+class Command(BaseCommand):
+    help = (
+        'Open many concurrent notification sockets against the in-memory channel layer and measure '
+        'connect rate, memory per connection and group_send to receive latency. No database access. '
+        'The in-memory layer scans all channels and groups on every receive, so with thousands of '
+        'sockets its cleanup dominates the totals. Latency includes the NOTIFICATION_SOCKET_BATCH '
+        'flush interval.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=2000)
+        parser.add_argument('--batch', type=int, default=500, help='Sockets connected concurrently')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for one frame')
+
+    def handle(self, *args, **options):
+        # the benchmark always uses a fresh in-memory layer, whatever CHANNEL_LAYERS configures
+        channel_layers.backends['default'] = InMemoryChannelLayer(capacity=100)
+        try:
+            asyncio.run(self.run(options['connections'], options['batch'], options['timeout']))
+        finally:
+            channel_layers.backends.pop('default', None)
+
+    async def run(self, count, batch, timeout):
+        application = NotificationsConsumer.as_asgi()
+        tokens = [self.token(user_id) for user_id in range(1, count + 1)]
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        communicators, started = [], time.perf_counter()
+        for offset in range(0, count, batch):
+            opened = [
+                WebsocketCommunicator(application, f'ws/notifications/?token={token}')
+                for token in tokens[offset:offset + batch]
+            ]
+            results = await asyncio.gather(*(communicator.connect(timeout) for communicator in opened))
+            assert all(connected for connected, _ in results), 'a socket was rejected'
+            communicators.extend(opened)
+        connect_seconds = time.perf_counter() - started
+        per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / count
+        tracemalloc.stop()
+
+        layer = channel_layers['default']
+        event = notification_event(NotificationType.new_thread())
+
+        async def deliver(user_id, communicator):
+            sent = time.perf_counter()
+            await layer.group_send(str(user_id), dict(event))
+            await communicator.receive_from(timeout)
+            return time.perf_counter() - sent
+
+        started = time.perf_counter()
+        latencies = sorted(await asyncio.gather(
+            *(deliver(user_id, communicator) for user_id, communicator in enumerate(communicators, start=1))
+        ))
+        deliver_seconds = time.perf_counter() - started
+
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        leftover = sum(len(channels) for channels in layer.groups.values())
+
+        self.stdout.write(f'connections        {count}')
+        self.stdout.write(f'connect rate       {count / connect_seconds:.0f}/s ({connect_seconds:.2f}s)')
+        self.stdout.write(f'memory/connection  {per_connection / 1024:.1f} KiB (tracemalloc)')
+        self.stdout.write(f'delivery rate      {count / deliver_seconds:.0f}/s ({deliver_seconds:.2f}s)')
+        self.stdout.write(
+            f'latency ms         p50 {statistics.median(latencies) * 1000:.2f} '
+            f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.2f} max {latencies[-1] * 1000:.2f}'
+        )
+        self.stdout.write(f'group members left {leftover}')
+
+    @staticmethod
+    def token(user_id):
+        token = AccessToken()
+        token['user_id'] = user_id
+        return str(token)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from pages.counters import (post_counter_expressions, comment_counter_expressions, user_counter_expressions,
+                            reconcile_counters)
+from pages.models import Post, Comment
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute denormalized engagement counters of posts and comments and unread notification, '
+        'follower, following and post counters of users in chunks to fix drift.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of rows recomputed per query')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        for model, expressions in (
+            (Post, post_counter_expressions()),
+            (Comment, comment_counter_expressions()),
+            (User, user_counter_expressions()),
+        ):
+            fixed = reconcile_counters(model, expressions, chunk_size)
+            self.stdout.write(f'{model.__name__}: {fixed} rows fixed')
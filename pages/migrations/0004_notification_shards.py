@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0003_post_rank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationBroadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notification_data', models.JSONField()),
+                ('filters', models.JSONField(default=dict)),
+                ('create_notification', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NotificationShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_id', models.PositiveBigIntegerField()),
+                ('end_id', models.PositiveBigIntegerField()),
+                ('last_recipient_id', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='pages.notificationbroadcast')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+
+def templates_from_text(apps, schema_editor):
+    """Keep the template of notification variants that share a type, the rest render from the type."""
+    Notification = apps.get_model('pages', 'Notification')
+    variants = [
+        ({'type': 'new_repost', 'text__contains': 'quoted'}, 'new_quote'),
+        ({'type': 'new_like', 'text__contains': 'your comment'}, 'new_comment_like'),
+        ({'type': 'new_mention', 'text__contains': 'in a comment'}, 'new_comment_mention'),
+    ]
+    for filters, template in variants:
+        Notification.objects.filter(**filters).update(payload={'template': template})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0005_notification_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='payload',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(templates_from_text, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='notification',
+            name='text',
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:11
+
+from django.db import migrations, models
+
+
+def mark_history_read(apps, schema_editor):
+    """Notifications from before read state existed start as read, so unread counters start at zero."""
+    Notification = apps.get_model('pages', 'Notification')
+    Notification.objects.filter(read_at__isnull=True).update(read_at=models.F('date_posted'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0006_notification_payload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_history_read, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['owner', '-date_posted', '-id'], name='pages_notif_owner_i_7d306f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['owner', 'type', '-date_posted', '-id'], name='pages_notif_owner_i_24e891_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('read_at__isnull', True)), fields=['owner', 'id'], name='notification_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,71 @@
+from datetime import datetime, timezone
+
+from django.db import migrations
+
+TABLE = 'pages_notification'
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def partition_notifications(apps, schema_editor):
+    """
+    Turn the notification table into a table range partitioned by month of date_posted.
+    PostgreSQL only, other databases keep the plain table and expire rows by deleting them.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT IN '
+            '(SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)',
+            [TABLE, TABLE]
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype IN ('f', 'c')",
+            [TABLE]
+        )
+        constraints = cursor.fetchall()
+        cursor.execute(f'SELECT min(date_posted), max(id) FROM {TABLE}')
+        first_posted, last_id = cursor.fetchone()
+
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_old')
+        cursor.execute(f'CREATE TABLE {TABLE} (LIKE {TABLE}_old INCLUDING DEFAULTS) PARTITION BY RANGE (date_posted)')
+        # the primary key of a partitioned table has to contain the partition key
+        cursor.execute(f'ALTER TABLE {TABLE} ADD PRIMARY KEY (id, date_posted)')
+        cursor.execute(f'CREATE SEQUENCE {TABLE}_part_id_seq OWNED BY {TABLE}.id')
+        cursor.execute(f"SELECT setval('{TABLE}_part_id_seq', %s, false)", [(last_id or 0) + 1])
+        cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_part_id_seq')")
+        for name, definition in constraints:
+            cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}')
+
+        now = datetime.now(timezone.utc)
+        month = (first_posted or now).astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        last_month = add_months(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0), 2)
+        while month <= last_month:
+            cursor.execute(
+                f'CREATE TABLE {TABLE}_p{month:%Y%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)',
+                [month, add_months(month, 1)]
+            )
+            month = add_months(month, 1)
+        cursor.execute(f'CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT')
+
+        cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_old')
+        cursor.execute(f'DROP TABLE {TABLE}_old')
+        for name, definition in indexes:
+            cursor.execute(definition)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0007_notification_inbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_notifications, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0008_partition_notifications'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['owner', 'id'], name='pages_notif_owner_i_d2015e_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pages', '0009_notification_owner_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('notification_id', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('actors', models.JSONField(default=list)),
+                ('opened_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='notificationgroup',
+            constraint=models.UniqueConstraint(fields=('owner', 'key'), name='unique_notification_group'),
+        ),
+    ]
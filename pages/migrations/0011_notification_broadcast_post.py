@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0010_notification_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationbroadcast',
+            name='post',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='pages.post'),
+        ),
+    ]
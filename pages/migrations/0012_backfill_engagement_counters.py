@@ -0,0 +1,21 @@
+from django.db import migrations
+
+from pages.counters import comment_counter_expressions, post_counter_expressions, reconcile_counters
+
+
+def backfill_counters(apps, schema_editor):
+    """Counters added in 0002 start at zero, fill them from the like, comment and repost rows."""
+    Post, Comment = apps.get_model('pages', 'Post'), apps.get_model('pages', 'Comment')
+    reconcile_counters(Post, post_counter_expressions(Post, Comment))
+    reconcile_counters(Comment, comment_counter_expressions(Comment))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0011_notification_broadcast_post'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def create_partitions(apps, schema_editor):
+    """Partitions for the months ahead, rows of those months already in the default partition move in."""
+    from pages import retention
+
+    if retention.is_partitioned():
+        retention.ensure_partitions(timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0012_backfill_engagement_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_partitions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pages', '0013_notification_partitions_ahead'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='notificationgroup',
+            name='actors',
+        ),
+        migrations.CreateModel(
+            name='NotificationGroupActor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('actor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='actors', to='pages.notificationgroup')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', '-id'], name='pages_notif_group_i_f1965c_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='notificationgroupactor',
+            constraint=models.UniqueConstraint(fields=('group', 'actor'), name='unique_notification_group_actor'),
+        ),
+    ]
@@ -1,6 +1,8 @@
 import re
 
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 from users.models import User
 
@@ -23,6 +25,10 @@ class Post(models.Model):
     mentioned_users = models.ManyToManyField(User, related_name='mentioned_in_posts', blank=True)
     hash_tag = models.ManyToManyField("HashTag", related_name='hash_tag_in_posts', blank=True)
     likes = models.ManyToManyField(User, related_name='liked_post', blank=True)
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+    repost_count = models.PositiveIntegerField(default=0)
+    quote_count = models.PositiveIntegerField(default=0)
 
     def total_likes(self):
         return self.likes.count()
@@ -33,6 +39,9 @@ class Post(models.Model):
     def total_comments(self):
         return Comment.objects.filter(post=self).count()
 
+    def is_quote(self):
+        return self.repost_id is not None and bool(self.text)
+
     def add_hashtags(self, tag_list: list):
         for tag_name in tag_list:
             hashtag, created = HashTag.objects.get_or_create(tag_name=tag_name)
@@ -50,6 +59,13 @@ class Post(models.Model):
             self.add_hashtags(hash_tag_list)
 
 
+class PostRank(models.Model):
+    """Candidate pool of the For You feed, refilled by the ranking task."""
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, primary_key=True, related_name='rank')
+    score = models.FloatField(db_index=True)
+    ranked_at = models.DateTimeField()
+
+
 class Comment(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
@@ -57,6 +73,7 @@ class Comment(models.Model):
     date_posted = models.DateTimeField(auto_now_add=True)
     reply = models.ForeignKey("self", on_delete=models.CASCADE, blank=True, null=True)
     likes = models.ManyToManyField(User, related_name='liked_comment', blank=True)
+    like_count = models.PositiveIntegerField(default=0)
 
     def total_likes(self):
         return self.likes.count()
@@ -69,6 +86,16 @@ class HashTag(models.Model):
     tag_name = models.CharField(max_length=255, unique=True)
 
 
+class NotificationQuerySet(models.QuerySet):
+    def recent(self):
+        """Notifications within the retention period, lets partitioned tables skip old partitions."""
+        return self.filter(date_posted__gte=timezone.now() - settings.NOTIFICATION_RETENTION)
+
+    def missed(self, owner_id, after_id):
+        """Notifications of the owner created after `after_id`, oldest first, a range scan of (owner, id)."""
+        return self.recent().filter(owner_id=owner_id, id__gt=after_id).order_by('id')
+
+
 class Notification(models.Model):
     types = [
         ("test", "test"),
@@ -88,9 +115,95 @@ class Notification(models.Model):
         ("new_mention", "new_mention"),
     ]
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
-    text = models.CharField(max_length=1024)
     type = models.CharField(max_length=20, choices=types)
+    # rendering details that type and related ids don't cover, e.g. {"template": "new_quote"}
+    payload = models.JSONField(default=dict, blank=True)
     related_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='related_user', blank=True, null=True)
     related_post = models.ForeignKey(Post, on_delete=models.CASCADE, blank=True, null=True)
     related_comment = models.ForeignKey(Comment, on_delete=models.CASCADE, blank=True, null=True)
     date_posted = models.DateTimeField(auto_now_add=True)
+    # coalesced notifications: number of actors and ids of the latest few of them, newest first
+    actor_count = models.PositiveIntegerField(default=1)
+    sample_actors = models.JSONField(default=list, blank=True)
+    read_at = models.DateTimeField(blank=True, null=True)
+
+    objects = NotificationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', '-date_posted', '-id']),
+            models.Index(fields=['owner', 'id']),
+            models.Index(fields=['owner', 'type', '-date_posted', '-id']),
+            models.Index(fields=['owner', 'type', 'related_post', '-date_posted']),
+            models.Index(fields=['owner', 'id'], condition=models.Q(read_at__isnull=True),
+                         name='notification_unread_idx'),
+        ]
+
+    @property
+    def template(self):
+        return self.payload.get('template', self.type)
+
+
+class NotificationGroup(models.Model):
+    """
+    Open coalescing window of one (owner, type, related_post) group and its aggregated
+    notification. The row and its actors are removed when the window is flushed.
+    """
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    # notifications are partitioned by date_posted, a foreign key can't point at their id alone
+    notification_id = models.PositiveBigIntegerField(blank=True, null=True)
+    opened_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'key'], name='unique_notification_group'),
+        ]
+
+
+class NotificationGroupActor(models.Model):
+    """An actor counted in a coalescing window, the unique row makes a repeated event a no-op."""
+    group = models.ForeignKey(NotificationGroup, on_delete=models.CASCADE, related_name='actors')
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'actor'], name='unique_notification_group_actor'),
+        ]
+        indexes = [
+            # the newest actors of a group are its sample
+            models.Index(fields=['group', '-id']),
+        ]
+
+
+class NotificationBroadcast(models.Model):
+    """
+    One notification sent to every user matching `filters`, delivered by id range shards.
+    Broadcasts of a `post` announce it to live feed sockets and send the notification to others.
+    """
+    notification_data = models.JSONField()
+    filters = models.JSONField(default=dict)
+    create_notification = models.BooleanField(default=True)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class NotificationShard(models.Model):
+    """
+    Recipients of a broadcast with ids in [start_id, end_id]. `last_recipient_id` is the
+    checkpoint of the delivered prefix, a retried shard continues after it.
+    """
+    broadcast = models.ForeignKey(NotificationBroadcast, on_delete=models.CASCADE, related_name='shards')
+    start_id = models.PositiveBigIntegerField()
+    end_id = models.PositiveBigIntegerField()
+    last_recipient_id = models.PositiveBigIntegerField(blank=True, null=True)
+    sent = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def duration(self):
+        if self.started_at and self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+        return None
@@ -1,5 +1,6 @@
 from rest_framework.permissions import BasePermission
 
+from users.graph import get_social_graph
 from .models import Post, Comment
 
 
@@ -22,9 +23,9 @@ def permission_comment(post, user):
     if post.comments_permission == 'anyone':
         return True
     elif post.comments_permission == 'your followers':
-        return post.author.follower.filter(followee=user).exists()
+        return get_social_graph().has_follow(post.author_id, user.id)
     elif post.comments_permission == 'profiles you follow':
-        return post.author.followee.filter(follower=user).exists()
+        return get_social_graph().has_follow(user.id, post.author_id)
     elif post.comments_permission == 'mentioned only':
         return post.mentioned_users.filter(id=user.id).exists()
     return False
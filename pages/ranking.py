@@ -0,0 +1,50 @@
+import heapq
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Post, PostRank
+
+# whether the candidate pool is filled, set by every ranking run
+RANKED_KEY = 'for_you:ranked'
+
+
+def engagement_score(post, now, options):
+    """Weighted engagement decayed by post age: (1 + engagement) / (age_hours + 2) ** gravity."""
+    weights = options['WEIGHTS']
+    engagement = (
+        post['like_count'] * weights['likes']
+        + post['comment_count'] * weights['comments']
+        + (post['repost_count'] + post['quote_count']) * weights['reposts']
+    )
+    age_hours = (now - post['date_posted']).total_seconds() / 3600
+    return (1 + engagement) / (age_hours + 2) ** options['GRAVITY']
+
+
+def rank_for_you_candidates():
+    """Score recent public posts and replace the For You candidate pool with the best of them."""
+    options = settings.FOR_YOU_RANKING
+    now = timezone.now()
+    posts = Post.objects.filter(
+        date_posted__gte=now - options['WINDOW'], author__is_private=False
+    ).values('pk', 'date_posted', 'like_count', 'comment_count', 'repost_count', 'quote_count')
+
+    scored = ((engagement_score(post, now, options), post['pk']) for post in posts.iterator(chunk_size=2000))
+    best = heapq.nlargest(options['POOL_SIZE'], scored)
+
+    with transaction.atomic():
+        PostRank.objects.all().delete()
+        PostRank.objects.bulk_create(PostRank(post_id=post_id, score=score, ranked_at=now) for score, post_id in best)
+    cache.set(RANKED_KEY, bool(best), None)
+    return len(best)
+
+
+def is_ranked():
+    """Whether the For You candidate pool has posts, read from the database once per cache."""
+    ranked = cache.get(RANKED_KEY)
+    if ranked is None:
+        ranked = PostRank.objects.exists()
+        cache.set(RANKED_KEY, ranked, None)
+    return ranked
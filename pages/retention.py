@@ -0,0 +1,196 @@
+import gzip
+import json
+import os
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+
+from users.models import User
+from .counters import adjust_counter
+from .models import Notification, NotificationBroadcast
+
+TABLE = Notification._meta.db_table
+# rows of months without a partition, see ensure_partitions
+DEFAULT_PARTITION = f'{TABLE}_default'
+EXPIRE_CHUNK_SIZE = 5000
+# monthly partitions are created this many months ahead of the current one
+PARTITIONS_AHEAD = 3
+
+
+def month_start(value):
+    return value.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def is_partitioned():
+    """True when the notification table is range partitioned by month (PostgreSQL only)."""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass)', [TABLE])
+        return cursor.fetchone()[0]
+
+
+def ensure_partitions(now, months_ahead=PARTITIONS_AHEAD):
+    """
+    Create monthly partitions from the current month up to `months_ahead` months ahead.
+    PostgreSQL refuses a partition for a range the default partition holds rows of, so such
+    rows are moved into the new table before it is attached.
+    """
+    first = month_start(now)
+    existing = {name for name, _ in monthly_partitions()}
+    for offset in range(months_ahead + 1):
+        month = add_months(first, offset)
+        name = partition_name(month)
+        if name in existing:
+            continue
+        bounds = [month, add_months(month, 1)]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE date_posted >= %s AND date_posted < %s '
+                f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+                bounds
+            )
+            cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', bounds)
+
+
+def monthly_partitions():
+    """Return [(partition table name, month start)] of existing monthly partitions, oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = %s::regclass',
+            [TABLE]
+        )
+        names = sorted(name for name, in cursor.fetchall())
+    prefix = f'{TABLE}_p'
+    return [
+        (name, datetime.strptime(name[len(prefix):], '%Y%m').replace(tzinfo=dt_timezone.utc))
+        for name in names if name.startswith(prefix)
+    ]
+
+
+def archive_path(month):
+    return os.path.join(settings.NOTIFICATION_ARCHIVE_DIR, f'notifications-{month:%Y-%m}.ndjson.gz')
+
+
+def archive_rows(month, rows):
+    """Append rows (dicts) to the gzip compressed NDJSON archive of their month."""
+    if not settings.NOTIFICATION_ARCHIVE_DIR:
+        return
+    os.makedirs(settings.NOTIFICATION_ARCHIVE_DIR, exist_ok=True)
+    with gzip.open(archive_path(month), 'at', encoding='utf-8') as archive:
+        for row in rows:
+            archive.write(json.dumps(row, cls=DjangoJSONEncoder, separators=(',', ':')) + '\n')
+
+
+def release_unread(rows):
+    """Keep unread counters in step with expired unread notifications."""
+    unread = Counter(row['owner_id'] for row in rows if row['read_at'] is None)
+    for owner_id, count in unread.items():
+        adjust_counter(User, owner_id, 'unread_notifications', -count)
+
+
+def expire_notifications(now=None):
+    """
+    Archive and remove notifications older than `NOTIFICATION_RETENTION`. Partitioned tables
+    archive and drop whole monthly partitions, other databases archive and delete rows in chunks.
+    Returns the number of expired notifications.
+    """
+    now = now or timezone.now()
+    cutoff = now - settings.NOTIFICATION_RETENTION
+    if is_partitioned():
+        return expire_partitions(now, cutoff)
+    return expire_rows(cutoff)
+
+
+def expire_partitions(now, cutoff):
+    ensure_partitions(now)
+    expired = expire_default_rows(cutoff)
+    for name, month in monthly_partitions():
+        if add_months(month, 1) > cutoff:
+            break
+        if settings.NOTIFICATION_ARCHIVE_DIR and os.path.exists(archive_path(month)):
+            # left over from an interrupted run, the partition is archived again as a whole
+            os.remove(archive_path(month))
+        with transaction.atomic():
+            with connection.chunked_cursor() as cursor:
+                cursor.execute(f'SELECT * FROM {name}')
+                while True:
+                    chunk = cursor.fetchmany(EXPIRE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    columns = [column[0] for column in cursor.description]
+                    rows = [dict(zip(columns, values)) for values in chunk]
+                    archive_rows(month, rows)
+                    release_unread(rows)
+                    expired += len(rows)
+            with connection.cursor() as cursor:
+                cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+                cursor.execute(f'DROP TABLE {name}')
+    return expired
+
+
+def archive_by_month(rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(month_start(row['date_posted']), []).append(row)
+    for month, month_rows in by_month.items():
+        archive_rows(month, month_rows)
+
+
+def expire_default_rows(cutoff):
+    """Archive and delete expired rows of months that never had a partition, in chunks."""
+    expired = 0
+    while True:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {DEFAULT_PARTITION} WHERE ctid IN (SELECT ctid FROM {DEFAULT_PARTITION} '
+                    f'WHERE date_posted < %s LIMIT %s) RETURNING *',
+                    [cutoff, EXPIRE_CHUNK_SIZE]
+                )
+                columns = [column[0] for column in cursor.description]
+                rows = [dict(zip(columns, values)) for values in cursor.fetchall()]
+            if not rows:
+                return expired
+            archive_by_month(rows)
+            release_unread(rows)
+        expired += len(rows)
+
+
+def expire_rows(cutoff):
+    expired = 0
+    while True:
+        rows = list(Notification.objects.filter(date_posted__lt=cutoff).order_by('pk').values()[:EXPIRE_CHUNK_SIZE])
+        if not rows:
+            return expired
+        with transaction.atomic():
+            archive_by_month(rows)
+            release_unread(rows)
+            Notification.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+        expired += len(rows)
+
+
+def expire_broadcasts(now=None):
+    """
+    Remove broadcasts started before `NOTIFICATION_BROADCAST_RETENTION` with their shards,
+    their deliveries are finished or given up by then. Returns the number of broadcasts.
+    """
+    cutoff = (now or timezone.now()) - settings.NOTIFICATION_BROADCAST_RETENTION
+    _, deleted = NotificationBroadcast.objects.filter(created_at__lt=cutoff).delete()
+    return deleted.get(NotificationBroadcast._meta.label, 0)
@@ -1,35 +1,113 @@
+from django.conf import settings
 from rest_framework import serializers
 from rest_framework.fields import SerializerMethodField
 
-from users.models import User, Follow
+from config.types import NotificationType
+from users.models import User
+from users.relationships import RelationshipsMixin
 from .models import Post, Comment, HashTag, Notification
+from .hydration import load_repost_chains
+from .viewer import ViewerState
+
+
+class PageListSerializer(serializers.ListSerializer):
+    """
+    Lets the child serializer load everything the page needs at once (`prepare_page`)
+    and share it with the rows through the serializer context.
+    """
+
+    def to_representation(self, data):
+        items = list(data.all() if hasattr(data, 'all') else data)
+        self.child.prepare_page(items)
+        return super().to_representation(items)
+
+
+class ViewerStateMixin:
+    viewer_state_loader = None
+
+    def prepare_page(self, instances):
+        request = self.context.get('request')
+        if request is not None:
+            self.context['viewer_state'] = self.resolve_viewer_state(request.user, instances)
+
+    @classmethod
+    def resolve_viewer_state(cls, user, instances):
+        return cls.viewer_state_loader(user, [instance.pk for instance in instances])
+
+    def get_viewer_state(self, obj):
+        state = self.context.get('viewer_state')
+        if state is None or not state.covers(obj.pk):
+            state = self.resolve_viewer_state(self.context['request'].user, [obj])
+            self.context['viewer_state'] = state
+        return state
 
 
 class RepostViewSerializer(serializers.ModelSerializer):
+    """
+    Original of a repost or quote. Every original is serialized once per response and
+    shared by all reposts of it; quote chains are expanded up to `REPOST_CHAIN_DEPTH`
+    levels from originals loaded by `PostViewSerializer.prepare_page`, deeper ones stay ids.
+    """
+
+    def to_representation(self, instance):
+        return self.represent(instance, depth=1)
+
+    def represent(self, instance, depth):
+        hydrated = self.context.setdefault('hydrated_reposts', {})
+        key = (instance.pk, depth)
+        if key not in hydrated:
+            data = super().to_representation(instance)
+            original = self.context.get('repost_originals', {}).get(instance.repost_id)
+            if original is not None and depth < settings.REPOST_CHAIN_DEPTH:
+                data['repost'] = self.represent(original, depth + 1)
+            hydrated[key] = data
+        return hydrated[key]
+
     class Meta:
         model = Post
         fields = ['id', 'author', 'text', 'image', 'video', 'repost', 'date_posted']
 
 
-class PostViewSerializer(serializers.ModelSerializer):
+class PostViewSerializer(ViewerStateMixin, serializers.ModelSerializer):
+    viewer_state_loader = ViewerState.for_posts
+
     repost = RepostViewSerializer()
-    total_likes = SerializerMethodField()
+    total_likes = serializers.IntegerField(source='like_count', read_only=True)
     user_like = SerializerMethodField()
-    total_comments = SerializerMethodField()
-
-    def get_total_likes(self, obj):
-        return obj.total_likes()
+    user_repost = SerializerMethodField()
+    user_comment = SerializerMethodField()
+    total_comments = serializers.IntegerField(source='comment_count', read_only=True)
+    total_reposts = serializers.IntegerField(source='repost_count', read_only=True)
+    total_quotes = serializers.IntegerField(source='quote_count', read_only=True)
+
+    def prepare_page(self, instances):
+        super().prepare_page(instances)
+        originals = load_repost_chains(instances, settings.REPOST_CHAIN_DEPTH)
+        for instance in instances:
+            if instance.repost_id in originals:
+                instance.repost = originals[instance.repost_id]
+        self.context['repost_originals'] = originals
+
+    def to_representation(self, instance):
+        if 'repost_originals' not in self.context:
+            self.prepare_page([instance])
+        return super().to_representation(instance)
 
     def get_user_like(self, obj):
-        return obj.user_like(self.context['request'].user)
+        return obj.pk in self.get_viewer_state(obj).liked
+
+    def get_user_repost(self, obj):
+        return obj.pk in self.get_viewer_state(obj).reposted
 
-    def total_comments(self, obj):
-        return obj.total_comments()
+    def get_user_comment(self, obj):
+        return obj.pk in self.get_viewer_state(obj).commented
 
     class Meta:
         model = Post
         fields = ['id', 'author', 'text', 'date_posted', 'image', 'video', 'repost', 'comments_permission',
-                  'total_comments', 'total_likes', 'user_like']
+                  'total_comments', 'total_likes', 'total_reposts', 'total_quotes',
+                  'user_like', 'user_repost', 'user_comment']
+        list_serializer_class = PageListSerializer
 
 
 class PostCreateSerializer(serializers.ModelSerializer):
@@ -63,20 +141,20 @@ class ReplyViewSerializer(serializers.ModelSerializer):
         fields = ['id', 'author', 'text', 'date_posted']
 
 
-class CommentViewSerializer(serializers.ModelSerializer):
+class CommentViewSerializer(ViewerStateMixin, serializers.ModelSerializer):
+    viewer_state_loader = ViewerState.for_comments
+
     reply = ReplyViewSerializer()
-    total_likes = SerializerMethodField()
+    total_likes = serializers.IntegerField(source='like_count', read_only=True)
     user_like = SerializerMethodField()
 
-    def get_total_likes(self, obj):
-        return obj.total_likes()
-
     def get_user_like(self, obj):
-        return obj.user_like(self.context['request'].user)
+        return obj.pk in self.get_viewer_state(obj).liked
 
     class Meta:
         model = Comment
         fields = ['id', 'post', 'author', 'text', 'date_posted', 'reply', 'total_likes', 'user_like']
+        list_serializer_class = PageListSerializer
 
 
 class CommentCreateSerializer(serializers.ModelSerializer):
@@ -97,24 +175,13 @@ class ReplyCreateSerializer(serializers.ModelSerializer):
         fields = ['post', 'author', 'text', 'reply']
 
 
-class UserSearchSerializer(serializers.ModelSerializer):
+class UserSearchSerializer(RelationshipsMixin, serializers.ModelSerializer):
     is_followed = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ['pk', 'username', 'is_followed']
-
-    def get_is_followed(self, obj):
-        user_id = self.context['request'].user.id
-        followee_id = obj.id
-
-        if user_id == followee_id:
-            return "You"
-        try:
-            follow = Follow.objects.get(followee_id=followee_id, follower_id=user_id)
-        except Follow.DoesNotExist:
-            return "Not Followed"
-        return "Followed" if follow.allowed else "Pending"
+        list_serializer_class = PageListSerializer
 
 
 class HashTagSearchSerializer(serializers.ModelSerializer):
@@ -129,6 +196,22 @@ class HashTagSearchSerializer(serializers.ModelSerializer):
 
 
 class NotificationSerializer(serializers.ModelSerializer):
+    """Notifications are stored as type and related ids, the text is rendered with current usernames."""
+    text = SerializerMethodField()
+
+    def prepare_page(self, instances):
+        user_ids = {instance.related_user_id for instance in instances if instance.related_user_id}
+        self.context['usernames'] = dict(User.objects.filter(pk__in=user_ids).values_list('pk', 'username'))
+
+    def get_text(self, obj):
+        usernames = self.context.get('usernames', {})
+        if obj.related_user_id and obj.related_user_id not in usernames:
+            self.prepare_page([obj])
+            usernames = self.context['usernames']
+        return NotificationType.render(obj.template, usernames.get(obj.related_user_id), obj.actor_count)
+
     class Meta:
         model = Notification
-        fields = ["pk", "owner", "text", "related_user", "related_post", "related_comment", "date_posted"]
+        fields = ["pk", "owner", "type", "text", "related_user", "related_post", "related_comment", "actor_count",
+                  "sample_actors", "date_posted", "read_at"]
+        list_serializer_class = PageListSerializer
@@ -1,3 +1,790 @@
+import asyncio
+import gzip
+import json
+from datetime import timedelta
+from io import StringIO
+
+import pytest
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config import metrics, presence
+from config.consumers import NotificationsConsumer
+from config.tasks import expire_notifications, flush_coalesced_notification, notification_event, post_counters_changed, push_new_post, send_notification, rank_for_you_feed, send_multiple_notifications, send_notification_shard
+from config.types import NotificationType
+from pages import retention
+from pages.counters import set_like
+from pages.feed_cache import bump_user_feeds
+from pages.models import Post, Comment, Notification, NotificationBroadcast, NotificationGroup, NotificationShard
+from pages.timelines import InMemoryTimelineStore, get_timeline_store
+from users.admin import CustomUserAdmin
+from users.graph import get_social_graph
+from users.models import User, Follow
+
+
 def test_examole():
     a = 1
     assert a is a
+
+
+@pytest.fixture(autouse=True)
+def timeline_store():
+    cache.clear()
+    get_timeline_store.cache_clear()
+    get_social_graph.cache_clear()
+    yield get_timeline_store()
+    get_timeline_store.cache_clear()
+    get_social_graph.cache_clear()
+
+
+def make_user(username, **extra_fields):
+    return User.objects.create_user(
+        f'{username}@example.com', username, 'Password1!', is_email_verify=True, **extra_fields
+    )
+
+
+def client_for(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+def feed_ids(client):
+    response = client.get(reverse('following_feed'))
+    assert response.status_code == 200
+    return [post['id'] for post in response.data['results']]
+
+
+def test_timeline_store_is_capped_and_ordered():
+    store = InMemoryTimelineStore(max_length=3)
+    store.replace(1, [])
+    store.replace(2, [(9, 0.5)])
+    for post_id in range(1, 6):
+        store.push([1, 2, 3], post_id, float(post_id))
+    store.remove([2], [5])
+
+    assert store.range(1) == [5, 4, 3]
+    assert store.range(2) == [4, 3]
+    # pushes do not create partial timelines
+    assert not store.exists(3)
+
+
+@pytest.mark.django_db
+def test_timeline_is_built_from_database_when_missing(timeline_store):
+    reader, author, loner = make_user('reader'), make_user('author'), make_user('loner')
+    old_posts = [Post.objects.create(author=author, text=str(i), comments_permission='anyone') for i in range(2)]
+    Follow.objects.create(follower=reader, followee=author, allowed=True)
+    client_for(author).post('/post/', {'text': 'new', 'comments_permission': 'anyone'})
+    new_post = Post.objects.get(text='new')
+
+    assert feed_ids(client_for(reader)) == [new_post.id, old_posts[1].id, old_posts[0].id]
+    # a user without followees gets an empty timeline, not a rebuild per read
+    assert feed_ids(client_for(loner)) == []
+    assert timeline_store.exists(loner.id)
+
+
+@pytest.mark.django_db
+def test_following_feed_is_fanned_out_and_purged():
+    reader, author = make_user('reader'), make_user('author')
+    old_post = Post.objects.create(author=author, text='old', comments_permission='anyone')
+    reader_client, author_client = client_for(reader), client_for(author)
+
+    reader_client.post(reverse('follow_followee_action'), {'followee': author.id})
+    assert feed_ids(reader_client) == [old_post.id]
+
+    author_client.post('/post/', {'text': 'new', 'comments_permission': 'anyone'})
+    new_post = Post.objects.get(text='new')
+    assert feed_ids(reader_client) == [new_post.id, old_post.id]
+
+    author_client.delete(f'/post/{new_post.id}/')
+    assert feed_ids(reader_client) == [old_post.id]
+
+    reader_client.post(reverse('unfollow_followee_action'), {'followee': author.id})
+    assert feed_ids(reader_client) == []
+
+
+@pytest.mark.django_db
+def test_cursor_pagination_walks_feed_without_count():
+    author = make_user('author')
+    client = client_for(author)
+    posts = [Post.objects.create(author=author, text=str(i), comments_permission='anyone') for i in range(5)]
+
+    response = client.get('/post/', {'cursor': '', 'page_size': 2})
+    seen = [post['id'] for post in response.data['results']]
+    assert 'count' not in response.data
+    assert response.data['links']['previous'] is None
+    while response.data['links']['next']:
+        response = client.get(response.data['links']['next'])
+        seen += [post['id'] for post in response.data['results']]
+
+    assert seen == [post.id for post in reversed(posts)]
+    previous_page = client.get(response.data['links']['previous'])
+    assert [post['id'] for post in previous_page.data['results']] == [posts[2].id, posts[1].id]
+
+
+@pytest.mark.django_db
+def test_engagement_counters_are_maintained_and_reconciled():
+    author, fan = make_user('author'), make_user('fan')
+    post = Post.objects.create(author=author, text='thread', comments_permission='anyone')
+    client = client_for(fan)
+
+    client.patch(reverse('post_like_unlike', args=[post.id]))
+    client.post(reverse('comment-list-create', args=[post.id]), {'text': 'nice'}, format='json')
+    client.post(reverse('repost_create', args=[post.id]), {}, format='json')
+    client.post(reverse('quote_create', args=[post.id]), {'text': 'look'}, format='json')
+
+    data = client.get(reverse('post-detail', args=[post.id])).data
+    assert (data['total_likes'], data['total_comments'], data['total_reposts'], data['total_quotes']) == (1, 1, 1, 1)
+
+    Post.objects.filter(pk=post.pk).update(like_count=7, comment_count=0, repost_count=3, quote_count=0)
+    call_command('reconcile_counters', chunk_size=1, stdout=StringIO())
+    post.refresh_from_db()
+    assert (post.like_count, post.comment_count, post.repost_count, post.quote_count) == (1, 1, 1, 1)
+
+    # a like inserted by a concurrent request is not counted again, nor a missing one removed
+    assert not set_like(Post, post.id, fan.id, True)
+    assert set_like(Post, post.id, fan.id, False)
+    assert not set_like(Post, post.id, fan.id, False)
+    post.refresh_from_db()
+    assert post.like_count == 0
+
+
+def count_page_queries(client, url):
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url)
+    assert response.status_code == 200
+    return len(queries), response.data['results']
+
+
+@pytest.mark.django_db
+def test_viewer_state_takes_constant_queries_per_page():
+    author, viewer = make_user('author'), make_user('viewer')
+    client = client_for(viewer)
+    client.post(reverse('follow_followee_action'), {'followee': author.id})
+    post = Post.objects.create(author=author, text='first', comments_permission='anyone')
+    comment = Comment.objects.create(author=author, post=post, text='first')
+    post.likes.add(viewer)
+    comment.likes.add(viewer)
+    Comment.objects.create(author=viewer, post=post, text='mine')
+
+    feed_url, comments_url = reverse('following_feed'), reverse('comment-list-create', args=[post.id])
+    small_feed_queries, _ = count_page_queries(client, feed_url)
+    small_comments_queries, _ = count_page_queries(client, comments_url)
+
+    for i in range(8):
+        Post.objects.create(author=author, text=str(i), comments_permission='anyone').likes.add(viewer)
+        Comment.objects.create(author=author, post=post, text=str(i), reply=comment)
+    get_timeline_store().clear(viewer.id)
+    bump_user_feeds(viewer.id)
+
+    feed_queries, posts = count_page_queries(client, feed_url)
+    comments_queries, comments = count_page_queries(client, comments_url)
+    assert feed_queries == small_feed_queries
+    assert comments_queries == small_comments_queries
+    assert all(item['user_like'] for item in posts)
+    assert [item['user_comment'] for item in posts if item['id'] == post.id] == [True]
+    assert {item['id'] for item in comments if item['user_like']} == {comment.id}
+
+
+@pytest.mark.django_db
+def test_for_you_feed_is_ranked_from_candidate_pool():
+    viewer, followee, stranger = make_user('viewer'), make_user('followee'), make_user('stranger')
+    hidden = make_user('hidden', is_private=True)
+    client = client_for(viewer)
+    client.post(reverse('follow_followee_action'), {'followee': followee.id})
+
+    quiet = Post.objects.create(author=stranger, text='quiet', comments_permission='anyone')
+    viral = Post.objects.create(author=stranger, text='viral', comments_permission='anyone')
+    Post.objects.filter(pk=quiet.pk).update(like_count=50, comment_count=10)
+    for author in (viewer, followee, hidden):
+        Post.objects.create(author=author, text='excluded', comments_permission='anyone')
+    # a request left pending while the author was private doesn't hide the author
+    requested = make_user('requested')
+    Follow.objects.create(follower=viewer, followee=requested, allowed=False)
+    pending = Post.objects.create(author=requested, text='pending', comments_permission='anyone')
+
+    rank_for_you_feed()
+
+    response = client.get(reverse('for_you_feed'))
+    assert [post['id'] for post in response.data['results']] == [quiet.id, pending.id, viral.id]
+    # both paginators order by the same key
+    response = client.get(reverse('for_you_feed'), {'cursor': ''})
+    assert [post['id'] for post in response.data['results']] == [quiet.id, pending.id, viral.id]
+
+
+@pytest.mark.django_db
+def test_following_feed_merges_pull_authors_at_read_time(settings, timeline_store):
+    settings.TIMELINES = {**settings.TIMELINES, 'FANOUT_FOLLOWER_LIMIT': 2}
+    reader, other_reader = make_user('reader'), make_user('other')
+    celebrity, regular = make_user('celebrity'), make_user('regular')
+    for user in (reader, other_reader):
+        client_for(user).post(reverse('follow_followee_action'), {'followee': celebrity.id})
+    client_for(reader).post(reverse('follow_followee_action'), {'followee': regular.id})
+
+    client_for(regular).post('/post/', {'text': 'regular', 'comments_permission': 'anyone'})
+    client_for(celebrity).post('/post/', {'text': 'celebrity', 'comments_permission': 'anyone'})
+    client_for(regular).post('/post/', {'text': 'latest', 'comments_permission': 'anyone'})
+
+    celebrity_post = Post.objects.get(text='celebrity')
+    assert timeline_store.pull_authors() == {celebrity.id}
+    assert celebrity_post.id not in timeline_store.range(reader.id)
+    expected = list(Post.objects.filter(text__in=['latest', 'celebrity', 'regular']).order_by('-pk')
+                    .values_list('pk', flat=True))
+    assert feed_ids(client_for(reader)) == expected
+
+
+@pytest.mark.django_db
+def test_feed_pages_are_cached_until_version_bump():
+    reader, author = make_user('reader'), make_user('author')
+    client, author_client = client_for(reader), client_for(author)
+    client.post(reverse('follow_followee_action'), {'followee': author.id})
+    author_client.post('/post/', {'text': 'first', 'comments_permission': 'anyone'})
+
+    assert len(feed_ids(client)) == 1
+    Post.objects.create(author=author, text='not fanned out', comments_permission='anyone')
+    assert len(feed_ids(client)) == 1
+
+    before = metrics.snapshot()
+    author_client.post('/post/', {'text': 'second', 'comments_permission': 'anyone'})
+    assert len(feed_ids(client)) == 2
+    assert len(feed_ids(client)) == 2
+    after = metrics.snapshot()
+    assert after[metrics.FEED_CACHE_HITS] - before[metrics.FEED_CACHE_HITS] == 1
+    assert after[metrics.FEED_CACHE_MISSES] - before[metrics.FEED_CACHE_MISSES] == 1
+
+
+@pytest.mark.django_db
+def test_following_feed_delta_polling():
+    reader, author = make_user('reader'), make_user('author')
+    client, author_client = client_for(reader), client_for(author)
+    client.post(reverse('follow_followee_action'), {'followee': author.id})
+    author_client.post('/post/', {'text': 'seen', 'comments_permission': 'anyone'})
+    seen = Post.objects.get(text='seen')
+    url = reverse('following_feed')
+
+    badge = client.get(url, {'since': seen.id, 'count_only': 'true'})
+    assert badge.data == {'latest_id': seen.id, 'count': 0, 'has_more': False}
+    unchanged = client.get(url, {'since': seen.id, 'count_only': 'true'}, HTTP_IF_NONE_MATCH=badge['ETag'])
+    assert unchanged.status_code == 304
+
+    author_client.post('/post/', {'text': 'fresh', 'comments_permission': 'anyone'})
+    fresh = Post.objects.get(text='fresh')
+    changed = client.get(url, {'since': seen.id, 'count_only': 'true'}, HTTP_IF_NONE_MATCH=badge['ETag'])
+    assert changed.status_code == 200
+    assert changed.data['count'] == 1
+
+    delta = client.get(url, {'since': seen.id})
+    assert [post['id'] for post in delta.data['results']] == [fresh.id]
+    assert delta.data['latest_id'] == fresh.id
+
+
+@pytest.mark.django_db
+def test_reposted_originals_are_loaded_once_per_page(settings):
+    settings.REPOST_CHAIN_DEPTH = 2
+    viewer, author = make_user('viewer'), make_user('author')
+    client = client_for(viewer)
+    viral = Post.objects.create(author=author, text='viral', comments_permission='anyone')
+    quote = Post.objects.create(author=author, text='quote', repost=viral, comments_permission='anyone')
+    requote = Post.objects.create(author=author, text='requote', repost=quote, comments_permission='anyone')
+
+    feed_url = reverse('following_feed')
+    for i in range(2):
+        reposter = make_user(f'reposter{i}')
+        client.post(reverse('follow_followee_action'), {'followee': reposter.id})
+        Post.objects.create(author=reposter, repost=viral, comments_permission='anyone')
+    get_timeline_store().clear(viewer.id)
+    few_queries, _ = count_page_queries(client, feed_url)
+
+    for i in range(2, 6):
+        reposter = make_user(f'reposter{i}')
+        client.post(reverse('follow_followee_action'), {'followee': reposter.id})
+        Post.objects.create(author=reposter, repost=viral, comments_permission='anyone')
+    reposter = make_user('requoter')
+    client.post(reverse('follow_followee_action'), {'followee': reposter.id})
+    Post.objects.create(author=reposter, repost=requote, comments_permission='anyone')
+    get_timeline_store().clear(viewer.id)
+    bump_user_feeds(viewer.id)
+
+    many_queries, posts = count_page_queries(client, feed_url)
+    # one more query for the second level of the quote chain
+    assert many_queries == few_queries + 1
+    assert [post['repost']['id'] for post in posts[1:]] == [viral.id] * 6
+    assert posts[0]['repost']['repost']['id'] == quote.id
+    assert posts[0]['repost']['repost']['repost'] == viral.id
+
+
+@pytest.mark.django_db
+def test_include_users_side_loads_profiles_in_one_query():
+    viewer, author = make_user('viewer'), make_user('author', full_name='Author')
+    client = client_for(viewer)
+    client.post(reverse('follow_followee_action'), {'followee': author.id})
+    original = Post.objects.create(author=make_user('original'), text='original', comments_permission='anyone')
+    Post.objects.create(author=author, text='quote', repost=original, comments_permission='anyone')
+    Post.objects.create(author=author, text='second', comments_permission='anyone')
+    get_timeline_store().clear(viewer.id)
+
+    response = client.get(reverse('following_feed'))
+    assert 'users' not in response.data
+
+    feed_url = f'{reverse("following_feed")}?include=users'
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(feed_url)
+    user_queries = [query for query in queries if 'FROM "users_user"' in query['sql']]
+    assert len(user_queries) == 1
+    assert set(response.data['users']) == {author.id, original.author_id}
+    assert response.data['users'][author.id]['full_name'] == 'Author'
+    assert len(response.data['results']) == 2
+
+
+@pytest.mark.django_db
+def test_multiple_notifications_are_stored_in_bulk():
+    author = make_user('author')
+    followers = [make_user(f'follower{i}') for i in range(5)]
+    for follower in followers:
+        client_for(follower).post(reverse('follow_followee_action'), {'followee': author.id})
+
+    with CaptureQueriesContext(connection) as queries:
+        send_multiple_notifications(
+            NotificationType.new_thread(), follower__followee=author.id, follower__allowed=True
+        )
+    inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "pages_notification"')]
+    assert len(inserts) == 1
+    notified = Notification.objects.filter(type='new_thread').values_list('owner_id', flat=True)
+    assert set(notified) == {follower.id for follower in followers}
+
+
+@pytest.mark.django_db
+def test_notification_shards_resume_from_checkpoint(settings):
+    settings.NOTIFICATION_SHARD_SIZE = 3
+    users = [make_user(f'user{i}') for i in range(7)]
+    send_multiple_notifications(NotificationType.test(), username__startswith='user')
+
+    shards = list(NotificationShard.objects.order_by('start_id'))
+    assert [(shard.start_id, shard.end_id) for shard in shards] == [
+        (users[0].id, users[2].id), (users[3].id, users[5].id), (users[6].id, users[6].id)
+    ]
+    assert all(shard.finished_at and shard.duration is not None for shard in shards)
+    assert sorted(Notification.objects.values_list('owner_id', flat=True)) == [user.id for user in users]
+
+    # a shard interrupted after its first recipient continues after the checkpoint
+    broadcast = NotificationBroadcast.objects.create(
+        notification_data=NotificationType.new_thread(), filters={'username__startswith': 'user'}
+    )
+    shard = NotificationShard.objects.create(
+        broadcast=broadcast, start_id=users[0].id, end_id=users[2].id, last_recipient_id=users[0].id, sent=1
+    )
+    assert send_notification_shard(shard.id) == 3
+    notified = Notification.objects.filter(type='new_thread').values_list('owner_id', flat=True)
+    assert sorted(notified) == [users[1].id, users[2].id]
+    assert send_notification_shard(shard.id) == 3
+
+    # shards split the recipients, not their id range
+    sparse = send_multiple_notifications(NotificationType.test(), shard_size=2, pk__in=[users[0].id, users[3].id, users[6].id])
+    assert list(NotificationShard.objects.filter(broadcast_id=sparse).order_by('start_id').values_list(
+        'start_id', 'end_id')) == [(users[0].id, users[3].id), (users[6].id, users[6].id)]
+
+
+@pytest.mark.django_db
+def test_like_notifications_are_coalesced_and_retracted():
+    author = make_user('author')
+    post = Post.objects.create(author=author, text='viral', comments_permission='anyone')
+    likers = [make_user(f'liker{i}') for i in range(5)]
+    like_url = reverse('post_like_unlike', args=[post.id])
+    for liker in likers:
+        client_for(liker).patch(like_url)
+
+    notification = Notification.objects.get(owner=author, type='new_like')
+    assert notification.actor_count == 5
+    assert notification.sample_actors == [liker.id for liker in reversed(likers)][:3]
+
+    def notification_texts():
+        response = client_for(author).get(reverse('notifications'))
+        return [item['text'] for item in response.data['results'] if item['type'] == 'new_like']
+
+    assert notification_texts() == ['@liker4 and 4 others just liked your thread!']
+
+    client_for(likers[4]).patch(like_url)
+    notification.refresh_from_db()
+    assert notification.actor_count == 4
+    assert notification_texts() == ['@liker3 and 3 others just liked your thread!']
+
+    # usernames are rendered at read time
+    User.objects.filter(pk=likers[3].pk).update(username='renamed')
+    assert notification_texts() == ['@renamed and 3 others just liked your thread!']
+
+    # actors outside the sample are counted once too, retracted ones are not shown
+    client_for(likers[0]).patch(like_url)
+    client_for(likers[0]).patch(like_url)
+    for liker in likers[1:4]:
+        client_for(liker).patch(like_url)
+    # the aggregate is updated in place
+    notification = Notification.objects.get(owner=author, type='new_like', pk=notification.pk)
+    assert notification.actor_count == 1
+    assert notification.related_user_id == likers[0].id
+    assert notification.sample_actors == [likers[0].id]
+
+    # the flush closes the window, later likes open a new group
+    group = NotificationGroup.objects.get(owner=author)
+    flush_coalesced_notification(group.id)
+    client_for(likers[1]).patch(like_url)
+    assert Notification.objects.filter(owner=author, type='new_like').count() == 2
+
+    other = Post.objects.create(author=author, text='other', comments_permission='anyone')
+    client = client_for(likers[0])
+    client.patch(reverse('post_like_unlike', args=[other.id]))
+    client.patch(reverse('post_like_unlike', args=[other.id]))
+    assert not Notification.objects.filter(related_post=other).exists()
+
+
+@pytest.mark.django_db
+def test_notification_inbox_pages_and_unread_counter():
+    owner = make_user('owner')
+    for i in range(5):
+        client_for(make_user(f'follower{i}')).post(reverse('follow_followee_action'), {'followee': owner.id})
+    send_multiple_notifications(NotificationType.test(), pk=owner.id)
+    client = client_for(owner)
+
+    def unread_count():
+        owner.refresh_from_db()
+        response = client.get(reverse('notifications_unread_count'))
+        return response.data['unread']
+
+    # five follows are coalesced into one notification, plus the broadcast test one
+    assert unread_count() == 2
+    first_page = client.get(reverse('notifications'), {'page_size': 1})
+    assert [item['type'] for item in first_page.data['results']] == ['test']
+    second_page = client.get(first_page.data['links']['next'])
+    subscriber = second_page.data['results'][0]
+    assert (subscriber['type'], subscriber['actor_count'], subscriber['read_at']) == ('new_subscriber', 5, None)
+
+    response = client.post(reverse('notifications_mark_read'), {'up_to_id': subscriber['pk']}, format='json')
+    assert response.data == {'marked': 1, 'unread': 1}
+    assert unread_count() == 1
+    response = client.post(reverse('notifications_mark_read'), format='json')
+    assert response.data == {'marked': 1, 'unread': 0}
+
+    User.objects.filter(pk=owner.pk).update(unread_notifications=7)
+    call_command('reconcile_counters', stdout=StringIO())
+    assert unread_count() == 0
+
+
+@pytest.mark.django_db
+def test_deletes_release_unread_notifications_they_cascade_over():
+    author, commenter, liker = make_user('author'), make_user('commenter'), make_user('liker')
+    post = Post.objects.create(author=author, text='post', comments_permission='anyone')
+    other = Post.objects.create(author=author, text='other', comments_permission='anyone')
+    client_for(commenter).post(reverse('comment-list-create', args=[post.id]), {'text': 'first'}, format='json')
+    client_for(commenter).post(reverse('comment-list-create', args=[other.id]), {'text': 'second'}, format='json')
+    comment = Comment.objects.get(post=other)
+    client_for(author).post(reverse('reply', args=[comment.id]), {'text': 'reply'}, format='json')
+    client_for(liker).patch(reverse('post_like_unlike', args=[other.id]))
+
+    def unread():
+        return dict(User.objects.filter(pk__in=[author.pk, commenter.pk]).values_list('username', 'unread_notifications'))
+
+    assert unread() == {'author': 3, 'commenter': 1}
+    client_for(commenter).delete(reverse('comment-delete', args=[comment.id]))
+    assert unread() == {'author': 2, 'commenter': 0}
+    client_for(author).delete(f'/post/{post.id}/')
+    assert unread() == {'author': 1, 'commenter': 0}
+    CustomUserAdmin(User, admin.site).delete_model(None, liker)
+    assert unread() == {'author': 0, 'commenter': 0}
+    assert not Notification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_expired_notifications_are_archived_and_deleted(settings, tmp_path):
+    settings.NOTIFICATION_ARCHIVE_DIR = str(tmp_path)
+    owner = make_user('owner')
+    send_multiple_notifications(NotificationType.test(), pk=owner.id)
+    send_multiple_notifications(NotificationType.new_thread(), pk=owner.id)
+    old = Notification.objects.get(type='test')
+    posted = timezone.now() - settings.NOTIFICATION_RETENTION - timedelta(days=1)
+    Notification.objects.filter(pk=old.pk).update(date_posted=posted)
+
+    response = client_for(owner).get(reverse('notifications'))
+    assert [item['type'] for item in response.data['results']] == ['new_thread']
+
+    NotificationBroadcast.objects.filter(notification_data__type='test').update(
+        created_at=timezone.now() - settings.NOTIFICATION_BROADCAST_RETENTION - timedelta(days=1)
+    )
+
+    assert expire_notifications() == 1
+    assert list(Notification.objects.values_list('type', flat=True)) == ['new_thread']
+    # delivery checkpoints are kept for the broadcast retention only
+    assert list(NotificationBroadcast.objects.values_list('notification_data__type', flat=True)) == ['new_thread']
+    assert NotificationShard.objects.count() == 1
+    owner.refresh_from_db()
+    assert owner.unread_notifications == 1
+    with gzip.open(tmp_path / f'notifications-{posted:%Y-%m}.ndjson.gz', 'rt') as archive:
+        archived = [json.loads(line) for line in archive]
+    assert [(row['id'], row['owner_id'], row['type']) for row in archived] == [(old.id, owner.id, 'test')]
+
+
+@pytest.mark.django_db
+@pytest.mark.skipif(connection.vendor != 'postgresql', reason='notifications are partitioned on PostgreSQL only')
+def test_new_partitions_take_over_default_partition_rows():
+    owner = make_user('owner')
+    now = timezone.now()
+    month = retention.add_months(retention.month_start(now), retention.PARTITIONS_AHEAD + 1)
+    notification = Notification.objects.create(owner=owner, type='test')
+    Notification.objects.filter(pk=notification.pk).update(date_posted=month)
+
+    retention.ensure_partitions(retention.add_months(now, 1))
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT tableoid::regclass::text FROM {retention.TABLE} WHERE id = %s', [notification.pk])
+        assert cursor.fetchone()[0] == retention.partition_name(month)
+
+
+@pytest.mark.django_db
+def test_notifications_consumer_joins_and_leaves_user_group():
+    application = NotificationsConsumer.as_asgi()
+    layer = get_channel_layer()
+
+    async def scenario():
+        token = AccessToken()
+        token['user_id'] = 42
+        communicator = WebsocketCommunicator(application, f'ws/notifications/?token={token}')
+        connected, _ = await communicator.connect()
+        assert connected
+        online = presence.online([41, 42])
+        for recipient_id in (41, 42):
+            await sync_to_async(send_notification)(recipient_id, NotificationType.new_thread(), False)
+        [frame] = await communicator.receive_json_from()
+        await communicator.send_to(text_data='ping')
+        pong = await communicator.receive_from()
+        await communicator.disconnect()
+
+        rejected = WebsocketCommunicator(application, 'ws/notifications/?token=invalid')
+        connected, _ = await rejected.connect()
+        return online, frame, pong, connected
+
+    online, frame, pong, rejected_connected = async_to_sync(scenario)()
+    assert online == [42]
+    assert frame['type'] == 'new_thread'
+    assert frame['text'] == 'We have new updates from people you follow!'
+    assert pong == 'pong'
+    assert not layer.groups.get('42')
+    assert presence.online([42]) == []
+    assert not rejected_connected
+    assert metrics.snapshot([metrics.PUSHES_DELIVERED, metrics.PUSHES_SKIPPED]) == {
+        metrics.PUSHES_DELIVERED: 1, metrics.PUSHES_SKIPPED: 1
+    }
+
+
+# the consumer reads through database_sync_to_async, which closes a connection left in a test transaction
+@pytest.mark.django_db(transaction=True)
+def test_notifications_consumer_replays_missed_notifications(settings):
+    settings.NOTIFICATION_REPLAY_BATCH_SIZE = 2
+    settings.NOTIFICATION_REPLAY_LIMIT = 3
+    application = NotificationsConsumer.as_asgi()
+    owner, actor = make_user('owner'), make_user('actor')
+    seen = Notification.objects.create(owner=owner, type='new_thread')
+    missed = [
+        Notification.objects.create(owner=owner, type='new_like', related_user=actor, actor_count=number)
+        for number in (1, 2, 3, 4)
+    ]
+    Notification.objects.create(owner=actor, type='new_thread')
+    token = AccessToken()
+    token['user_id'] = owner.id
+
+    async def replay(last_seen):
+        communicator = WebsocketCommunicator(application, f'ws/notifications/?token={token}&last_seen={last_seen}')
+        await communicator.connect()
+        frames = [await communicator.receive_json_from()]
+        while isinstance(frames[-1], list):
+            frames.append(await communicator.receive_json_from())
+        await communicator.disconnect()
+        return frames
+
+    frames = async_to_sync(replay)(seen.id)
+    assert [[item['id'] for item in frame] for frame in frames[:-1]] == [
+        [missed[0].id, missed[1].id], [missed[2].id]
+    ]
+    assert frames[0][1]['text'] == '@actor and 1 other just liked your thread!'
+    assert frames[-1] == {'type': 'replay', 'last_id': missed[2].id, 'complete': False}
+
+    frames = async_to_sync(replay)(missed[2].id)
+    assert [[item['id'] for item in frame] for frame in frames[:-1]] == [[missed[3].id]]
+    assert frames[-1] == {'type': 'replay', 'last_id': missed[3].id, 'complete': True}
+
+    async def live():
+        communicator = WebsocketCommunicator(application, f'ws/notifications/?token={token}')
+        await communicator.connect()
+        await sync_to_async(send_notification)(owner.id, NotificationType.new_thread())
+        [frame] = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return frame
+
+    # live frames carry the id of the stored notification, the next `last_seen` of the client
+    frame = async_to_sync(live)()
+    assert frame['id'] == Notification.objects.filter(owner=owner).latest('id').id
+    assert async_to_sync(replay)(frame['id']) == [{'type': 'replay', 'last_id': frame['id'], 'complete': True}]
+
+
+@pytest.mark.django_db
+def test_notifications_consumer_batches_collapses_and_drops(settings):
+    settings.NOTIFICATION_SOCKET_BATCH = {'INTERVAL_MS': 200, 'MAX_EVENTS': 10, 'QUEUE_SIZE': 3}
+    application = NotificationsConsumer.as_asgi()
+    layer = get_channel_layer()
+    events = [
+        notification_event({'type': 'new_like', 'template': 'new_like', 'actor': 'user', 'related_post': post_id})
+        for post_id in (1, 2, 3, 3, 4, 5)
+    ]
+
+    async def scenario():
+        token = AccessToken()
+        token['user_id'] = 42
+        communicator = WebsocketCommunicator(application, f'ws/notifications/?token={token}')
+        await communicator.connect()
+        for event in events:
+            await layer.group_send('42', event)
+        frame = await communicator.receive_json_from(timeout=2)
+        nothing_else = await communicator.receive_nothing(timeout=0.3)
+
+        settings.NOTIFICATION_SOCKET_BATCH = {'INTERVAL_MS': 10000, 'MAX_EVENTS': 2, 'QUEUE_SIZE': 3}
+        for event in events[:2]:
+            await layer.group_send('42', event)
+        full_batch = await communicator.receive_json_from(timeout=2)
+        await communicator.disconnect()
+        return frame, nothing_else, full_batch
+
+    frame, nothing_else, full_batch = async_to_sync(scenario)()
+    assert [item['related_post'] for item in frame] == [3, 4, 5]
+    assert nothing_else
+    assert [item['related_post'] for item in full_batch] == [1, 2]
+    stats = metrics.snapshot()
+    assert stats[metrics.SOCKET_FRAMES_SENT] == 2
+    assert stats[metrics.SOCKET_EVENTS_SENT] == 5
+    assert stats[metrics.SOCKET_EVENTS_COLLAPSED] == 1
+    assert stats[metrics.SOCKET_EVENTS_DROPPED] == 2
+    assert stats[metrics.SOCKET_QUEUE_PEAK] == 3
+
+
+# consumers close old database connections per message, a test transaction included
+@pytest.mark.django_db(transaction=True)
+def test_live_feed_pushes_posts_to_allowed_subscribers():
+    application = NotificationsConsumer.as_asgi()
+    author = make_user('author', is_private=True)
+    subscriber, legacy, pending = make_user('subscriber'), make_user('legacy'), make_user('pending')
+    Follow.objects.create(follower=subscriber, followee=author)
+    Follow.objects.create(follower=legacy, followee=author)
+    Follow.objects.create(follower=pending, followee=author, allowed=False)
+    post = Post.objects.create(author=author, text='hello')
+
+    def open_socket(user):
+        token = AccessToken()
+        token['user_id'] = user.id
+        return WebsocketCommunicator(application, f'ws/notifications/?token={token}')
+
+    async def scenario():
+        sockets = {user.username: open_socket(user) for user in (subscriber, legacy, pending)}
+        for username, communicator in sockets.items():
+            await communicator.connect()
+            if username != 'legacy':
+                await communicator.send_json_to({'action': 'subscribe', 'stream': 'feed', 'data': True})
+                assert await communicator.receive_json_from() == {'type': 'subscribed', 'stream': 'feed'}
+        await sync_to_async(push_new_post)(post.id)
+        frames = {
+            'subscriber': await sockets['subscriber'].receive_json_from(),
+            'legacy': await sockets['legacy'].receive_json_from(),
+            'pending': await sockets['pending'].receive_nothing(timeout=0.3),
+        }
+        for communicator in sockets.values():
+            await communicator.disconnect()
+        return frames
+
+    frames = async_to_sync(scenario)()
+    assert frames['subscriber']['type'] == 'new_post'
+    assert frames['subscriber']['post']['id'] == post.id
+    assert frames['subscriber']['post']['author'] == author.id
+    assert frames['subscriber']['data']['text'] == 'hello'
+    assert [item['type'] for item in frames['legacy']] == ['new_thread']
+    assert frames['pending']
+    assert presence.online([subscriber.id], presence.FEED) == []
+    # delivered by a resumable broadcast shard, without stored notifications
+    assert NotificationBroadcast.objects.get(post=post).shards.get().sent == 2
+    assert not Notification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_socket_presence_outlives_ttl_and_counts_each_socket(settings):
+    settings.PRESENCE_TTL = 0.2
+    application = NotificationsConsumer.as_asgi()
+
+    async def scenario():
+        token = AccessToken()
+        token['user_id'] = 42
+        first, second = (WebsocketCommunicator(application, f'ws/notifications/?token={token}') for _ in range(2))
+        await first.connect()
+        await second.connect()
+        # no client frames, the sockets refresh presence themselves
+        await asyncio.sleep(0.5)
+        states = [presence.online([42])]
+        await first.disconnect()
+        states.append(presence.online([42]))
+        await second.disconnect()
+        states.append(presence.online([42]))
+        return states
+
+    assert async_to_sync(scenario)() == [[42], [42], []]
+
+
+# the consumer reads through database_sync_to_async, which closes a connection left in a test transaction
+@pytest.mark.django_db(transaction=True)
+def test_watched_post_counters_are_broadcast_once_per_interval(settings, django_capture_on_commit_callbacks):
+    settings.POST_WATCH_LIMIT = 2
+    application = NotificationsConsumer.as_asgi()
+    viewer, author, private_author = make_user('viewer'), make_user('author'), make_user('hidden', is_private=True)
+    post = Post.objects.create(author=author, text='hot', comments_permission='anyone')
+    other = Post.objects.create(author=author, text='other')
+    hidden = Post.objects.create(author=private_author, text='hidden')
+    liker = make_user('liker')
+    token = AccessToken()
+    token['user_id'] = viewer.id
+
+    async def scenario():
+        communicator = WebsocketCommunicator(application, f'ws/notifications/?token={token}')
+        await communicator.connect()
+        await communicator.send_json_to({'action': 'subscribe', 'stream': 'posts', 'posts': [hidden.id, post.id]})
+        subscribed = await communicator.receive_json_from()
+        await communicator.send_json_to({'action': 'subscribe', 'stream': 'posts', 'posts': [other.id, 999, 1000]})
+        capped = await communicator.receive_json_from()
+
+        def engage():
+            client = client_for(liker)
+            # both changes land within one interval, eager tasks ignore the countdown
+            with transaction.atomic():
+                client.patch(reverse('post_like_unlike', args=[post.id]))
+                client.post(reverse('comment-list-create', args=[post.id]), {'text': 'nice'}, format='json')
+        await sync_to_async(engage)()
+        frame = await communicator.receive_json_from()
+        nothing_else = await communicator.receive_nothing(timeout=0.3)
+        await communicator.disconnect()
+        return subscribed, capped, frame, nothing_else
+
+    subscribed, capped, frame, nothing_else = async_to_sync(scenario)()
+    assert subscribed == {'type': 'subscribed', 'stream': 'posts', 'posts': [post.id]}
+    assert capped['posts'] == [post.id, other.id]
+    assert frame == {
+        'type': 'post_counters', 'post': post.id,
+        'total_likes': 1, 'total_comments': 1, 'total_reposts': 0, 'total_quotes': 0,
+    }
+    assert nothing_else
+    assert not get_channel_layer().groups.get(f'post_{post.id}')
+
+    # watched posts stay marked for the presence TTL, changes of other posts schedule nothing
+    with transaction.atomic(), django_capture_on_commit_callbacks() as callbacks:
+        post_counters_changed(other.id)
+        post_counters_changed(hidden.id)
+    assert len(callbacks) == 1
@@ -0,0 +1,345 @@
+import heapq
+import threading
+from functools import lru_cache
+from itertools import islice
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# member kept in every Redis timeline below all posts, so a built timeline without posts
+# still exists (post ids start at 1)
+MARKER = 0
+
+
+class BaseTimelineStore:
+    """
+    Materialized per-user timelines of post ids ordered by score (post timestamp).
+    Every timeline is capped to `max_length` newest entries. Timelines are built by `replace`,
+    pushes and extends only reach users whose timeline exists, the others are built from the
+    database on their next read.
+
+    Authors with too many followers are not pushed to follower timelines ("pull authors"),
+    their newest posts are kept in a small per-author cache capped to `author_max_length`
+    and merged into timelines at read time.
+    """
+
+    def __init__(self, max_length=800, author_max_length=100, **config):
+        self.max_length = max_length
+        self.author_max_length = author_max_length
+
+    def push(self, user_ids, post_id, score):
+        """Add one post to the existing timelines of the given users."""
+        raise NotImplementedError
+
+    def extend(self, user_id, entries):
+        """Add (post_id, score) pairs to a single user timeline, when it exists."""
+        raise NotImplementedError
+
+    def replace(self, user_id, entries):
+        """Create or overwrite a user timeline with (post_id, score) pairs, possibly none."""
+        raise NotImplementedError
+
+    def remove(self, user_ids, post_ids):
+        """Remove posts from the timelines of all given users."""
+        raise NotImplementedError
+
+    def range_with_scores(self, user_id, count=None):
+        """Return (post_id, score) pairs of a user timeline, newest first."""
+        raise NotImplementedError
+
+    def range(self, user_id, count=None):
+        """Return post ids of a user timeline, newest first."""
+        return [post_id for post_id, _ in self.range_with_scores(user_id, count)]
+
+    def exists(self, user_id):
+        raise NotImplementedError
+
+    def clear(self, user_id):
+        raise NotImplementedError
+
+    def push_author(self, author_id, post_id, score):
+        """Add a post to the recent posts cache of its author."""
+        raise NotImplementedError
+
+    def remove_author_posts(self, author_id, post_ids):
+        raise NotImplementedError
+
+    def author_ranges(self, author_ids):
+        """Return {author_id: [(post_id, score), ...]} of recent posts caches, newest first."""
+        raise NotImplementedError
+
+    def add_pull_author(self, author_id):
+        raise NotImplementedError
+
+    def pull_authors(self):
+        """Return ids of all authors whose posts are merged at read time."""
+        raise NotImplementedError
+
+
+class InMemoryTimelineStore(BaseTimelineStore):
+    """Process local timeline store, used in tests, local development and benchmarks."""
+
+    def __init__(self, max_length=800, author_max_length=100, **config):
+        super().__init__(max_length, author_max_length, **config)
+        self._timelines = {}
+        self._author_posts = {}
+        self._pull_authors = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _newest(timeline, count=None):
+        newest = sorted(timeline.items(), key=lambda item: (item[1], item[0]), reverse=True)
+        return newest[:count] if count else newest
+
+    def _trim(self, timeline, max_length):
+        if len(timeline) > max_length:
+            for post_id, _ in self._newest(timeline)[max_length:]:
+                del timeline[post_id]
+
+    def push(self, user_ids, post_id, score):
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._timelines.get(user_id)
+                if timeline is not None:
+                    timeline[post_id] = score
+                    self._trim(timeline, self.max_length)
+
+    def extend(self, user_id, entries):
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is not None:
+                timeline.update(entries)
+                self._trim(timeline, self.max_length)
+
+    def replace(self, user_id, entries):
+        timeline = dict(entries)
+        self._trim(timeline, self.max_length)
+        with self._lock:
+            self._timelines[user_id] = timeline
+
+    def remove(self, user_ids, post_ids):
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._timelines.get(user_id)
+                if timeline is None:
+                    continue
+                for post_id in post_ids:
+                    timeline.pop(post_id, None)
+
+    def range_with_scores(self, user_id, count=None):
+        with self._lock:
+            timeline = dict(self._timelines.get(user_id, {}))
+        return self._newest(timeline, count or self.max_length)
+
+    def exists(self, user_id):
+        return user_id in self._timelines
+
+    def clear(self, user_id):
+        with self._lock:
+            self._timelines.pop(user_id, None)
+
+    def push_author(self, author_id, post_id, score):
+        with self._lock:
+            posts = self._author_posts.setdefault(author_id, {})
+            posts[post_id] = score
+            self._trim(posts, self.author_max_length)
+
+    def remove_author_posts(self, author_id, post_ids):
+        with self._lock:
+            posts = self._author_posts.get(author_id, {})
+            for post_id in post_ids:
+                posts.pop(post_id, None)
+
+    def author_ranges(self, author_ids):
+        with self._lock:
+            return {author_id: self._newest(self._author_posts.get(author_id, {})) for author_id in author_ids}
+
+    def add_pull_author(self, author_id):
+        with self._lock:
+            self._pull_authors.add(author_id)
+
+    def pull_authors(self):
+        return set(self._pull_authors)
+
+
+class RedisTimelineStore(BaseTimelineStore):
+    """
+    Timelines kept in Redis sorted sets, one key per user and one per pull author.
+    User timelines hold the MARKER member at -inf, which trimming keeps.
+    """
+
+    key_prefix = 'timeline'
+
+    # ARGV: max length, then score, post id pairs
+    add_script = """
+    if redis.call('exists', KEYS[1]) == 0 then
+        return 0
+    end
+    redis.call('zadd', KEYS[1], unpack(ARGV, 2))
+    redis.call('zremrangebyrank', KEYS[1], 1, -tonumber(ARGV[1]) - 1)
+    return 1
+    """
+
+    def __init__(self, max_length=800, author_max_length=100, url='redis://redis:6379/1', **config):
+        super().__init__(max_length, author_max_length, **config)
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self._add = self.client.register_script(self.add_script)
+
+    def key(self, user_id):
+        return f'{self.key_prefix}:{user_id}'
+
+    def author_key(self, author_id):
+        return f'{self.key_prefix}:author:{author_id}'
+
+    @property
+    def pull_authors_key(self):
+        return f'{self.key_prefix}:pull_authors'
+
+    @staticmethod
+    def _entries(members):
+        return [(int(post_id), score) for post_id, score in members]
+
+    def _add_args(self, entries):
+        args = [self.max_length]
+        for post_id, score in entries:
+            args.extend((score, post_id))
+        return args
+
+    def push(self, user_ids, post_id, score):
+        pipe = self.client.pipeline(transaction=False)
+        args = self._add_args([(post_id, score)])
+        for user_id in user_ids:
+            self._add(keys=[self.key(user_id)], args=args, client=pipe)
+        pipe.execute()
+
+    def extend(self, user_id, entries):
+        args = self._add_args(dict(entries).items())
+        if len(args) > 1:
+            self._add(keys=[self.key(user_id)], args=args)
+
+    def replace(self, user_id, entries):
+        key = self.key(user_id)
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        pipe.zadd(key, {MARKER: float('-inf'), **dict(entries)})
+        pipe.zremrangebyrank(key, 1, -self.max_length - 1)
+        pipe.execute()
+
+    def remove(self, user_ids, post_ids):
+        post_ids = list(post_ids)
+        if not post_ids:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zrem(self.key(user_id), *post_ids)
+        pipe.execute()
+
+    def range_with_scores(self, user_id, count=None):
+        members = self.client.zrevrangebyscore(
+            self.key(user_id), '+inf', '(-inf', start=0, num=count or self.max_length, withscores=True
+        )
+        return self._entries(members)
+
+    def exists(self, user_id):
+        return bool(self.client.exists(self.key(user_id)))
+
+    def clear(self, user_id):
+        self.client.delete(self.key(user_id))
+
+    def push_author(self, author_id, post_id, score):
+        key = self.author_key(author_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(key, {post_id: score})
+        pipe.zremrangebyrank(key, 0, -self.author_max_length - 1)
+        pipe.execute()
+
+    def remove_author_posts(self, author_id, post_ids):
+        post_ids = list(post_ids)
+        if post_ids:
+            self.client.zrem(self.author_key(author_id), *post_ids)
+
+    def author_ranges(self, author_ids):
+        author_ids = list(author_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for author_id in author_ids:
+            pipe.zrevrange(self.author_key(author_id), 0, -1, withscores=True)
+        return {author_id: self._entries(members) for author_id, members in zip(author_ids, pipe.execute())}
+
+    def add_pull_author(self, author_id):
+        self.client.sadd(self.pull_authors_key, author_id)
+
+    def pull_authors(self):
+        return {int(author_id) for author_id in self.client.smembers(self.pull_authors_key)}
+
+
+@lru_cache(maxsize=None)
+def get_timeline_store():
+    options = settings.TIMELINES
+    store_class = import_string(options['BACKEND'])
+    return store_class(
+        max_length=options.get('MAX_LENGTH', 800),
+        author_max_length=options.get('AUTHOR_MAX_LENGTH', 100),
+        **options.get('CONFIG', {})
+    )
+
+
+def is_pull_author(follower_count):
+    return follower_count >= settings.TIMELINES.get('FANOUT_FOLLOWER_LIMIT', 10000)
+
+
+def post_score(post):
+    return post.date_posted.timestamp()
+
+
+def merge_timelines(sources, limit):
+    """k-way merge of newest-first (post_id, score) lists into at most `limit` unique post ids."""
+    merged = heapq.merge(*sources, key=lambda entry: (entry[1], entry[0]), reverse=True)
+    unique_ids = (post_id for post_id, _ in _unique(merged))
+    return list(islice(unique_ids, limit))
+
+
+def _unique(entries):
+    seen = set()
+    for entry in entries:
+        if entry[0] not in seen:
+            seen.add(entry[0])
+            yield entry
+
+
+def rebuild_timeline(user_id):
+    """Build the user timeline from the database with the newest posts of allowed followees."""
+    from pages.models import Post
+
+    store = get_timeline_store()
+    posts = Post.objects.filter(
+        author__followee__follower_id=user_id, author__followee__allowed=True
+    ).order_by('-date_posted', '-pk').values_list('pk', 'date_posted')[:store.max_length]
+    store.replace(user_id, ((post_id, date_posted.timestamp()) for post_id, date_posted in posts))
+
+
+def followed_pull_authors(user_id):
+    from users.models import Follow
+
+    pull_authors = get_timeline_store().pull_authors()
+    if not pull_authors:
+        return []
+    return list(Follow.objects.filter(
+        follower_id=user_id, allowed=True, followee_id__in=pull_authors
+    ).values_list('followee_id', flat=True))
+
+
+def read_timeline(user_id, pull_authors=None):
+    """Return newest post ids of the user feed: pushed timeline merged with followed pull authors."""
+    store = get_timeline_store()
+    if not store.exists(user_id):
+        rebuild_timeline(user_id)
+    timeline = store.range_with_scores(user_id)
+
+    if pull_authors is None:
+        pull_authors = followed_pull_authors(user_id)
+    if pull_authors:
+        author_posts = store.author_ranges(pull_authors)
+        return merge_timelines([timeline, *author_posts.values()], store.max_length)
+    return [post_id for post_id, _ in timeline]
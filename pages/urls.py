@@ -26,6 +26,10 @@ urlpatterns = [
     path('search/users/<str:search_obj>/', views.UsersSearchView().as_view(), name='username_search_view'),
     path('search/hashtag/<str:search_obj>/', views.HashTagsSearch().as_view(), name='hashtag_search_view'),
 
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+
     path('notifications/', views.NotificationsView.as_view(), name='notifications'),
+    path('notifications/unread_count/', views.NotificationsUnreadCountView.as_view(), name='notifications_unread_count'),
+    path('notifications/mark_read/', views.NotificationsMarkReadView.as_view(), name='notifications_mark_read'),
     path('notifications/<str:type>/', views.NotificationsByTypeView.as_view(), name='user_notifications'),
 ]
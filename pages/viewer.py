@@ -0,0 +1,50 @@
+from django.db.models import CharField, Value
+
+from .models import Post, Comment
+
+
+class ViewerState:
+    """
+    Requester specific flags (liked / reposted / commented) for a whole page
+    of posts or comments, resolved with a single query.
+    """
+
+    def __init__(self, object_ids, liked=(), reposted=(), commented=()):
+        self.object_ids = set(object_ids)
+        self.liked = set(liked)
+        self.reposted = set(reposted)
+        self.commented = set(commented)
+
+    def covers(self, object_id):
+        return object_id in self.object_ids
+
+    @classmethod
+    def for_posts(cls, user, post_ids):
+        post_ids = list(post_ids)
+        if not post_ids or not user.is_authenticated:
+            return cls(post_ids)
+
+        def flagged(queryset, post_field, flag):
+            return queryset.annotate(flag=Value(flag, output_field=CharField())).values_list(post_field, 'flag')
+
+        rows = flagged(
+            Post.likes.through.objects.filter(user_id=user.id, post_id__in=post_ids), 'post_id', 'liked'
+        ).union(
+            flagged(Post.objects.filter(author_id=user.id, repost_id__in=post_ids), 'repost_id', 'reposted'),
+            flagged(Comment.objects.filter(author_id=user.id, post_id__in=post_ids), 'post_id', 'commented'),
+            all=True,
+        )
+        flags = {'liked': set(), 'reposted': set(), 'commented': set()}
+        for post_id, flag in rows:
+            flags[flag].add(post_id)
+        return cls(post_ids, **flags)
+
+    @classmethod
+    def for_comments(cls, user, comment_ids):
+        comment_ids = list(comment_ids)
+        if not comment_ids or not user.is_authenticated:
+            return cls(comment_ids)
+        liked = Comment.likes.through.objects.filter(
+            user_id=user.id, comment_id__in=comment_ids
+        ).values_list('comment_id', flat=True)
+        return cls(comment_ids, liked=liked)
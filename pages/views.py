@@ -1,26 +1,45 @@
-from django.db.models import Count, Q
+from django.db import transaction
+from django.db.models import F, FloatField, Q, Value
+from django.utils import timezone
 from rest_framework import mixins, status
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 from rest_framework.generics import (ListCreateAPIView,
                                      get_object_or_404)
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 from rest_framework import generics
 from cloudinary.uploader import upload
 
-from config.tasks import send_multiple_notifications, send_notification
+from config import metrics
+from config.tasks import (send_notification,
+                          coalesce_notification,
+                          fan_out_post,
+                          post_counters_changed,
+                          push_new_post,
+                          remove_posts_from_timelines,
+                          retract_notification)
 from config.types import NotificationType
-from config.utils import ThreadsMainPaginatorLTE, ThreadsMainPaginatorInspector, ThreadsMainPaginator
+from config.utils import (ThreadsMainPaginatorLTE,
+                          ThreadsMainPaginator,
+                          ThreadsCursorPaginator,
+                          ThreadsCursorPaginatorInspector,
+                          CursorPaginationMixin)
+from users.graph import get_social_graph
 from users.models import User, Follow
 from users.permissions import EmailVerified
 from . import serializers
-from .base_views import BaseSearchView
+from .base_views import BaseSearchView, FeedCacheMixin, FeedDeltaMixin, SideLoadUsersMixin
+from .counters import (adjust_counter, recount_post_comments, release_post_counters, release_unread_notifications,
+                       reply_thread_ids, repost_counter_field, set_like)
+from .feed_cache import author_scope, tag_scope, user_scope, bump_user_feeds, bump_versions
 from .models import Post, Comment, HashTag, Notification
+from .ranking import is_ranked
 from .permissions import (CommentPermission,
                           ReplyPermission)
+from .timelines import read_timeline, followed_pull_authors
 from .serializers import (PostViewSerializer,
                           PostCreateSerializer,
                           CommentCreateSerializer,
@@ -30,7 +49,9 @@ from .serializers import (PostViewSerializer,
                           ReplyCreateSerializer)
 
 
-class PostModelViewSet(mixins.CreateModelMixin,
+class PostModelViewSet(SideLoadUsersMixin,
+                       CursorPaginationMixin,
+                       mixins.CreateModelMixin,
                        mixins.DestroyModelMixin,
                        mixins.ListModelMixin,
                        GenericViewSet):
@@ -40,7 +61,7 @@ class PostModelViewSet(mixins.CreateModelMixin,
     serializer_class = PostViewSerializer
     permission_classes = (IsAuthenticated, EmailVerified)
     pagination_class = ThreadsMainPaginator
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
 
     def get_queryset(self):
         user_id = self.request.user.id
@@ -109,18 +130,36 @@ class PostModelViewSet(mixins.CreateModelMixin,
 
         serializer = PostCreateSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
-        serializer.save()
-        send_multiple_notifications.delay(
-            NotificationType.new_thread(), create_notification=False, follower__followee=request.user.id, follower__allowed=True
-        )
+        with transaction.atomic():
+            post = serializer.save()
+            adjust_counter(User, request.user.id, 'post_count')
+        fan_out_post.delay(post.id)
+        push_new_post.delay(post.id)
 
         return Response({'message': 'Post added successfully.'},
                         status=status.HTTP_201_CREATED)
 
-    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
+    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector],
+                         manual_parameters=SideLoadUsersMixin.include_parameters)
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)
 
+    def perform_destroy(self, instance):
+        # reposts and quotes of the post are removed by cascade, so purge them from timelines too
+        entries = list(Post.objects.filter(Q(pk=instance.pk) | Q(repost=instance)).values_list('pk', 'author_id'))
+        tag_names = list(instance.hash_tag.values_list('tag_name', flat=True))
+        post_ids = [post_id for post_id, _ in entries]
+        with transaction.atomic():
+            release_unread_notifications(Notification.objects.filter(
+                Q(related_post__in=post_ids) | Q(related_comment__post__in=post_ids)
+            ))
+            instance.delete()
+            release_post_counters(author_id for _, author_id in entries)
+            if instance.repost_id:
+                adjust_counter(Post, instance.repost_id, repost_counter_field(instance), -1)
+        bump_versions(tag_scope(tag_name) for tag_name in tag_names)
+        remove_posts_from_timelines.delay(entries)
+
 
 class PostDetailAPIView(APIView):
     """
@@ -140,7 +179,7 @@ class PostDetailAPIView(APIView):
             post = Post.objects.get(pk=post_id)
             author = post.author
             if author.is_private:
-                is_follower = Follow.objects.filter(followee=author, follower=request.user, allowed=True).exists()
+                is_follower = get_social_graph().is_following(request.user.id, author.id)
                 if not is_follower:
                     return Response({'message': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
             serializer = PostViewSerializer(post, context={'request': request})
@@ -166,7 +205,7 @@ class UserPostsListAPIView(APIView):
         try:
             user = User.objects.get(pk=user_id)
             if user.is_private:
-                is_follower = Follow.objects.filter(followee=user, follower=request.user, allowed=True).exists()
+                is_follower = get_social_graph().is_following(request.user.id, user.id)
                 if not is_follower:
                     return Response({'message': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
             posts = Post.objects.filter(author=user)
@@ -196,8 +235,13 @@ class RepostCreateAPIVIew(APIView):
             return Response({'error': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
         serializer = RepostCreateSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
-        repost = serializer.save()
-        send_notification.delay(post.author.id, NotificationType.new_repost(request.user, repost))
+        with transaction.atomic():
+            repost = serializer.save()
+            adjust_counter(Post, post.id, 'repost_count')
+            adjust_counter(User, request.user.id, 'post_count')
+        bump_user_feeds(request.user.id)
+        fan_out_post.delay(repost.id)
+        coalesce_notification.delay(post.author.id, NotificationType.new_repost(request.user, post))
         return Response({'message': 'Repost added successfully.'}, status=status.HTTP_201_CREATED)
 
 
@@ -228,7 +272,12 @@ class QuoteCreateAPIVIew(APIView):
             return Response({'error': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
         serializer = QuoteCreateSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
-        quote = serializer.save()
+        with transaction.atomic():
+            quote = serializer.save()
+            adjust_counter(Post, post.id, 'quote_count')
+            adjust_counter(User, request.user.id, 'post_count')
+        bump_user_feeds(request.user.id)
+        fan_out_post.delay(quote.id)
         send_notification.delay(post.author.id, NotificationType.new_quote(request.user, quote))
         return Response({'message': 'Quote added successfully.'}, status=status.HTTP_201_CREATED)
 
@@ -251,22 +300,27 @@ class PostLikeUnlikeAPIView(APIView):
         except Post.DoesNotExist:
             return Response({'error': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
         if not post.likes.filter(id=user.id).exists():
-            post.likes.add(user.id)
-            send_notification.delay(post.author.id, NotificationType.new_thread_like(user, post))
+            if set_like(Post, post.id, user.id, True):
+                post_counters_changed(post.id)
+                bump_user_feeds(user.id)
+                coalesce_notification.delay(post.author.id, NotificationType.new_thread_like(user, post))
             return Response({'message': 'Like added.'}, status=status.HTTP_200_OK)
-        elif post.likes.filter(id=user.id).exists():
-            post.likes.remove(user.id)
+        else:
+            if set_like(Post, post.id, user.id, False):
+                post_counters_changed(post.id)
+                bump_user_feeds(user.id)
+                retract_notification.delay(post.author.id, NotificationType.new_thread_like(user, post))
             return Response({'message': 'Like removed.'}, status=status.HTTP_200_OK)
 
 
-class CommentListCreateAPIView(ListCreateAPIView):
+class CommentListCreateAPIView(SideLoadUsersMixin, CursorPaginationMixin, ListCreateAPIView):
     """
     API endpoint for view post comments.
     """
     serializer_class = CommentViewSerializer
     permission_classes = (IsAuthenticated, EmailVerified)
     pagination_class = ThreadsMainPaginator
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
 
     def get_permissions(self):
         if self.request.method == 'GET':
@@ -277,7 +331,7 @@ class CommentListCreateAPIView(ListCreateAPIView):
     def get_queryset(self):
         post_id = self.kwargs['post_id']
         post = get_object_or_404(Post, pk=post_id)
-        queryset = Comment.objects.filter(post=post).order_by('-date_posted')
+        queryset = Comment.objects.filter(post=post).select_related('reply').order_by('-date_posted')
         return queryset
 
     @swagger_auto_schema(
@@ -303,11 +357,16 @@ class CommentListCreateAPIView(ListCreateAPIView):
             return Response({'error': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
         serializer = CommentCreateSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
-        comment = serializer.save()
-        send_notification.delay(post.author.id, NotificationType.new_comment(request.user, post, comment))
+        with transaction.atomic():
+            comment = serializer.save()
+            adjust_counter(Post, post.id, 'comment_count')
+        post_counters_changed(post.id)
+        bump_user_feeds(request.user.id)
+        coalesce_notification.delay(post.author.id, NotificationType.new_comment(request.user, post, comment))
         return Response({'message': 'Comment added successfully.'}, status=status.HTTP_201_CREATED)
 
-    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
+    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector],
+                         manual_parameters=SideLoadUsersMixin.include_parameters)
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
@@ -325,7 +384,11 @@ class CommentDeleteAPIView(APIView):
             return Response({'error': 'Comment not found.'}, status=status.HTTP_404_NOT_FOUND)
         if comment.author != request.user:
             return Response({'error': 'You cannot delete this comment.'}, status=status.HTTP_403_FORBIDDEN)
-        comment.delete()
+        with transaction.atomic():
+            release_unread_notifications(Notification.objects.filter(related_comment__in=reply_thread_ids(comment.pk)))
+            comment.delete()
+            recount_post_comments(comment.post_id)
+        post_counters_changed(comment.post_id)
         return Response({'message': 'Comment delete successfully.'}, status=status.HTTP_204_NO_CONTENT)
 
 
@@ -347,10 +410,12 @@ class CommentLikeUnlikeAPIView(APIView):
         except Comment.DoesNotExist:
             return Response({'error': 'Comment not found.'}, status=status.HTTP_404_NOT_FOUND)
         if not comment.likes.filter(id=user.id).exists():
-            comment.likes.add(user.id)
+            if set_like(Comment, comment.id, user.id, True):
+                bump_user_feeds(user.id)
             return Response({'message': 'Like added.'}, status=status.HTTP_200_OK)
-        elif comment.likes.filter(id=user.id).exists():
-            comment.likes.remove(user.id)
+        else:
+            if set_like(Comment, comment.id, user.id, False):
+                bump_user_feeds(user.id)
             return Response({'message': 'Like removed.'}, status=status.HTTP_200_OK)
 
 
@@ -384,17 +449,25 @@ class ReplyCreateAPIView(APIView):
         request.data['reply'] = comment.id
         serializer = ReplyCreateSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        with transaction.atomic():
+            serializer.save()
+            adjust_counter(Post, comment.post_id, 'comment_count')
+        post_counters_changed(comment.post_id)
+        bump_user_feeds(request.user.id)
         send_notification.delay(comment.author.id, NotificationType.new_reply(request.user, comment))
         return Response({'message': 'Reply added successfully.'}, status=status.HTTP_201_CREATED)
 
 
-class PostsByHashTagView(generics.ListAPIView):
+class PostsByHashTagView(SideLoadUsersMixin, FeedCacheMixin, CursorPaginationMixin, generics.ListAPIView):
     permission_classes = (IsAuthenticated, EmailVerified)
     model = HashTag
     serializer_class = PostViewSerializer
     pagination_class = ThreadsMainPaginatorLTE
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
+    feed_name = 'hashtag'
+
+    def get_feed_scopes(self):
+        return super().get_feed_scopes() + [tag_scope(self.kwargs.get('tag_name'))]
 
     def get_queryset(self):
         tag_name = self.kwargs.get('tag_name')
@@ -402,32 +475,42 @@ class PostsByHashTagView(generics.ListAPIView):
         queryset = Post.objects.filter(hash_tag=hashtag).order_by('-pk', '-date_posted')
         return queryset
 
-    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
+    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector],
+                         manual_parameters=SideLoadUsersMixin.include_parameters)
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
 
-class ForYouFeedView(generics.ListAPIView):
+class ForYouFeedView(SideLoadUsersMixin, FeedDeltaMixin, FeedCacheMixin, CursorPaginationMixin, generics.ListAPIView):
     """For You feed page records"""
     permission_classes = (IsAuthenticated, EmailVerified)
     model = Post
     serializer_class = PostViewSerializer
     pagination_class = ThreadsMainPaginatorLTE
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
+    cursor_ordering = ('-rank_score', '-date_posted', '-id')
+    feed_name = 'for_you'
 
     def get_queryset(self):
         user_id = self.request.user.id
-        queryset = Post.objects.exclude(
-            Q(author__followee__follower_id=user_id) | Q(author=user_id) | Q(author__is_private=True)
-        ).annotate(likes_count=Count('likes')).order_by('-date_posted', '-pk', '-likes_count')
-        return queryset
-
-    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
+        followee_ids = Follow.objects.filter(follower_id=user_id, allowed=True).values('followee_id')
+        queryset = Post.objects.filter(author__is_private=False).exclude(author_id=user_id).exclude(
+            author_id__in=followee_ids
+        )
+        if is_ranked():
+            queryset = queryset.filter(rank__isnull=False).annotate(rank_score=F('rank__score'))
+        else:
+            # the ranking task has not filled the candidate pool yet, fall back to the newest posts
+            queryset = queryset.annotate(rank_score=Value(0.0, output_field=FloatField()))
+        return queryset.order_by(*self.cursor_ordering)
+
+    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector],
+                         manual_parameters=FeedDeltaMixin.delta_parameters + SideLoadUsersMixin.include_parameters)
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
 
-class FollowingFeedView(generics.ListAPIView):
+class FollowingFeedView(SideLoadUsersMixin, FeedDeltaMixin, FeedCacheMixin, CursorPaginationMixin, generics.ListAPIView):
     """
     Following feed page records
     """
@@ -435,16 +518,20 @@ class FollowingFeedView(generics.ListAPIView):
     model = Post
     serializer_class = PostViewSerializer
     pagination_class = ThreadsMainPaginatorLTE
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
+    feed_name = 'following'
+
+    def get_feed_scopes(self):
+        self.pull_authors = followed_pull_authors(self.request.user.id)
+        return [user_scope(self.request.user.id)] + [author_scope(author_id) for author_id in self.pull_authors]
 
     def get_queryset(self):
-        user_id = self.request.user.id
-        queryset = Post.objects.filter(
-            author__followee__follower_id=user_id, author__followee__allowed=True
-        ).order_by('-date_posted', '-pk')
+        post_ids = read_timeline(self.request.user.id, getattr(self, 'pull_authors', None))
+        queryset = Post.objects.filter(pk__in=post_ids).order_by('-date_posted', '-pk')
         return queryset
 
-    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
+    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector],
+                         manual_parameters=FeedDeltaMixin.delta_parameters + SideLoadUsersMixin.include_parameters)
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
@@ -477,22 +564,29 @@ class HashTagsSearch(BaseSearchView):
         return queryset
 
 
-class NotificationsView(generics.ListAPIView):
+class NotificationsView(SideLoadUsersMixin, generics.ListAPIView):
     """
-    Full list of current user notifications
+    Current user notifications, newest first, paginated by cursor
     """
     permission_classes = (IsAuthenticated, EmailVerified)
     model = Notification
     serializer_class = serializers.NotificationSerializer
+    pagination_class = ThreadsCursorPaginator
+    pagination_inspector = ThreadsCursorPaginatorInspector
 
     def get_queryset(self):
-        queryset = Notification.objects.filter(owner=self.request.user)
+        queryset = Notification.objects.recent().filter(owner=self.request.user)
         return queryset
 
+    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector],
+                         manual_parameters=SideLoadUsersMixin.include_parameters)
+    def get(self, request, *args, **kwargs):
+        return self.list(request, *args, **kwargs)
+
 
-class NotificationsByTypeView(generics.ListAPIView):
+class NotificationsByTypeView(SideLoadUsersMixin, generics.ListAPIView):
     """
-    List of current user notifications by type
+    Current user notifications by type, newest first, paginated by cursor
     allowed types ->
     - test,
     - new_thread,
@@ -513,7 +607,75 @@ class NotificationsByTypeView(generics.ListAPIView):
     permission_classes = (IsAuthenticated, EmailVerified)
     model = Notification
     serializer_class = serializers.NotificationSerializer
+    pagination_class = ThreadsCursorPaginator
+    pagination_inspector = ThreadsCursorPaginatorInspector
 
     def get_queryset(self):
-        queryset = Notification.objects.filter(owner=self.request.user, type=self.kwargs.get('type'))
+        queryset = Notification.objects.recent().filter(owner=self.request.user, type=self.kwargs.get('type'))
         return queryset
+
+    @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector],
+                         manual_parameters=SideLoadUsersMixin.include_parameters)
+    def get(self, request, *args, **kwargs):
+        return self.list(request, *args, **kwargs)
+
+
+class NotificationsUnreadCountView(APIView):
+    """
+    Number of unread notifications of the current user, read from the maintained counter
+    """
+    permission_classes = (IsAuthenticated, EmailVerified)
+
+    @swagger_auto_schema(
+        responses={
+            200: openapi.Schema(type=openapi.TYPE_OBJECT, properties={'unread': openapi.Schema(type=openapi.TYPE_INTEGER)})
+        }
+    )
+    def get(self, request):
+        return Response({'unread': request.user.unread_notifications}, status=status.HTTP_200_OK)
+
+
+class NotificationsMarkReadView(APIView):
+    """
+    Mark all unread notifications of the current user as read, or only those up to `up_to_id`
+    """
+    permission_classes = (IsAuthenticated, EmailVerified)
+
+    @swagger_auto_schema(
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            properties={
+                'up_to_id': openapi.Schema(type=openapi.TYPE_INTEGER)
+            },
+        ),
+        responses={
+            200: openapi.Schema(type=openapi.TYPE_OBJECT, properties={
+                'marked': openapi.Schema(type=openapi.TYPE_INTEGER),
+                'unread': openapi.Schema(type=openapi.TYPE_INTEGER),
+            }),
+            400: 'up_to_id must be an integer.'
+        }
+    )
+    def post(self, request):
+        unread = Notification.objects.recent().filter(owner=request.user, read_at__isnull=True)
+        up_to_id = request.data.get('up_to_id')
+        if up_to_id is not None:
+            try:
+                unread = unread.filter(pk__lte=int(up_to_id))
+            except (TypeError, ValueError):
+                return Response({'error': 'up_to_id must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            marked = unread.update(read_at=timezone.now())
+            adjust_counter(User, request.user.id, 'unread_notifications', -marked)
+        unread_count = User.objects.filter(pk=request.user.id).values_list('unread_notifications', flat=True).get()
+        return Response({'marked': marked, 'unread': unread_count}, status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    """
+    Shared runtime counters (feed cache hits/misses etc.), admin only
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(metrics.snapshot(), status=status.HTTP_200_OK)
@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group
+from django.db import transaction
 
+from pages.counters import deleted_user_notifications, release_unread_notifications
 from users.models import User
 
 admin.site.unregister(Group)
@@ -15,6 +17,16 @@ class CustomUserAdmin(UserAdmin):
     search_fields = ('email', 'username')
     ordering = ('email', 'username')
 
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            release_unread_notifications(deleted_user_notifications([obj.pk]))
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            release_unread_notifications(deleted_user_notifications(list(queryset.values_list('pk', flat=True))))
+            super().delete_queryset(request, queryset)
+
     # fieldsets = (
     #                 (None, {'fields': ('username', 'email', 'password', 'userpic', 'phone', 'phone_verify')}),
     #                 ('Персональная информация', {'fields': ('first_name', 'last_name', 'date_of_birth')}),
@@ -0,0 +1,327 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+FOLLOWERS = 'followers'
+FOLLOWING = 'following'
+PENDING = 'pending'
+REQUESTED = 'requested'
+
+# member stored in every loaded set, tells an empty set from one that was never loaded (ids start at 1)
+LOADED = 0
+
+
+class BaseGraphStore:
+    """
+    Id sets of the social graph, per user: allowed followers, allowed followees (following),
+    users waiting for the user's approval (pending) and users the user waits for (requested).
+    Sets are loaded from `Follow` on first use.
+
+    Every change bumps the version of its set, loaded or not. A load passes the version read
+    before its database query and is dropped when the set changed meanwhile, so a follow
+    committed during the query is never overwritten by the older snapshot.
+    """
+
+    def __init__(self, **config):
+        pass
+
+    def get(self, kind, user_id):
+        """Return the set of `kind` of the user, None when it is not loaded."""
+        raise NotImplementedError
+
+    def contains(self, kind, user_id, member_id):
+        """Membership of one id, None when the set is not loaded."""
+        raise NotImplementedError
+
+    def version(self, kind, user_id):
+        raise NotImplementedError
+
+    def load(self, kind, user_id, member_ids, version):
+        """Store a set read from the database, unless it was loaded or changed since `version`."""
+        raise NotImplementedError
+
+    def add(self, kind, user_id, member_id):
+        """Add a member to a loaded set, unloaded sets are left for the next load."""
+        raise NotImplementedError
+
+    def remove(self, kind, user_id, member_id):
+        raise NotImplementedError
+
+
+class InMemoryGraphStore(BaseGraphStore):
+    """Process local graph store, used in tests and local development."""
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self._sets = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, user_id):
+        with self._lock:
+            members = self._sets.get((kind, user_id))
+            return None if members is None else set(members)
+
+    def contains(self, kind, user_id, member_id):
+        with self._lock:
+            members = self._sets.get((kind, user_id))
+            return None if members is None else member_id in members
+
+    def version(self, kind, user_id):
+        return self._versions.get((kind, user_id), 0)
+
+    def load(self, kind, user_id, member_ids, version):
+        with self._lock:
+            if (kind, user_id) not in self._sets and self.version(kind, user_id) == version:
+                self._sets[(kind, user_id)] = set(member_ids)
+
+    def add(self, kind, user_id, member_id):
+        with self._lock:
+            self._versions[(kind, user_id)] = self.version(kind, user_id) + 1
+            if (kind, user_id) in self._sets:
+                self._sets[(kind, user_id)].add(member_id)
+
+    def remove(self, kind, user_id, member_id):
+        with self._lock:
+            self._versions[(kind, user_id)] = self.version(kind, user_id) + 1
+            self._sets.get((kind, user_id), set()).discard(member_id)
+
+
+class RedisGraphStore(BaseGraphStore):
+    """
+    Graph sets kept in Redis, one set per (kind, user) with the LOADED marker member and a
+    version counter next to it. Loads fill a temporary key that replaces the set only when
+    the version still matches.
+    """
+
+    key_prefix = 'graph'
+    load_chunk_size = 10000
+
+    # KEYS: set, version, loaded temporary set; ARGV: version, timeout
+    commit_script = """
+    if redis.call('exists', KEYS[1]) == 0 and (redis.call('get', KEYS[2]) or '0') == ARGV[1] then
+        redis.call('rename', KEYS[3], KEYS[1])
+        redis.call('expire', KEYS[1], ARGV[2])
+        return 1
+    end
+    redis.call('del', KEYS[3])
+    return 0
+    """
+
+    # KEYS: set, version; ARGV: sadd or srem, member, timeout
+    update_script = """
+    redis.call('incr', KEYS[2])
+    redis.call('expire', KEYS[2], ARGV[3])
+    if redis.call('sismember', KEYS[1], 0) == 1 then
+        redis.call(ARGV[1], KEYS[1], ARGV[2])
+    end
+    """
+
+    def __init__(self, url='redis://redis:6379/1', timeout=24 * 60 * 60, **config):
+        super().__init__(**config)
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        # loaded sets are rebuilt from the database at least this often (seconds)
+        self.timeout = timeout
+        self._commit = self.client.register_script(self.commit_script)
+        self._update = self.client.register_script(self.update_script)
+
+    def key(self, kind, user_id):
+        return f'{self.key_prefix}:{kind}:{user_id}'
+
+    def version_key(self, kind, user_id):
+        return f'{self.key_prefix}:version:{kind}:{user_id}'
+
+    def get(self, kind, user_id):
+        members = {int(member) for member in self.client.smembers(self.key(kind, user_id))}
+        if LOADED not in members:
+            return None
+        members.discard(LOADED)
+        return members
+
+    def contains(self, kind, user_id, member_id):
+        loaded, found = self.client.smismember(self.key(kind, user_id), [LOADED, member_id])
+        return bool(found) if loaded else None
+
+    def version(self, kind, user_id):
+        return int(self.client.get(self.version_key(kind, user_id)) or 0)
+
+    def load(self, kind, user_id, member_ids, version):
+        key = self.key(kind, user_id)
+        loading_key = f'{key}:loading:{uuid.uuid4().hex}'
+        member_ids = list(member_ids)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.sadd(loading_key, LOADED)
+        for start in range(0, len(member_ids), self.load_chunk_size):
+            pipe.sadd(loading_key, *member_ids[start:start + self.load_chunk_size])
+        pipe.expire(loading_key, 60)
+        pipe.execute()
+        self._commit(keys=[key, self.version_key(kind, user_id), loading_key], args=[version, self.timeout])
+
+    def add(self, kind, user_id, member_id):
+        self._update(keys=[self.key(kind, user_id), self.version_key(kind, user_id)],
+                     args=['sadd', member_id, self.timeout])
+
+    def remove(self, kind, user_id, member_id):
+        self._update(keys=[self.key(kind, user_id), self.version_key(kind, user_id)],
+                     args=['srem', member_id, self.timeout])
+
+
+class SocialGraph:
+    """
+    Follow relations answered from the graph store with an in-process LRU of recently read
+    sets and membership checks in front. Local entries live `local_ttl` seconds, so changes
+    made by other processes are seen after at most that long; changes made through this
+    object are seen at once. Single checks ask the store for one member, whole sets are
+    only read by `followers`, `following`, `pending` and `requested`.
+    """
+
+    def __init__(self, store, local_size=10000, local_ttl=5):
+        self.store = store
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, key, now):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[0] > now:
+                self._local.move_to_end(key)
+                return entry
+        return None
+
+    def _remember(self, key, value, now):
+        with self._lock:
+            self._local[key] = (now + self.local_ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+        return value
+
+    def _load(self, kind, user_id):
+        version = self.store.version(kind, user_id)
+        members = load_members(kind, user_id)
+        self.store.load(kind, user_id, members, version)
+        return members
+
+    def members(self, kind, user_id):
+        now = time.monotonic()
+        entry = self._cached((kind, user_id), now)
+        if entry is not None:
+            return entry[1]
+
+        members = self.store.get(kind, user_id)
+        if members is None:
+            members = self._load(kind, user_id)
+        return self._remember((kind, user_id), frozenset(members), now)
+
+    def contains(self, kind, user_id, member_id):
+        now = time.monotonic()
+        entry = self._cached((kind, user_id), now) or self._cached((kind, user_id, member_id), now)
+        if entry is not None:
+            return member_id in entry[1] if isinstance(entry[1], frozenset) else entry[1]
+
+        found = self.store.contains(kind, user_id, member_id)
+        if found is None:
+            found = member_id in self._load(kind, user_id)
+        return self._remember((kind, user_id, member_id), found, now)
+
+    def followers(self, user_id):
+        return self.members(FOLLOWERS, user_id)
+
+    def following(self, user_id):
+        return self.members(FOLLOWING, user_id)
+
+    def pending(self, user_id):
+        return self.members(PENDING, user_id)
+
+    def requested(self, user_id):
+        return self.members(REQUESTED, user_id)
+
+    def is_following(self, follower_id, followee_id):
+        """True when the follow exists and is allowed."""
+        return self.contains(FOLLOWING, follower_id, followee_id)
+
+    def is_pending(self, follower_id, followee_id):
+        return self.contains(REQUESTED, follower_id, followee_id)
+
+    def has_follow(self, follower_id, followee_id):
+        """True for allowed and pending follows."""
+        return self.is_following(follower_id, followee_id) or self.is_pending(follower_id, followee_id)
+
+    def follow_status(self, follower_id, followee_id):
+        if self.is_following(follower_id, followee_id):
+            return "Followed"
+        return "Pending" if self.is_pending(follower_id, followee_id) else "Not Followed"
+
+    def is_followed_by(self, followee_id, follower_id):
+        """Same as is_following, answered from the sets of the followee."""
+        return self.contains(FOLLOWERS, followee_id, follower_id)
+
+    def has_follower(self, followee_id, follower_id):
+        """Same as has_follow, answered from the sets of the followee."""
+        return self.is_followed_by(followee_id, follower_id) or self.contains(PENDING, followee_id, follower_id)
+
+    def followed(self, follower_id, followee_id, allowed):
+        """Record a new follow, allowed or waiting for approval."""
+        if allowed:
+            self._update('add', [(FOLLOWERS, followee_id, follower_id), (FOLLOWING, follower_id, followee_id)])
+        else:
+            self._update('add', [(PENDING, followee_id, follower_id), (REQUESTED, follower_id, followee_id)])
+
+    def approved(self, follower_id, followee_id):
+        self._update('remove', [(PENDING, followee_id, follower_id), (REQUESTED, follower_id, followee_id)])
+        self.followed(follower_id, followee_id, allowed=True)
+
+    def unfollowed(self, follower_id, followee_id):
+        """Forget a follow in any state, for unfollow, removed followers and declined requests."""
+        self._update('remove', [
+            (FOLLOWERS, followee_id, follower_id),
+            (FOLLOWING, follower_id, followee_id),
+            (PENDING, followee_id, follower_id),
+            (REQUESTED, follower_id, followee_id),
+        ])
+
+    def _update(self, operation, changes):
+        for kind, user_id, member_id in changes:
+            getattr(self.store, operation)(kind, user_id, member_id)
+        with self._lock:
+            for kind, user_id, member_id in changes:
+                self._local.pop((kind, user_id), None)
+                self._local.pop((kind, user_id, member_id), None)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+
+def load_members(kind, user_id):
+    from users.models import Follow
+
+    if kind == FOLLOWERS:
+        follows = Follow.objects.filter(followee_id=user_id, allowed=True).values_list('follower_id', flat=True)
+    elif kind == FOLLOWING:
+        follows = Follow.objects.filter(follower_id=user_id, allowed=True).values_list('followee_id', flat=True)
+    elif kind == PENDING:
+        follows = Follow.objects.filter(followee_id=user_id, allowed=False).values_list('follower_id', flat=True)
+    else:
+        follows = Follow.objects.filter(follower_id=user_id, allowed=False).values_list('followee_id', flat=True)
+    return set(follows)
+
+
+@lru_cache(maxsize=None)
+def get_social_graph():
+    options = settings.SOCIAL_GRAPH
+    store_class = import_string(options['BACKEND'])
+    return SocialGraph(
+        store_class(**options.get('CONFIG', {})),
+        local_size=options.get('LOCAL_CACHE_SIZE', 10000),
+        local_ttl=options.get('LOCAL_CACHE_TTL', 5),
+    )
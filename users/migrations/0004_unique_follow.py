@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:58
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def remove_duplicate_follows(apps, schema_editor):
+    """Keep one follow per (follower, followee), an allowed one when there is any."""
+    Follow = apps.get_model('users', 'Follow')
+    duplicates = Follow.objects.values('follower_id', 'followee_id').annotate(rows=Count('pk')).filter(rows__gt=1)
+    for pair in list(duplicates):
+        follows = Follow.objects.filter(follower_id=pair['follower_id'], followee_id=pair['followee_id'])
+        keep = follows.order_by('-allowed', 'pk').values_list('pk', flat=True).first()
+        follows.exclude(pk=keep).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_profile_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_follows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='follow',
+            constraint=models.UniqueConstraint(fields=('follower', 'followee'), name='unique_follow'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+from pages.counters import reconcile_counters, user_counter_expressions
+
+
+def backfill_counters(apps, schema_editor):
+    """Counters added in 0003 start at zero, fill them from follows, posts and notifications."""
+    User = apps.get_model('users', 'User')
+    expressions = user_counter_expressions(
+        apps.get_model('pages', 'Notification'), apps.get_model('users', 'Follow'), apps.get_model('pages', 'Post')
+    )
+    reconcile_counters(User, expressions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_unique_follow'),
+        ('pages', '0012_backfill_engagement_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -32,6 +32,13 @@ class User(AbstractUser):
     location = models.CharField(max_length=200, blank=True, null=True)
     is_email_verify = models.BooleanField(default=False)
     is_private = models.BooleanField(default=False)
+    # maintained with notification writes and mark-read, see pages.counters.user_counter_expressions
+    unread_notifications = models.PositiveIntegerField(default=0)
+    # allowed follows and own posts (reposts and quotes included), maintained by the follow and
+    # post views, see pages.counters.user_counter_expressions
+    follower_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    post_count = models.PositiveIntegerField(default=0)
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username"]
@@ -51,6 +58,11 @@ class Follow(models.Model):
     follower = models.ForeignKey(User, related_name='follower', on_delete=models.CASCADE)
     allowed = models.BooleanField(default=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['follower', 'followee'], name='unique_follow'),
+        ]
+
 
 class OTP(models.Model):
     title = models.CharField(max_length=128)
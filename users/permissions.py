@@ -1,7 +1,8 @@
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import BasePermission
 
-from users.models import User, Follow
+from users.graph import get_social_graph
+from users.models import User
 
 
 class NotAuthenticate(BasePermission):
@@ -22,12 +23,10 @@ class PublicOrPrivateProfilePermission(BasePermission):
         if not profile.is_private:
             return True
         else:
-            follow = Follow.objects.filter(
-                followee_id=profile_id if followee_id else request.user.id,
-                follower_id=request.user.id if followee_id else profile_id,
-                allowed=True
-            ).exists()
-            return follow
+            graph = get_social_graph()
+            if followee_id:
+                return graph.is_following(request.user.id, profile.pk)
+            return graph.is_followed_by(request.user.id, profile.pk)
 
 
 class EmailVerified(BasePermission):
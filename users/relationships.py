@@ -0,0 +1,85 @@
+from users.models import Follow
+
+
+class Relationships:
+    """
+    Follow relations between the viewer and a page of users, resolved with two queries:
+    the viewer's follows of those users and their follows of the viewer.
+    """
+
+    def __init__(self, viewer_id, user_ids, following=None, followed_by=()):
+        self.viewer_id = viewer_id
+        self.user_ids = set(user_ids)
+        # {user_id: allowed} of the viewer's follows
+        self.following = dict(following or {})
+        self.followed_by = set(followed_by)
+
+    def covers(self, user_id):
+        return user_id in self.user_ids
+
+    @classmethod
+    def for_users(cls, viewer_id, user_ids):
+        user_ids = set(user_ids) - {viewer_id}
+        if not user_ids or viewer_id is None:
+            return cls(viewer_id, user_ids)
+        following = Follow.objects.filter(
+            follower_id=viewer_id, followee_id__in=user_ids
+        ).values_list('followee_id', 'allowed')
+        followed_by = Follow.objects.filter(
+            followee_id=viewer_id, follower_id__in=user_ids
+        ).values_list('follower_id', flat=True)
+        return cls(viewer_id, user_ids, following, followed_by)
+
+    def status(self, user_id):
+        """You / Followed / Pending / Not Followed."""
+        if user_id == self.viewer_id:
+            return "You"
+        allowed = self.following.get(user_id)
+        if allowed is None:
+            return "Not Followed"
+        return "Followed" if allowed else "Pending"
+
+    def mutual_status(self, user_id):
+        """Like `status`, with Mutual Follow and Follow in response for users following the viewer."""
+        if user_id == self.viewer_id:
+            return "You"
+        follows, followed_back = user_id in self.following, user_id in self.followed_by
+        if follows and followed_back:
+            return "Mutual Follow"
+        if follows:
+            return self.status(user_id)
+        if followed_back:
+            return "Follow in response"
+        return "Not Followed"
+
+
+class RelationshipsMixin:
+    """
+    `is_followed` of list rows from one `Relationships` lookup per page, kept in the serializer
+    context so nested user serializers reuse it. Rows are users, or objects with the user in
+    `relationship_source`.
+    """
+    relationship_source = None
+
+    def relationship_user_id(self, instance):
+        if self.relationship_source is None:
+            return instance.pk
+        return getattr(instance, f'{self.relationship_source}_id')
+
+    def prepare_page(self, instances):
+        request = self.context.get('request')
+        if request is not None:
+            self.context['relationships'] = Relationships.for_users(
+                request.user.id, [self.relationship_user_id(instance) for instance in instances]
+            )
+
+    def get_relationships(self, user_id):
+        relationships = self.context.get('relationships')
+        if relationships is None or not (relationships.covers(user_id) or user_id == relationships.viewer_id):
+            relationships = Relationships.for_users(self.context['request'].user.id, [user_id])
+            self.context['relationships'] = relationships
+        return relationships
+
+    def get_is_followed(self, obj):
+        user_id = self.relationship_user_id(obj)
+        return self.get_relationships(user_id).status(user_id)
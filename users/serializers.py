@@ -10,7 +10,9 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from config.tasks import send_email
 from users import validators
 from users.exceptions import OTPExpired
+from pages.serializers import PageListSerializer
 from users.models import User, OTP, Follow
+from users.relationships import RelationshipsMixin
 from users.utils import otp_update_or_create
 
 
@@ -20,7 +22,7 @@ class SelfUserProfileSerializer(serializers.ModelSerializer):
         fields = ['pk', 'username', 'full_name', 'bio', 'website', 'location', 'photo', 'is_private', 'is_email_verify']
 
 
-class UserProfileDataSerializer(serializers.ModelSerializer):
+class UserProfileDataSerializer(RelationshipsMixin, serializers.ModelSerializer):
     username = serializers.CharField(
         required=False,
         validators=[UniqueValidator(queryset=User.objects.all())]
@@ -35,30 +37,12 @@ class UserProfileDataSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = User
-        fields = ['pk', 'username', 'full_name', 'bio', 'website', 'location', 'photo', 'is_private', 'is_followed']
+        fields = ['pk', 'username', 'full_name', 'bio', 'website', 'location', 'photo', 'is_private', 'is_followed',
+                  'follower_count', 'following_count', 'post_count']
+        read_only_fields = ['follower_count', 'following_count', 'post_count']
 
     def get_is_followed(self, obj):
-        user_id = self.context['request'].user.id
-        followee_id = obj.id
-
-        if user_id == followee_id:
-            return "You"
-        try:
-            follow = Follow.objects.get(followee_id=followee_id, follower_id=user_id)
-        except Follow.DoesNotExist:
-            follow = None
-        try:
-            lookup_user_follow = Follow.objects.get(followee_id=user_id, follower_id=followee_id)
-        except Follow.DoesNotExist:
-            lookup_user_follow = None
-
-        if follow and lookup_user_follow:
-            return "Mutual Follow"
-        if follow:
-            return "Followed" if follow.allowed else "Pending"
-        if lookup_user_follow:
-            return "Follow in response"
-        return "Not Followed"
+        return self.get_relationships(obj.pk).mutual_status(obj.pk)
 
 
 class UserProfileSerializer(serializers.ModelSerializer):
@@ -67,46 +51,28 @@ class UserProfileSerializer(serializers.ModelSerializer):
         fields = ['pk', 'username', 'full_name', 'bio', 'website', 'location', 'photo', 'is_private']
 
 
-class FollowersSerializer(serializers.ModelSerializer):
+class FollowersSerializer(RelationshipsMixin, serializers.ModelSerializer):
+    relationship_source = 'follower'
+
     follower = UserProfileSerializer()
     is_followed = serializers.SerializerMethodField()
 
     class Meta:
         model = Follow
         fields = ['follower', 'is_followed']
+        list_serializer_class = PageListSerializer
 
-    def get_is_followed(self, obj):
-        user_id = self.context['request'].user.id
-        followee_id = obj.follower.id
-
-        if user_id == followee_id:
-            return "You"
-        try:
-            follow = Follow.objects.get(followee_id=followee_id, follower_id=user_id)
-        except Follow.DoesNotExist:
-            return "Not Followed"
-        return "Followed" if follow.allowed else "Pending"
 
+class FollowsSerializer(RelationshipsMixin, serializers.ModelSerializer):
+    relationship_source = 'followee'
 
-class FollowsSerializer(serializers.ModelSerializer):
     followee = UserProfileDataSerializer()
     is_followed = serializers.SerializerMethodField()
 
     class Meta:
         model = Follow
         fields = ['followee', 'is_followed']
-
-    def get_is_followed(self, obj):
-        user_id = self.context['request'].user.id
-        followee_id = obj.followee.id
-
-        if user_id == followee_id:
-            return "You"
-        try:
-            follow = Follow.objects.get(followee_id=followee_id, follower_id=user_id)
-        except Follow.DoesNotExist:
-            return "Not Followed"
-        return "Followed" if follow.allowed else "Pending"
+        list_serializer_class = PageListSerializer
 
 
 class MutualFollowSerializer(serializers.ModelSerializer):
@@ -1,3 +1,171 @@
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from users.graph import FOLLOWERS, InMemoryGraphStore, get_social_graph
+from users.models import User, Follow
+
+
 def test_examole():
     a = 1
     assert a is a
+
+
+@pytest.fixture(autouse=True)
+def social_graph():
+    get_social_graph.cache_clear()
+    yield get_social_graph()
+    get_social_graph.cache_clear()
+
+
+def make_user(username, **extra_fields):
+    return User.objects.create_user(
+        f'{username}@example.com', username, 'Password1!', is_email_verify=True, **extra_fields
+    )
+
+
+def client_for(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+@pytest.mark.django_db
+def test_social_graph_follows_follow_views(social_graph, django_capture_on_commit_callbacks):
+    reader, public, private = make_user('reader'), make_user('public'), make_user('private', is_private=True)
+    client = client_for(reader)
+    assert social_graph.following(reader.id) == set()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(reverse('follow_followee_action'), {'followee': public.id})
+        client.post(reverse('follow_followee_action'), {'followee': private.id})
+    assert social_graph.following(reader.id) == {public.id}
+    assert social_graph.requested(reader.id) == {private.id}
+    assert social_graph.follow_status(reader.id, private.id) == 'Pending'
+
+    with django_capture_on_commit_callbacks(execute=True):
+        client_for(private).post(reverse('followers_pending_allow'), {'follower': reader.id})
+    assert social_graph.is_following(reader.id, private.id)
+    assert social_graph.followers(private.id) == {reader.id}
+    assert social_graph.pending(private.id) == set()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(reverse('unfollow_followee_action'), {'followee': public.id})
+    assert social_graph.follow_status(reader.id, public.id) == 'Not Followed'
+
+    # a fresh process loads the same sets from the database
+    get_social_graph.cache_clear()
+    graph = get_social_graph()
+    assert graph.following(reader.id) == {private.id}
+    assert graph.followers(private.id) == {reader.id}
+    with CaptureQueriesContext(connection) as queries:
+        assert graph.is_following(reader.id, private.id)
+        assert graph.has_follower(private.id, reader.id)
+    assert len(queries) == 0
+
+
+def test_social_graph_load_is_dropped_after_concurrent_change():
+    store = InMemoryGraphStore()
+    version = store.version(FOLLOWERS, 1)
+    # the follower is removed while the load reads the database
+    store.remove(FOLLOWERS, 1, 2)
+    store.load(FOLLOWERS, 1, {2}, version)
+    assert store.get(FOLLOWERS, 1) is None
+
+    store.load(FOLLOWERS, 1, set(), store.version(FOLLOWERS, 1))
+    assert store.contains(FOLLOWERS, 1, 2) is False
+
+
+@pytest.mark.django_db
+def test_social_graph_local_cache_is_bounded(settings):
+    settings.SOCIAL_GRAPH = {**settings.SOCIAL_GRAPH, 'LOCAL_CACHE_SIZE': 2}
+    get_social_graph.cache_clear()
+    graph = get_social_graph()
+    users = [make_user(f'user{number}') for number in range(3)]
+    Follow.objects.create(follower=users[0], followee=users[1])
+    for user in users:
+        graph.following(user.id)
+    assert len(graph._local) == 2
+    assert graph.following(users[0].id) == {users[1].id}
+
+
+@pytest.mark.django_db
+def test_following_list_resolves_relationships_per_page():
+    viewer, owner = make_user('viewer'), make_user('owner')
+    followed, pending, fan, mutual = (
+        make_user('followed'), make_user('pending', is_private=True), make_user('fan'), make_user('mutual')
+    )
+    Follow.objects.create(follower=viewer, followee=followed)
+    Follow.objects.create(follower=viewer, followee=pending, allowed=False)
+    Follow.objects.create(follower=fan, followee=viewer)
+    Follow.objects.create(follower=viewer, followee=mutual)
+    Follow.objects.create(follower=mutual, followee=viewer)
+    client = client_for(viewer)
+    url = reverse('following_list', args=[owner.id])
+
+    def page_queries():
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        assert response.status_code == 200
+        return len(queries), response.data['results']
+
+    Follow.objects.create(follower=owner, followee=followed)
+    small_page_queries, _ = page_queries()
+    for followee in (viewer, pending, fan, mutual):
+        Follow.objects.create(follower=owner, followee=followee)
+    queries, results = page_queries()
+
+    assert queries == small_page_queries
+    assert {row['followee']['username']: row['is_followed'] for row in results} == {
+        'viewer': 'You', 'followed': 'Followed', 'pending': 'Pending', 'fan': 'Not Followed', 'mutual': 'Followed',
+    }
+    assert {row['followee']['username']: row['followee']['is_followed'] for row in results} == {
+        'viewer': 'You', 'followed': 'Followed', 'pending': 'Pending', 'fan': 'Follow in response',
+        'mutual': 'Mutual Follow',
+    }
+
+
+@pytest.mark.django_db
+def test_profile_counters_follow_views_and_posts():
+    reader, public, private = make_user('reader'), make_user('public'), make_user('private', is_private=True)
+    client = client_for(reader)
+
+    def counts(user):
+        response = client.get(reverse('user_profile_data', args=[user.id]))
+        return response.data['follower_count'], response.data['following_count'], response.data['post_count']
+
+    client.post(reverse('follow_followee_action'), {'followee': public.id})
+    client.post(reverse('follow_followee_action'), {'followee': private.id})
+    repeated = client.post(reverse('follow_followee_action'), {'followee': public.id})
+    assert repeated.status_code == 400
+    assert Follow.objects.filter(follower=reader, followee=public).count() == 1
+    assert counts(reader) == (0, 1, 0)
+    assert counts(private) == (0, 0, 0)
+
+    private_client = client_for(private)
+    private_client.post(reverse('followers_pending_allow'), {'follower': reader.id})
+    private_client.post(reverse('followers_pending_allow'), {'follower': reader.id})
+    assert counts(reader) == (0, 2, 0)
+    assert counts(private) == (1, 0, 0)
+
+    client_for(public).post(reverse('follow_followee_action'), {'followee': reader.id})
+    private_client.post(reverse('delete_follower_action'), {'follower': reader.id})
+    client.post(reverse('unfollow_followee_action'), {'followee': public.id})
+    assert counts(reader) == (1, 0, 0)
+    assert counts(public) == (0, 1, 0)
+
+    client.post('/post/', {'text': 'first', 'comments_permission': 'anyone'})
+    client.post('/post/', {'text': 'second', 'comments_permission': 'anyone'})
+    assert counts(reader) == (1, 0, 2)
+    post_id = reader.post_set.get(text='first').pk
+    client.delete(f'/post/{post_id}/')
+    assert counts(reader) == (1, 0, 1)
+
+    User.objects.filter(pk=reader.pk).update(follower_count=7, following_count=7, post_count=0)
+    call_command('reconcile_counters', chunk_size=1, stdout=StringIO())
+    assert counts(reader) == (1, 0, 1)
@@ -4,6 +4,7 @@ from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from dj_rest_auth.registration.serializers import SocialLoginSerializer
 from dj_rest_auth.registration.views import SocialLoginView
+from django.db import transaction
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status, generics
@@ -15,11 +16,14 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 from cloudinary.uploader import upload
 
-from config.tasks import send_notification
+from config.tasks import send_notification, backfill_timeline, coalesce_notification, purge_timeline
 from config.types import NotificationType
-from config.utils import ThreadsMainPaginatorInspector, ThreadsMainPaginator
+from config.utils import ThreadsMainPaginator, ThreadsCursorPaginatorInspector, CursorPaginationMixin
+from pages.counters import adjust_follow_counters
+from pages.feed_cache import PUBLIC_SCOPE, bump_user_feeds, bump_versions
 from users import permissions, serializers
 from users.base_views import BaseOtpView, BaseOTPVerifyView
+from users.graph import get_social_graph
 from users.models import User, Follow
 
 
@@ -88,6 +92,12 @@ class UserProfileUpdateView(generics.UpdateAPIView):
         queryset = User.objects.get(pk=user_id)
         return queryset
 
+    def perform_update(self, serializer):
+        was_private = serializer.instance.is_private
+        user = serializer.save()
+        if user.is_private != was_private:
+            bump_versions([PUBLIC_SCOPE])
+
 
 class GoogleLoginView(SocialLoginView):
     adapter_class = GoogleOAuth2Adapter
@@ -100,16 +110,17 @@ class GoogleLoginView(SocialLoginView):
         return serializer_class(*args, **kwargs)
 
 
-class FollowersListView(generics.ListAPIView):
+class FollowersListView(CursorPaginationMixin, generics.ListAPIView):
     """API view to retrieve a list of followers for a given user."""
     permission_classes = (IsAuthenticated, permissions.EmailVerified, permissions.PublicOrPrivateProfilePermission)
     serializer_class = serializers.FollowersSerializer
     pagination_class = ThreadsMainPaginator
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
+    cursor_ordering = ('-id',)
 
     def get_queryset(self):
         followee_id = self.kwargs.get('followee_pk')
-        queryset = Follow.objects.filter(followee_id=followee_id, allowed=True)
+        queryset = Follow.objects.filter(followee_id=followee_id, allowed=True).select_related('follower')
         return queryset
 
     @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
@@ -117,16 +128,17 @@ class FollowersListView(generics.ListAPIView):
         return self.list(request, *args, **kwargs)
 
 
-class FollowersListPendingView(generics.ListAPIView):
+class FollowersListPendingView(CursorPaginationMixin, generics.ListAPIView):
     """API view to retrieve a list of pending followers for the authenticated user."""
     permission_classes = (IsAuthenticated, permissions.EmailVerified)
     serializer_class = serializers.FollowersSerializer
     pagination_class = ThreadsMainPaginator
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
+    cursor_ordering = ('-id',)
 
     def get_queryset(self):
         user_id = self.request.user.pk
-        queryset = Follow.objects.filter(followee_id=user_id, allowed=False)
+        queryset = Follow.objects.filter(followee_id=user_id, allowed=False).select_related('follower')
         return queryset
 
     @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
@@ -134,16 +146,17 @@ class FollowersListPendingView(generics.ListAPIView):
         return self.list(request, *args, **kwargs)
 
 
-class FollowingListView(generics.ListAPIView):
+class FollowingListView(CursorPaginationMixin, generics.ListAPIView):
     """API view to retrieve a list of users followed by a given follower."""
     permission_classes = (IsAuthenticated, permissions.EmailVerified, permissions.PublicOrPrivateProfilePermission)
     serializer_class = serializers.FollowsSerializer
     pagination_class = ThreadsMainPaginator
-    pagination_inspector = ThreadsMainPaginatorInspector
+    pagination_inspector = ThreadsCursorPaginatorInspector
+    cursor_ordering = ('-id',)
 
     def get_queryset(self):
         user_id = self.kwargs.get('follower_pk')
-        queryset = Follow.objects.filter(follower_id=user_id, allowed=True)
+        queryset = Follow.objects.filter(follower_id=user_id, allowed=True).select_related('followee')
         return queryset
 
     @swagger_auto_schema(pagination_class=pagination_class, paginator_inspectors=[pagination_inspector])
@@ -211,15 +224,23 @@ class FollowActionView(APIView):
             if followee == follower:
                 return Response({'error': "You can't follow by yourself"})
 
-            if Follow.objects.filter(followee=followee, follower=follower).exists():
-                return Response({'error': 'You already followed this user'}, status=status.HTTP_400_BAD_REQUEST)
-
             allowed = not followee.is_private
-            follow = Follow.objects.create(followee=followee, follower=follower, allowed=allowed)
+            with transaction.atomic():
+                # the unique (follower, followee) constraint settles double submits
+                follow, created = Follow.objects.get_or_create(
+                    followee=followee, follower=follower, defaults={'allowed': allowed}
+                )
+                if not created:
+                    return Response({'error': 'You already followed this user'}, status=status.HTTP_400_BAD_REQUEST)
+                if allowed:
+                    adjust_follow_counters(follower.id, followee.id)
+                transaction.on_commit(lambda: get_social_graph().followed(follower.id, followee.id, allowed))
+            bump_user_feeds(follower.id)
             if allowed:
-                send_notification.delay(followee.id, NotificationType.new_subscriber(follower))
+                backfill_timeline.delay(follower.id, followee.id)
+                coalesce_notification.delay(followee.id, NotificationType.new_subscriber(follower))
             else:
-                send_notification.delay(followee.id, NotificationType.subscribe_request(follower))
+                coalesce_notification.delay(followee.id, NotificationType.subscribe_request(follower))
 
             mutual_follow_data = self.secondary_serializer(instance=follow).data
             return Response(mutual_follow_data, status=status.HTTP_200_OK)
@@ -242,7 +263,13 @@ class UnfollowActionView(APIView):
             follower = request.user
             followee = serializer.validated_data['followee']
             follow = get_object_or_404(Follow, follower=follower, followee=followee)
-            follow.delete()
+            with transaction.atomic():
+                deleted, _ = follow.delete()
+                if deleted and follow.allowed:
+                    adjust_follow_counters(follower.id, followee.id, -1)
+                transaction.on_commit(lambda: get_social_graph().unfollowed(follower.id, followee.id))
+            bump_user_feeds(follower.id)
+            purge_timeline.delay(follower.id, followee.id)
             return Response({'action': "unfollowed", 'followee_id': followee.id})
         else:
             return Response({'error': serializer.error_messages}, status=status.HTTP_404_NOT_FOUND)
@@ -263,7 +290,13 @@ class DeleteFollowerView(APIView):
             follower = serializer.validated_data['follower']
             follow = get_object_or_404(
                 Follow, followee=request.user.id, follower=follower)
-            follow.delete()
+            with transaction.atomic():
+                deleted, _ = follow.delete()
+                if deleted and follow.allowed:
+                    adjust_follow_counters(follower.id, request.user.id, -1)
+                transaction.on_commit(lambda: get_social_graph().unfollowed(follower.id, request.user.id))
+            bump_user_feeds(follower.id)
+            purge_timeline.delay(follower.id, request.user.id)
             return Response({'action': "deleted", 'follower_id': follower.id}, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -284,11 +317,16 @@ class FollowPendingConfirm(APIView):
         if serializer.is_valid():
             follow = get_object_or_404(
                 Follow, followee=request.user.id, follower=serializer.validated_data['follower'].id, allowed=False)
+            with transaction.atomic():
+                # the filter keeps a repeated approval from counting twice
+                if Follow.objects.filter(pk=follow.pk, allowed=False).update(allowed=True):
+                    adjust_follow_counters(follow.follower_id, follow.followee_id)
+                    transaction.on_commit(lambda: get_social_graph().approved(follow.follower_id, follow.followee_id))
             follow.allowed = True
-            follow.save()
+            backfill_timeline.delay(follow.follower_id, follow.followee_id)
             send_notification.delay(follow.follower.id, NotificationType.subscribe_allowed(follow.followee))
 
-            mutual_follow_serializer_instance = self.secondary_serializer(follow)
+            mutual_follow_serializer_instance = self.secondary_serializer(follow, context={'request': request})
 
             return Response(mutual_follow_serializer_instance.data, status=status.HTTP_200_OK)
         else:
@@ -310,7 +348,10 @@ class FollowPendingDecline(APIView):
             follower = serializer.validated_data['follower']
             follow = get_object_or_404(
                 Follow, followee=request.user.id, follower=follower, allowed=False)
-            follow.delete()
+            with transaction.atomic():
+                follow.delete()
+                transaction.on_commit(lambda: get_social_graph().unfollowed(follower.id, request.user.id))
+            bump_user_feeds(follower.id)
             return Response({'action': "deleted", 'follower_id': follower.id}, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)